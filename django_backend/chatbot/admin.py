@@ -1,34 +1,69 @@
+import uuid
 from django.contrib import admin
-from .models import ChatSession, Message, AIConfiguration, ChatAnalytics
+from . import search
+from .models import ChatSession, Message, AIConfiguration, FallbackIntent, ChatAnalytics, ChatMetricsRollup
+
+def _is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ['session_id', 'user', 'title', 'is_active', 'created_at', 'updated_at']
     list_filter = ['is_active', 'created_at', 'updated_at']
     search_fields = ['session_id', 'user__username', 'user__email', 'title']
-    readonly_fields = ['session_id', 'created_at', 'updated_at']
+    readonly_fields = ['session_id', 'context_summary', 'context_summary_upto', 'created_at', 'updated_at']
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['id', 'chat_session', 'message_type', 'content_preview', 'created_at']
     list_filter = ['message_type', 'created_at']
     search_fields = ['content', 'chat_session__session_id', 'chat_session__user__username']
+    search_help_text = 'Full-text search on message content, or paste a session ID'
     readonly_fields = ['created_at']
 
+    def get_search_results(self, request, queryset, search_term):
+        """Use the full-text index instead of ILIKE scans over every message"""
+        search_term = search_term.strip()
+        if not search_term or not search.is_supported():
+            return super().get_search_results(request, queryset, search_term)
+        if _is_uuid(search_term):
+            return queryset.filter(chat_session__session_id=search_term), False
+        return search.filter_messages(queryset, search_term), False
+
     def content_preview(self, obj):
         return obj.content[:100] + '...' if len(obj.content) > 100 else obj.content
     content_preview.short_description = 'Content Preview'
 
 @admin.register(AIConfiguration)
 class AIConfigurationAdmin(admin.ModelAdmin):
-    list_display = ['name', 'model_name', 'temperature', 'max_tokens', 'is_active', 'created_at']
-    list_filter = ['is_active', 'model_name', 'created_at']
+    list_display = ['name', 'model_name', 'temperature', 'max_tokens', 'response_cache_enabled', 'max_concurrent_requests', 'requests_per_minute', 'is_active', 'created_at']
+    list_filter = ['is_active', 'response_cache_enabled', 'knowledge_base_enabled', 'model_name', 'created_at']
     search_fields = ['name', 'model_name']
     readonly_fields = ['created_at', 'updated_at']
 
+@admin.register(FallbackIntent)
+class FallbackIntentAdmin(admin.ModelAdmin):
+    list_display = ['name', 'priority', 'is_active', 'updated_at']
+    list_filter = ['is_active']
+    list_editable = ['priority', 'is_active']
+    search_fields = ['name', 'keywords', 'response']
+    readonly_fields = ['created_at', 'updated_at']
+
 @admin.register(ChatAnalytics)
 class ChatAnalyticsAdmin(admin.ModelAdmin):
-    list_display = ['chat_session', 'total_messages', 'user_messages', 'assistant_messages', 'satisfaction_rating']
+    list_display = ['chat_session', 'total_messages', 'user_messages', 'assistant_messages',
+                    'average_response_time', 'completion_tokens', 'satisfaction_rating']
     list_filter = ['satisfaction_rating', 'created_at']
     search_fields = ['chat_session__session_id', 'chat_session__user__username']
-    readonly_fields = ['created_at', 'updated_at']
\ No newline at end of file
+    readonly_fields = ['created_at', 'updated_at']
+
+@admin.register(ChatMetricsRollup)
+class ChatMetricsRollupAdmin(admin.ModelAdmin):
+    list_display = ['bucket_start', 'period', 'sessions_created', 'total_messages', 'user_messages',
+                    'assistant_messages', 'average_response_time', 'prompt_tokens', 'completion_tokens']
+    list_filter = ['period']
+    readonly_fields = ['updated_at']
\ No newline at end of file
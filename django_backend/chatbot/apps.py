@@ -2,4 +2,7 @@ from django.apps import AppConfig
 
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'chatbot'
\ No newline at end of file
+    name = 'chatbot'
+
+    def ready(self):
+        from . import signals  # noqa: F401
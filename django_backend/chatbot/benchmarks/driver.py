@@ -0,0 +1,287 @@
+import asyncio
+import json
+import string
+import threading
+import time
+import uuid
+from importlib import import_module
+import httpx
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.db.backends.signals import connection_created
+from django.utils.crypto import get_random_string
+from chatbot.models import ChatSession
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+USERNAME_PREFIX = 'loadtest-'
+
+PROMPTS = [
+    "How many vacation days do I get per year?",
+    "How do I reset my VPN password?",
+    "Where can I find the expense reimbursement policy?",
+    "Who approves overtime requests?",
+    "What is the process for reporting a broken laptop?",
+]
+
+
+class BenchSession:
+    """A throwaway user logged in through the session store, with one chat session"""
+
+    def __init__(self, user, chat_session, session_key):
+        self.user = user
+        self.chat_session = chat_session
+        self.session_key = session_key
+        self.csrf_token = get_random_string(32, string.ascii_letters + string.digits)
+
+    @property
+    def cookie(self) -> str:
+        return f'{settings.SESSION_COOKIE_NAME}={self.session_key}; {settings.CSRF_COOKIE_NAME}={self.csrf_token}'
+
+
+def create_sessions(count, run_id):
+    """Users, chat sessions and logged-in session cookies for one run"""
+    User = get_user_model()
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    backend = getattr(settings, 'AUTHENTICATION_BACKENDS', ['django.contrib.auth.backends.ModelBackend'])[0]
+
+    sessions = []
+    for i in range(count):
+        user = User(username=f'{USERNAME_PREFIX}{run_id}-{i}', first_name='Load')
+        user.set_unusable_password()
+        user.save()
+        chat_session = ChatSession.objects.create(user=user, session_id=uuid.uuid4(), title='Load test')
+
+        store = SessionStore()
+        store[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        store[BACKEND_SESSION_KEY] = backend
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.create()
+        sessions.append(BenchSession(user, chat_session, store.session_key))
+    return sessions
+
+
+def delete_sessions(sessions):
+    """Remove a run's users with their chats, and their login sessions"""
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    for bench in sessions:
+        SessionStore(bench.session_key).delete()
+    get_user_model().objects.filter(pk__in=[bench.user.pk for bench in sessions]).delete()
+
+
+class QueryCounter:
+    """Counts SQL statements on every database connection opened while installed"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, sender, connection, **kwargs):
+        # Connections are reopened between requests; wrap each wrapper object once
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self._connections.append(connection)
+
+    def install(self):
+        connection_created.connect(self._attach, weak=False)
+
+    def uninstall(self):
+        connection_created.disconnect(self._attach)
+        for connection in self._connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class _CommunicatorSocket:
+    def __init__(self, communicator):
+        self.communicator = communicator
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class _ClientSocket:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def send(self, text):
+        await self.connection.send(text)
+
+    async def recv(self, timeout):
+        return await asyncio.wait_for(self.connection.recv(), timeout)
+
+    async def close(self):
+        await self.connection.close()
+
+
+class InProcessTransport:
+    """Drives the project's ASGI application inside this process.
+
+    Requests go through the full routing, middleware and consumer stack
+    without a network hop, and the database queries they make can be
+    counted.
+    """
+    name = 'in-process'
+
+    def __init__(self, application):
+        self.application = application
+
+    def http_client(self, timeout):
+        return httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=self.application), base_url='http://localhost', timeout=timeout
+        )
+
+    async def open_websocket(self, path, cookie):
+        communicator = WebsocketCommunicator(self.application, path, headers=[(b'cookie', cookie.encode())])
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise ConnectionRefusedError(f'WebSocket rejected: {path}')
+        return _CommunicatorSocket(communicator)
+
+
+class RemoteTransport:
+    """Drives a running server over the network; needs the ``websockets`` package"""
+    name = 'remote'
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def http_client(self, timeout):
+        return httpx.AsyncClient(base_url=self.base_url, timeout=timeout)
+
+    async def open_websocket(self, path, cookie):
+        url = self.base_url.replace('http', 'ws', 1) + path
+        connection = await websockets.connect(url, extra_headers={'Cookie': cookie})
+        return _ClientSocket(connection)
+
+
+class LoadTest:
+    """Runs conversations concurrently and records every turn.
+
+    Each session sends ``turns`` messages one after another, waiting for the
+    reply before the next. Prompts carry the run id so that replies cached
+    by earlier runs are never reused; with ``same_prompt`` every session
+    asks the same questions, which exercises the response cache and
+    single-flight coalescing.
+    """
+
+    def __init__(self, transport, run_id, turns=3, stream=True, think_time=0.0, ramp_up=0.0,
+                 timeout=60.0, same_prompt=False):
+        self.transport = transport
+        self.run_id = run_id
+        self.turns = turns
+        self.stream = stream
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.timeout = timeout
+        self.same_prompt = same_prompt
+
+    def prompt(self, index, turn):
+        base = PROMPTS[turn % len(PROMPTS)]
+        if self.same_prompt:
+            return f'{base} [{self.run_id}]'
+        return f'{base} [{self.run_id}-{index}]'
+
+    async def run(self, websocket_sessions, rest_sessions):
+        """Returns the recorded turns and the wall-clock duration in seconds"""
+        total = len(websocket_sessions) + len(rest_sessions)
+        started = time.perf_counter()
+        async with self.transport.http_client(self.timeout) as client:
+            jobs = [self.websocket_session(bench, i, total) for i, bench in enumerate(websocket_sessions)]
+            jobs += [
+                self.rest_session(client, bench, len(websocket_sessions) + i, total)
+                for i, bench in enumerate(rest_sessions)
+            ]
+            results = await asyncio.gather(*jobs)
+        duration = time.perf_counter() - started
+        return [turn for session_turns in results for turn in session_turns], duration
+
+    async def _stagger(self, index, total):
+        if self.ramp_up and total > 1:
+            await asyncio.sleep(self.ramp_up * index / (total - 1))
+
+    def _turn(self, transport, started, ttft_ms=None, error=None):
+        latency_ms = (time.perf_counter() - started) * 1000
+        return {'transport': transport, 'latency_ms': latency_ms, 'ttft_ms': ttft_ms, 'error': error}
+
+    async def websocket_session(self, bench, index, total):
+        await self._stagger(index, total)
+        turns = []
+        started = time.perf_counter()
+        try:
+            socket = await self.transport.open_websocket(f'/ws/chat/{bench.chat_session.session_id}/', bench.cookie)
+        except Exception as e:
+            return [self._turn('websocket', started, error=f'connect: {type(e).__name__}')]
+
+        try:
+            for turn in range(self.turns):
+                started = time.perf_counter()
+                await socket.send(json.dumps({
+                    'type': 'message', 'content': self.prompt(index, turn), 'stream': self.stream
+                }))
+                ttft_ms, error = None, None
+                try:
+                    while True:
+                        frame = json.loads(await socket.recv(self.timeout))
+                        if 'error' in frame:
+                            error = 'error frame'
+                            break
+                        if frame.get('type') == 'delta' and ttft_ms is None:
+                            ttft_ms = (time.perf_counter() - started) * 1000
+                        if frame.get('type') == 'message' and frame['message'].get('type') == 'assistant':
+                            break
+                except asyncio.TimeoutError:
+                    error = 'timeout'
+
+                record = self._turn('websocket', started, ttft_ms, error)
+                if record['ttft_ms'] is None and not error:
+                    # Unstreamed (or cached) replies arrive all at once
+                    record['ttft_ms'] = record['latency_ms']
+                turns.append(record)
+                if error == 'timeout':
+                    break
+                if self.think_time:
+                    await asyncio.sleep(self.think_time)
+        finally:
+            try:
+                await socket.close()
+            except Exception:
+                pass
+        return turns
+
+    async def rest_session(self, client, bench, index, total):
+        await self._stagger(index, total)
+        turns = []
+        url = f'/api/v1/chat/sessions/{bench.chat_session.pk}/send_message/'
+        headers = {'Cookie': bench.cookie, 'X-CSRFToken': bench.csrf_token}
+        for turn in range(self.turns):
+            started = time.perf_counter()
+            error = None
+            try:
+                response = await client.post(url, json={'content': self.prompt(index, turn)}, headers=headers)
+                if response.status_code != 200:
+                    error = f'http {response.status_code}'
+            except httpx.TimeoutException:
+                error = 'timeout'
+            except httpx.HTTPError as e:
+                error = type(e).__name__
+            turns.append(self._turn('rest', started, error=error))
+            if self.think_time:
+                await asyncio.sleep(self.think_time)
+        return turns
@@ -0,0 +1,100 @@
+import math
+import subprocess
+
+
+def summarize(values):
+    """Count, mean and nearest-rank percentiles of ``values`` in milliseconds"""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+
+    def rank(p):
+        return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)], 1)
+
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 1),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': round(values[-1], 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(turns, duration, options, db_queries=None, server=None) -> dict:
+    """JSON-serializable report for a load-test run.
+
+    ``turns`` are dicts with ``transport`` ('websocket' or 'rest'),
+    ``latency_ms``, ``ttft_ms`` and ``error``.
+    """
+    completed = [t for t in turns if not t['error']]
+    by_transport = {}
+    for transport in ('websocket', 'rest'):
+        selected = [t for t in completed if t['transport'] == transport]
+        if not selected and not any(t['transport'] == transport for t in turns):
+            continue
+        by_transport[transport] = {
+            'turns': len(selected),
+            'latency_ms': summarize(t['latency_ms'] for t in selected),
+            'ttft_ms': summarize(t['ttft_ms'] for t in selected),
+        }
+
+    errors = {}
+    for turn in turns:
+        if turn['error']:
+            errors[turn['error']] = errors.get(turn['error'], 0) + 1
+
+    return {
+        'commit': git_commit(),
+        'options': options,
+        'duration_s': round(duration, 3),
+        'turns': len(turns),
+        'completed': len(completed),
+        'errors': errors,
+        'throughput_turns_per_s': round(len(completed) / duration, 2) if duration else None,
+        'latency_ms': summarize(t['latency_ms'] for t in completed),
+        'transports': by_transport,
+        'db_queries_per_turn': round(db_queries / len(completed), 2) if db_queries is not None and completed else None,
+        'server': server or {},
+    }
+
+
+COMPARED_METRICS = [
+    ('throughput_turns_per_s', ('throughput_turns_per_s',), True),
+    ('latency p50', ('latency_ms', 'p50'), False),
+    ('latency p95', ('latency_ms', 'p95'), False),
+    ('latency p99', ('latency_ms', 'p99'), False),
+    ('ws ttft p50', ('transports', 'websocket', 'ttft_ms', 'p50'), False),
+    ('ws ttft p95', ('transports', 'websocket', 'ttft_ms', 'p95'), False),
+    ('db queries/turn', ('db_queries_per_turn',), False),
+]
+
+
+def _lookup(report, path):
+    for key in path:
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report
+
+
+def compare(report, baseline):
+    """Rows of (metric, baseline, current, change %, regressed) for headline metrics"""
+    rows = []
+    for name, path, higher_is_better in COMPARED_METRICS:
+        old, new = _lookup(baseline, path), _lookup(report, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else None
+        regressed = change is not None and (change < 0 if higher_is_better else change > 0)
+        rows.append((name, old, new, change, regressed))
+    return rows
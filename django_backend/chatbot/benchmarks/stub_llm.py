@@ -0,0 +1,164 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VOCABULARY = (
+    'the', 'policy', 'covers', 'leave', 'requests', 'and', 'your', 'manager', 'approves',
+    'them', 'in', 'the', 'portal', 'within', 'two', 'business', 'days', 'please', 'contact',
+    'HR', 'if', 'you', 'need', 'more', 'help', 'with', 'benefits', 'or', 'payroll',
+)
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """OpenAI-compatible chat completions endpoint with scripted timing.
+
+    Every completion waits ``latency`` seconds (plus up to ``jitter``) before
+    its first token and then emits ``tokens`` tokens at ``token_rate`` per
+    second (0 sends them all at once). A fraction ``error_rate`` of requests
+    fails with ``error_status`` instead. Answers both the OpenAI path
+    (``/v1/chat/completions``) and Azure deployment paths, so it can stand
+    in for any LLM_ENDPOINTS entry through ``base_url``.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, jitter=0.0, token_rate=50.0,
+                 tokens=60, error_rate=0.0, error_status=503, seed=None):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self.counts = {'requests': 0, 'streamed': 0, 'errors': 0, 'completion_tokens': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        """Serve from a daemon thread; returns self"""
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-llm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def plan(self, streamed: bool):
+        """(fail, first_token_delay) for a new request"""
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['streamed'] += int(streamed)
+            fail = self.rng.random() < self.error_rate
+            if fail:
+                self.counts['errors'] += 1
+            else:
+                self.counts['completion_tokens'] += self.tokens
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        return fail, delay
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._json(400, {'error': {'message': 'Invalid JSON body', 'type': 'invalid_request_error'}})
+        if not self.path.split('?')[0].rstrip('/').endswith('/chat/completions'):
+            return self._json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+        server = self.server
+        streamed = bool(body.get('stream'))
+        fail, delay = server.plan(streamed)
+        time.sleep(delay)
+        if fail:
+            return self._json(server.error_status, {
+                'error': {'message': 'Injected failure', 'type': 'server_error'}
+            })
+
+        words = [VOCABULARY[i % len(VOCABULARY)] for i in range(server.tokens)]
+        tokens = [words[0].capitalize()] + [' ' + word for word in words[1:]] if words else []
+        interval = 1.0 / server.token_rate if server.token_rate else 0.0
+        model = body.get('model', 'stub')
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        if streamed:
+            self._stream(completion_id, model, tokens, interval)
+        else:
+            time.sleep(interval * len(tokens))
+            prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in body.get('messages', []))
+            self._json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(tokens) + '.'},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': len(tokens),
+                    'total_tokens': prompt_tokens + len(tokens),
+                },
+            })
+
+    def _stream(self, completion_id, model, tokens, interval):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            return 'data: ' + json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }) + '\n\n'
+
+        try:
+            self._write_chunk(chunk({'role': 'assistant', 'content': ''}))
+            for i, token in enumerate(tokens):
+                if i and interval:
+                    time.sleep(interval)
+                self._write_chunk(chunk({'content': token}))
+            self._write_chunk(chunk({}, 'stop') + 'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the generation
+            self.close_connection = True
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,108 @@
+import gzip
+import logging
+import os
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from .models import ChatAnalytics, ChatSession, Message
+
+logger = logging.getLogger('chatbot')
+
+SESSION_FIELDS = ['id', 'user_id', 'session_id', 'title', 'created_at', 'updated_at', 'is_active']
+MESSAGE_FIELDS = ['id', 'chat_session_id', 'message_type', 'content', 'metadata', 'created_at']
+
+
+def expired_sessions(cutoff):
+    return ChatSession.objects.filter(is_active=False, updated_at__lt=cutoff)
+
+
+def archive_path(now=None):
+    now = now or timezone.now()
+    return os.path.join(settings.CHAT_ARCHIVE_DIR, f"sessions-{now:%Y%m%dT%H%M%S}.jsonl.gz")
+
+
+def write_archive(archive, session_ids):
+    """Append one line per session and per message to an open gzip text file.
+
+    Messages are read with a server-side iterator so a single huge session
+    does not have to fit in memory.
+    """
+    encoder = DjangoJSONEncoder()
+    sessions = ChatSession.objects.filter(id__in=session_ids).order_by('id').values(*SESSION_FIELDS)
+    for session in sessions:
+        archive.write(encoder.encode({'record': 'session', **session}) + '\n')
+
+    messages = (
+        Message.objects.filter(chat_session_id__in=session_ids)
+        .order_by('chat_session_id', 'created_at', 'id')
+        .values(*MESSAGE_FIELDS)
+    )
+    for message in messages.iterator(chunk_size=settings.CLEANUP_MESSAGE_BATCH_SIZE):
+        archive.write(encoder.encode({'record': 'message', **message}) + '\n')
+
+
+def delete_sessions(session_ids):
+    """Delete a batch of sessions, their messages in bounded chunks first.
+
+    Every DELETE runs in its own short transaction and filters by primary
+    key, so no related rows are loaded by the cascade collector.
+    """
+    while True:
+        message_ids = list(
+            Message.objects.filter(chat_session_id__in=session_ids)
+            .values_list('id', flat=True)[:settings.CLEANUP_MESSAGE_BATCH_SIZE]
+        )
+        if not message_ids:
+            break
+        with transaction.atomic():
+            Message.objects.filter(id__in=message_ids).delete()
+
+    with transaction.atomic():
+        ChatAnalytics.objects.filter(chat_session_id__in=session_ids).delete()
+        deleted, _ = ChatSession.objects.filter(id__in=session_ids, is_active=False).delete()
+    return deleted
+
+
+def cleanup_sessions(cutoff, archive=False, batch_size=None, pause=None):
+    """Archive (optionally) and delete expired sessions in id-ordered batches.
+
+    Batches are walked by ascending id, so each step reads at most
+    ``batch_size`` session ids and memory stays flat however large the
+    backlog is. Sleeps ``pause`` seconds between batches to leave room for
+    foreground writes. Returns ``(deleted_count, archive_file)``.
+    """
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    pause = settings.CLEANUP_BATCH_PAUSE if pause is None else pause
+    queryset = expired_sessions(cutoff).order_by('id')
+
+    archive_file = None
+    archive_handle = None
+    if archive:
+        os.makedirs(settings.CHAT_ARCHIVE_DIR, exist_ok=True)
+        archive_file = archive_path()
+        archive_handle = gzip.open(archive_file, 'wt', encoding='utf-8')
+
+    deleted_count = 0
+    last_id = 0
+    try:
+        while True:
+            session_ids = list(queryset.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not session_ids:
+                break
+            last_id = session_ids[-1]
+
+            if archive_handle is not None:
+                write_archive(archive_handle, session_ids)
+                archive_handle.flush()
+
+            deleted_count += delete_sessions(session_ids)
+            logger.debug(f"Cleanup batch up to session {last_id}: {deleted_count} deleted so far")
+            if pause:
+                time.sleep(pause)
+    finally:
+        if archive_handle is not None:
+            archive_handle.close()
+
+    return deleted_count, archive_file
@@ -0,0 +1,71 @@
+import logging
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .models import AIConfiguration
+
+logger = logging.getLogger('chatbot')
+
+VERSION_KEY = 'chatbot:ai_config:version'
+
+# (config, version, checked_at) for this worker process
+_cached = (None, None, 0.0)
+
+
+def _current_version():
+    try:
+        return cache.get(VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"Could not read AI configuration version: {str(e)}")
+        return None
+
+
+def get_active_config(default_factory):
+    """Return the active AIConfiguration, loading it at most once per version.
+
+    The shared version key is only consulted every
+    AI_CONFIG_CACHE_CHECK_INTERVAL seconds, which bounds how long a worker
+    can keep serving a configuration that was changed elsewhere.
+    ``default_factory`` is called when no configuration is active.
+    """
+    global _cached
+    config, version, checked_at = _cached
+    now = time.monotonic()
+
+    if config is not None and now - checked_at < settings.AI_CONFIG_CACHE_CHECK_INTERVAL:
+        return config
+
+    current_version = _current_version()
+    if config is not None and current_version is not None and current_version == version:
+        _cached = (config, version, now)
+        return config
+
+    config = AIConfiguration.objects.filter(is_active=True).first()
+    if not config:
+        config = default_factory()
+
+    if current_version is None:
+        # Nobody has published a version yet; publish one so other workers
+        # can tell when this configuration changes.
+        current_version = _publish_version()
+    _cached = (config, current_version, now)
+    return config
+
+
+def _publish_version():
+    version = uuid.uuid4().hex
+    try:
+        cache.set(VERSION_KEY, version, None)
+    except Exception as e:
+        logger.warning(f"Could not publish AI configuration version: {str(e)}")
+        return None
+    return version
+
+
+def invalidate():
+    """Drop the local copy and bump the shared version for every worker"""
+    global _cached
+    _cached = (None, None, 0.0)
+    _publish_version()
+    logger.info("Invalidated cached AI configuration")
@@ -1,27 +1,75 @@
+import asyncio
 import json
 import logging
+import time
+from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import ChatSession, Message
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics, presence, turns
+from .models import ChatSession
+from .persistence import save_message
 from .services import AIService
 
 logger = logging.getLogger('chatbot')
 
+# Close code sent to sockets whose session was ended elsewhere
+SESSION_ENDED_CLOSE_CODE = 4000
+
+
+def room_group_name(session_id) -> str:
+    return f'chat_{session_id}'
+
+
+def end_session_sockets(session_id):
+    """Tell every socket on the session that it has ended, so they drop it and close"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            room_group_name(session_id), {'type': 'session_ended'}
+        )
+    except Exception as e:
+        logger.warning(f"Could not notify sockets that session {session_id} ended: {str(e)}")
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
-        self.room_group_name = f'chat_{self.session_id}'
-        
+        self.room_group_name = room_group_name(self.session_id)
+        self.chat_session = None
+        self.joined = False
+        user = self.scope['user']
+
+        # Ownership is checked once here; rejected sockets never join the group
+        if user.is_authenticated:
+            self.chat_session = await self.get_chat_session(user)
+        if self.chat_session is None:
+            logger.warning(f"Rejected WebSocket for session {self.session_id}")
+            await self.close()
+            return
+
+        self.ai_service = AIService()
+        self.typing = presence.TypingThrottle(self.publish_typing)
+        self.turns = turns.TurnQueue(self.handle_message, self.turn_failed)
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        self.joined = True
         
         await self.accept()
+        metrics.WEBSOCKET_CONNECTIONS.inc()
         logger.info(f"WebSocket connected for session {self.session_id}")
 
     async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        metrics.WEBSOCKET_CONNECTIONS.dec()
+        self.typing.cancel()
+        self.turns.cancel()
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -35,7 +83,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message_type = text_data_json.get('type', 'message')
             
             if message_type == 'message':
-                await self.handle_message(text_data_json)
+                # Generated in the background so typing events keep flowing
+                if text_data_json.get('content') and not self.turns.submit(text_data_json):
+                    await self.send(text_data=json.dumps({
+                        'error': 'Too many messages pending, please wait for a reply'
+                    }))
             elif message_type == 'typing':
                 await self.handle_typing(text_data_json)
         except Exception as e:
@@ -44,102 +96,221 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'error': 'Failed to process message'
             }))
 
+    async def turn_failed(self, error):
+        await self.send(text_data=json.dumps({
+            'error': 'Failed to process message'
+        }))
+
     async def handle_message(self, data):
         message_content = data.get('content', '')
         user = self.scope['user']
         
-        if not message_content or not user.is_authenticated:
+        if not message_content:
             return
 
-        # Get chat session
-        chat_session = await self.get_chat_session(user)
-        if not chat_session:
+        # Authorized in connect; cleared when the session is ended
+        chat_session = self.chat_session
+        if chat_session is None:
             await self.send(text_data=json.dumps({
                 'error': 'Chat session not found'
             }))
             return
 
-        # Create user message
-        user_message = await self.create_message(chat_session, 'user', message_content)
-        
-        # Send user message to room group
+        # Saves run in a worker thread that cancelling the turn cannot stop, so
+        # they are shielded and a cancelled turn still announces what it saved
+        user_save = asyncio.ensure_future(self.create_message(chat_session, 'user', message_content))
+        user_message = reply_save = None
+        stream = data.get('stream', settings.CHAT_STREAMING_DEFAULT)
+        try:
+            user_message = await asyncio.shield(user_save)
+            await self.send_user_message(user_message)
+
+            # Generate AI response
+            if stream:
+                ai_response, metadata = await self.stream_ai_response(
+                    chat_session, user, message_content, user_message.id
+                )
+            else:
+                metadata = {'reply_to': user_message.id}
+                ai_response = await self.ai_service.agenerate_response(
+                    chat_session, message_content, metadata
+                )
+
+            reply_save = asyncio.ensure_future(
+                self.create_message(chat_session, 'assistant', ai_response, metadata)
+            )
+            assistant_message = await asyncio.shield(reply_save)
+        except asyncio.CancelledError:
+            await self.end_cancelled_turn(user_save, user_message is None, reply_save, stream)
+            raise
+
+        # Once the reply is saved it is delivered even if the turn is cancelled
+        await asyncio.shield(self.send_reply(assistant_message, stream))
+
+    async def end_cancelled_turn(self, user_save, echo_user, reply_save, stream):
+        """Deliver a reply saved as the turn was cancelled, or say that none is coming"""
+        try:
+            user_message = await user_save
+            if echo_user:
+                await self.send_user_message(user_message)
+            if reply_save is not None:
+                await self.send_reply(await reply_save, stream)
+                return
+        except Exception as e:
+            logger.error(f"Error saving a cancelled chat turn: {str(e)}")
+            return
         await self.channel_layer.group_send(
             self.room_group_name,
             {
-                'type': 'chat_message',
-                'message': {
-                    'id': user_message.id,
-                    'type': 'user',
-                    'content': message_content,
-                    'timestamp': user_message.created_at.isoformat()
-                }
+                'type': 'turn_cancelled',
+                'reason': 'cancelled' if self.turns.closed else 'superseded',
+                'reply_to': user_message.id
             }
         )
 
-        # Send typing indicator
+    async def send_user_message(self, user_message):
+        # Send user message to room group; the assistant's typing state rides along
         await self.channel_layer.group_send(
             self.room_group_name,
             {
-                'type': 'typing_indicator',
+                'type': 'chat_message',
+                'message': {
+                    'id': user_message.id,
+                    'type': 'user',
+                    'content': user_message.content,
+                    'timestamp': user_message.created_at.isoformat()
+                },
                 'is_typing': True
             }
         )
 
-        # Generate AI response
-        ai_service = AIService()
-        ai_response = await database_sync_to_async(ai_service.generate_response)(
-            chat_session, message_content
-        )
-
-        # Create assistant message
-        assistant_message = await self.create_message(chat_session, 'assistant', ai_response)
-
+    async def send_reply(self, assistant_message, stream):
         # Send assistant message to room group
+        final_message = {
+            'id': assistant_message.id,
+            'type': 'assistant',
+            'content': assistant_message.content,
+            'timestamp': assistant_message.created_at.isoformat()
+        }
+        if stream:
+            final_message['reply_to'] = assistant_message.metadata['reply_to']
+            final_message['ttft_ms'] = assistant_message.metadata.get('ttft_ms')
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
-                'message': {
-                    'id': assistant_message.id,
-                    'type': 'assistant',
-                    'content': ai_response,
-                    'timestamp': assistant_message.created_at.isoformat()
-                }
+                'message': final_message,
+                'is_typing': False
             }
         )
+        presence.record_piggybacked(2)
+
+    async def stream_ai_response(self, chat_session, user, message_content, reply_to):
+        """Stream the AI response to the room as delta frames.
+
+        Deltas are coalesced for CHAT_STREAM_FLUSH_INTERVAL seconds so a long
+        answer does not cost one channel-layer publish per token; the first
+        delta is always sent straight away. Returns the full text and the
+        metadata to store on the assistant message.
+        """
+        started = time.perf_counter()
+        metadata = {'reply_to': reply_to}
+        config, messages = await database_sync_to_async(self.ai_service.prepare_context)(
+            chat_session, message_content, metadata
+        )
+
+        parts = []
+        pending = []
+        ttft_ms = None
+        last_flush = started
+        chunks = self.ai_service.astream_response(
+            messages, config, message_content, user, metadata
+        )
+        async for chunk in chunks:
+            parts.append(chunk)
+            pending.append(chunk)
+
+            now = time.perf_counter()
+            if ttft_ms is None:
+                ttft_ms = round((now - started) * 1000, 1)
+                logger.info(f"Time to first token for session {self.session_id}: {ttft_ms}ms")
+            elif now - last_flush < settings.CHAT_STREAM_FLUSH_INTERVAL:
+                continue
+
+            await self.send_delta(reply_to, ''.join(pending))
+            pending = []
+            last_flush = now
 
-        # Stop typing indicator
+        if pending:
+            await self.send_delta(reply_to, ''.join(pending))
+
+        metadata['ttft_ms'] = ttft_ms
+        metadata['generation_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return ''.join(parts), metadata
+
+    async def send_delta(self, reply_to, delta):
         await self.channel_layer.group_send(
             self.room_group_name,
             {
-                'type': 'typing_indicator',
-                'is_typing': False
+                'type': 'chat_delta',
+                'reply_to': reply_to,
+                'delta': delta
             }
         )
 
     async def handle_typing(self, data):
-        is_typing = data.get('is_typing', False)
-        
+        # Debounced; see presence.TypingThrottle
+        await self.typing.update(bool(data.get('is_typing', False)))
+
+    async def publish_typing(self, is_typing):
         # Send typing indicator to room group
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'typing_indicator',
                 'is_typing': is_typing,
-                'user_id': self.scope['user'].id
+                'user_id': self.scope['user'].id,
+                'sender_channel': self.channel_name
             }
         )
 
     async def chat_message(self, event):
         message = event['message']
+        frame = {
+            'type': 'message',
+            'message': message
+        }
+        if 'is_typing' in event:
+            frame['is_typing'] = event['is_typing']
         
         # Send message to WebSocket
+        await self.send(text_data=json.dumps(frame))
+
+    async def chat_delta(self, event):
+        # Send incremental assistant output to WebSocket
         await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': message
+            'type': 'delta',
+            'reply_to': event['reply_to'],
+            'delta': event['delta']
+        }))
+
+    async def turn_cancelled(self, event):
+        # The user message reply_to will get no reply
+        await self.send(text_data=json.dumps({
+            'type': event['reason'],
+            'reply_to': event['reply_to']
         }))
 
+    async def session_ended(self, event):
+        self.chat_session = None
+        await self.send(text_data=json.dumps({'type': 'session_ended'}))
+        await self.close(code=SESSION_ENDED_CLOSE_CODE)
+
     async def typing_indicator(self, event):
+        # The sender already knows it is typing
+        if event.get('sender_channel') == self.channel_name:
+            return
+
         # Send typing indicator to WebSocket
         await self.send(text_data=json.dumps({
             'type': 'typing',
@@ -150,7 +321,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def get_chat_session(self, user):
         try:
-            return ChatSession.objects.get(
+            return ChatSession.objects.select_related('user').get(
                 session_id=self.session_id,
                 user=user,
                 is_active=True
@@ -159,9 +330,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return None
 
     @database_sync_to_async
-    def create_message(self, chat_session, message_type, content):
-        return Message.objects.create(
-            chat_session=chat_session,
-            message_type=message_type,
-            content=content
+    def create_message(self, chat_session, message_type, content, metadata=None):
+        if message_type == 'user':
+            # The session is held from connect, but the summary task moves on
+            # without it; reload its progress before this turn's context
+            chat_session.refresh_from_db(fields=['context_summary', 'context_summary_upto'])
+        # The reply closes the turn, so only it bumps the session's updated_at
+        return save_message(
+            chat_session, message_type, content, metadata,
+            touch_session=(message_type == 'assistant')
         )
\ No newline at end of file
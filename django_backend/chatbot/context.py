@@ -0,0 +1,264 @@
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import knowledge, llm_client, providers
+from .models import ChatSession
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is optional
+    tiktoken = None
+
+logger = logging.getLogger('chatbot')
+
+# Context windows by model name prefix; the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-35-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4o': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Tokens the chat format adds per message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+REPLY_PRIMING_TOKENS = 3
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+KNOWLEDGE_PREFIX = (
+    "\n\nAnswer from these company documents where they are relevant. "
+    "If they do not cover the question, say so rather than guessing.\n"
+)
+SUMMARY_PENDING_KEY = 'chatbot:context_summary_pending:{}'
+
+# Seconds before a tokenizer that failed to load is tried again
+TOKENIZER_RETRY_SECONDS = 60
+
+_encodings = {}
+_encoding_failures = {}
+
+
+def _encoding_for(model_name: str):
+    """Tokenizer for the model; a failed load is retried after TOKENIZER_RETRY_SECONDS"""
+    if tiktoken is None:
+        return None
+    encoding = _encodings.get(model_name)
+    if encoding is not None:
+        return encoding
+    failed_at = _encoding_failures.get(model_name)
+    if failed_at is not None and time.monotonic() - failed_at < TOKENIZER_RETRY_SECONDS:
+        return None
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Azure deployment names are arbitrary; every chat model uses cl100k
+            encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # tiktoken downloads its files on first use; only successes are kept
+        logger.warning(f"Could not load tokenizer, estimating token counts: {str(e)}")
+        _encoding_failures[model_name] = time.monotonic()
+        return None
+    _encoding_failures.pop(model_name, None)
+    _encodings[model_name] = encoding
+    return encoding
+
+
+def count_tokens(text: str, model_name: str = 'gpt-4') -> int:
+    """Count tokens locally, estimating four characters per token without tiktoken"""
+    encoding = _encoding_for(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model_name: str = 'gpt-4') -> int:
+    """Prompt tokens for a chat request, counted the way the API bills them"""
+    return sum(
+        count_tokens(message['content'], model_name) + TOKENS_PER_MESSAGE
+        for message in messages
+    ) + REPLY_PRIMING_TOKENS
+
+
+def context_window(model_name: str) -> int:
+    if settings.LLM_CONTEXT_WINDOW:
+        return settings.LLM_CONTEXT_WINDOW
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+class ContextBuilder:
+    """Packs chat history newest-first into the model's token budget.
+
+    The budget is the model window minus the completion reserved by
+    ``config.max_tokens``. Turns that no longer fit are folded into a rolling
+    summary on the session by a background task.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.model_name = config.model_name
+
+    def tokens(self, text: str) -> int:
+        return count_tokens(text, self.model_name) + TOKENS_PER_MESSAGE
+
+    def history_budget(self, fixed_messages) -> int:
+        used = sum(self.tokens(message['content']) for message in fixed_messages)
+        return (
+            context_window(self.model_name)
+            - self.config.max_tokens
+            - REPLY_PRIMING_TOKENS
+            - used
+        )
+
+    def system_prompt(self, user_message: str) -> str:
+        """The configured system prompt, grounded with the best matching passages"""
+        prompt = self.config.system_prompt
+        if not self.config.knowledge_base_enabled:
+            return prompt
+
+        passages = []
+        budget = settings.KNOWLEDGE_MAX_CONTEXT_TOKENS
+        for score, chunk in knowledge.search(user_message):
+            passage = f"[{chunk['source']}] {chunk['text']}"
+            cost = count_tokens(passage, self.model_name)
+            if cost > budget:
+                break
+            budget -= cost
+            passages.append(passage)
+        if not passages:
+            return prompt
+        return prompt + KNOWLEDGE_PREFIX + '\n\n'.join(passages)
+
+    def build(self, chat_session: ChatSession, user_message: str):
+        messages = [{"role": "system", "content": self.system_prompt(user_message)}]
+        if chat_session.context_summary:
+            messages.append({
+                "role": "system",
+                "content": SUMMARY_PREFIX + chat_session.context_summary
+            })
+        current = {"role": "user", "content": user_message}
+        budget = self.history_budget(messages + [current])
+
+        limit = settings.CONTEXT_MAX_HISTORY_MESSAGES
+        history = chat_session.messages.filter(message_type__in=['user', 'assistant'])
+        if chat_session.context_summary_upto:
+            history = history.filter(id__gt=chat_session.context_summary_upto)
+        # One row past the cap, plus the user turn stripped below, so the
+        # cap cutting off older turns is noticed and they get summarized
+        rows = list(
+            history.order_by('-created_at', '-id')
+            .values_list('id', 'message_type', 'content')[:limit + 2]
+        )
+
+        # Callers store the user turn before generating; don't send it twice
+        if rows and rows[0][1] == 'user' and rows[0][2] == user_message:
+            rows = rows[1:]
+
+        included = []
+        dropped = len(rows) > limit
+        for message_id, message_type, content in rows[:limit]:
+            cost = self.tokens(content)
+            if cost > budget:
+                dropped = True
+                break
+            budget -= cost
+            included.append((message_id, message_type, content))
+
+        for message_id, message_type, content in reversed(included):
+            messages.append({"role": message_type, "content": content})
+        messages.append(current)
+
+        if dropped:
+            # Everything older than the oldest turn we kept goes into the summary
+            boundary = included[-1][0] - 1 if included else rows[0][0]
+            schedule_summary(chat_session, boundary)
+
+        return messages
+
+
+def schedule_summary(chat_session: ChatSession, upto_id: int):
+    """Queue folding of turns up to ``upto_id`` into the session summary, once"""
+    if chat_session.context_summary_upto and upto_id <= chat_session.context_summary_upto:
+        return
+    pending_key = SUMMARY_PENDING_KEY.format(chat_session.pk)
+    try:
+        if not cache.add(pending_key, upto_id, 120):
+            return
+        from .tasks import update_context_summary
+        update_context_summary.delay(chat_session.pk, upto_id)
+    except Exception as e:
+        logger.error(f"Could not schedule context summary for session {chat_session.pk}: {str(e)}")
+        # Let the next turn try again rather than waiting out the marker
+        cache.delete(pending_key)
+
+
+def update_summary(chat_session_id: int, upto_id: int):
+    """Fold turns up to ``upto_id`` into the session's rolling summary"""
+    session = ChatSession.objects.only('id', 'context_summary', 'context_summary_upto').get(
+        id=chat_session_id
+    )
+    previous_upto = session.context_summary_upto or 0
+    if upto_id <= previous_upto:
+        return False
+
+    turns = list(
+        session.messages.filter(
+            id__gt=previous_upto, id__lte=upto_id,
+            message_type__in=['user', 'assistant']
+        ).order_by('created_at', 'id').values_list('message_type', 'content')
+    )
+    summary = _summarize(session.context_summary, turns)
+
+    # Only move forward; a concurrent run that got further wins
+    updated = ChatSession.objects.filter(
+        id=chat_session_id, context_summary_upto=session.context_summary_upto
+    ).update(context_summary=summary, context_summary_upto=upto_id)
+    cache.delete(SUMMARY_PENDING_KEY.format(chat_session_id))
+    return bool(updated)
+
+
+def _summarize(previous_summary: str, turns) -> str:
+    transcript = '\n'.join(
+        f"{'Employee' if message_type == 'user' else 'Assistant'}: {content}"
+        for message_type, content in turns
+    )
+    max_tokens = settings.CONTEXT_SUMMARY_MAX_TOKENS
+
+    if llm_client.is_configured():
+        prompt = (
+            "Update the running summary of a workplace support conversation. "
+            "Keep names, facts, decisions and open questions; drop small talk.\n\n"
+            f"Current summary:\n{previous_summary or '(none)'}\n\n"
+            f"New turns:\n{transcript}"
+        )
+        try:
+            response = providers.get_pool().complete(
+                None,
+                [{"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=max_tokens
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.warning(f"LLM summary failed, using extractive summary: {str(e)}")
+
+    # Extractive fallback: keep the most recent lines that fit the budget
+    lines = [line for line in (previous_summary + '\n' + transcript).splitlines() if line.strip()]
+    kept = []
+    remaining = max_tokens
+    for line in reversed(lines):
+        line = line[:300]
+        cost = count_tokens(line)
+        if cost > remaining:
+            break
+        kept.append(line)
+        remaining -= cost
+    return '\n'.join(reversed(kept))
@@ -0,0 +1,190 @@
+import logging
+import re
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .models import FallbackIntent
+
+logger = logging.getLogger('chatbot')
+
+VERSION_KEY = 'chatbot:intents:version'
+
+DEFAULT_RESPONSE = "I understand you're looking for assistance. Could you please provide more details about what you need help with? I can help with HR matters, IT support, employee services, and general workplace questions. I'm powered by Azure AI Foundry to provide you with the best possible assistance."
+
+# Seeded into an empty FallbackIntent table
+DEFAULT_INTENTS = [
+    {
+        'name': 'Azure AI Foundry',
+        'priority': 10,
+        'keywords': 'azure, ai foundry, gpt-4, openai',
+        'response': "I'm powered by Azure AI Foundry's GPT-4 model to provide you with intelligent assistance. How can I help you with your workplace needs today?",
+    },
+    {
+        'name': 'HR',
+        'priority': 20,
+        'keywords': 'hr, human resources, payroll, benefits, leave, vacation',
+        'response': "I can help you with HR-related questions! For specific HR matters like payroll, benefits, or leave requests, I recommend visiting the HR Management portal or contacting your HR representative directly. What specific HR topic would you like assistance with?",
+    },
+    {
+        'name': 'IT support',
+        'priority': 30,
+        'keywords': 'it, technical, computer, software, password, system',
+        'response': "For technical support and IT-related issues, I can guide you through common solutions or help you submit a support ticket. What technical issue are you experiencing?",
+    },
+    {
+        'name': 'Employee portal',
+        'priority': 40,
+        'keywords': 'employee, portal, profile, directory',
+        'response': "You can access your employee information, update your profile, and view the company directory through the Employee Portal. What specific information are you looking for?",
+    },
+    {
+        'name': 'Greeting',
+        'priority': 50,
+        'keywords': 'hello, hi, hey, good morning, good afternoon',
+        'response': "Hello {name}! I'm your AI assistant powered by Azure AI Foundry. I'm here to help with HR questions, IT support, employee services, and general workplace information. What can I assist you with today?",
+    },
+    {
+        'name': 'General help',
+        'priority': 60,
+        'keywords': 'help, support, assistance',
+        'response': "I'm here to help! I can assist you with:\n\n• HR-related questions and processes\n• IT support and technical issues\n• Employee portal navigation\n• General workplace information\n• Policy and procedure questions\n\nWhat would you like to know about?",
+    },
+]
+
+# (matcher, version, checked_at) for this worker process
+_cached = (None, None, 0.0)
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def split_keywords(keywords: str):
+    return [normalize(k) for k in re.split(r'[,\n]', keywords) if k.strip()]
+
+
+def trie_pattern(words) -> str:
+    """Regex alternation for ``words`` factored into a character trie.
+
+    At each position the engine branches on one character per level instead
+    of trying every keyword in turn, so matching cost depends on keyword
+    length rather than on how many keywords there are. Optional suffixes are
+    greedy, so the longest keyword wins.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        terminal = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if terminal else group
+
+    return build(trie)
+
+
+class IntentMatcher:
+    """All intents compiled into one whole-word regex"""
+
+    def __init__(self, intents):
+        intents = sorted(intents, key=lambda intent: (intent.priority, intent.name))
+        # keyword -> (rank, intent); a keyword shared by intents goes to the first
+        self.lookup = {}
+        for rank, intent in enumerate(intents):
+            for keyword in split_keywords(intent.keywords):
+                self.lookup.setdefault(keyword, (rank, intent))
+        self.pattern = None
+        if self.lookup:
+            self.pattern = re.compile(r'(?<!\w)' + trie_pattern(self.lookup) + r'(?!\w)')
+
+    def match(self, text: str):
+        """Highest-priority intent with a keyword in ``text``, or None"""
+        if self.pattern is None:
+            return None
+        best = None
+        for found in self.pattern.finditer(normalize(text)):
+            candidate = self.lookup[found.group()]
+            if best is None or candidate[0] < best[0]:
+                best = candidate
+        return best[1] if best else None
+
+
+def _current_version():
+    try:
+        return cache.get(VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"Could not read fallback intent version: {str(e)}")
+        return None
+
+
+def _publish_version():
+    version = uuid.uuid4().hex
+    try:
+        cache.set(VERSION_KEY, version, None)
+    except Exception as e:
+        logger.warning(f"Could not publish fallback intent version: {str(e)}")
+        return None
+    return version
+
+
+def _load_intents():
+    if not FallbackIntent.objects.exists():
+        FallbackIntent.objects.bulk_create(
+            [FallbackIntent(**intent) for intent in DEFAULT_INTENTS],
+            ignore_conflicts=True
+        )
+    return list(FallbackIntent.objects.filter(is_active=True))
+
+
+def get_matcher() -> IntentMatcher:
+    """Return the compiled matcher, rebuilding it at most once per version.
+
+    Like the AI configuration cache, the shared version key is consulted
+    every INTENT_CACHE_CHECK_INTERVAL seconds.
+    """
+    global _cached
+    matcher, version, checked_at = _cached
+    now = time.monotonic()
+
+    if matcher is not None and now - checked_at < settings.INTENT_CACHE_CHECK_INTERVAL:
+        return matcher
+
+    current_version = _current_version()
+    if matcher is not None and current_version is not None and current_version == version:
+        _cached = (matcher, version, now)
+        return matcher
+
+    matcher = IntentMatcher(_load_intents())
+    logger.info(f"Compiled {len(matcher.lookup)} fallback intent keywords")
+
+    if current_version is None:
+        current_version = _publish_version()
+    _cached = (matcher, current_version, now)
+    return matcher
+
+
+def invalidate():
+    """Drop the local matcher and bump the shared version for every worker"""
+    global _cached
+    _cached = (None, None, 0.0)
+    _publish_version()
+
+
+def respond(user_message: str, user) -> str:
+    """Fallback reply for ``user_message``"""
+    if not user_message.strip():
+        return DEFAULT_RESPONSE
+    intent = get_matcher().match(user_message)
+    if intent is None:
+        return DEFAULT_RESPONSE
+    name = user.first_name if user and user.first_name else "there"
+    return intent.response.replace('{name}', name)
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger('chatbot')
+
+MANIFEST_NAME = 'manifest.json'
+DOCUMENT_EXTENSIONS = ('.md', '.txt')
+WORD_RE = re.compile(r'\w+')
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _features(text: str):
+    """Hashed unigram and bigram counts; crc32 keeps buckets stable across processes"""
+    words = WORD_RE.findall(text.lower())
+    terms = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+    dimensions = settings.KNOWLEDGE_VECTOR_DIMENSIONS
+    return Counter(zlib.crc32(term.encode('utf-8')) % dimensions for term in terms)
+
+
+def vectorize(text: str) -> np.ndarray:
+    """Unit-length vector of sublinear term frequencies"""
+    vector = np.zeros(settings.KNOWLEDGE_VECTOR_DIMENSIONS, dtype=np.float32)
+    for bucket, count in _features(text).items():
+        vector[bucket] = 1.0 + math.log(count)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def chunk_text(text: str):
+    """Overlapping windows of KNOWLEDGE_CHUNK_WORDS words, split on paragraphs where possible"""
+    size = settings.KNOWLEDGE_CHUNK_WORDS
+    overlap = settings.KNOWLEDGE_CHUNK_OVERLAP
+    chunks, current = [], []
+    for paragraph in re.split(r'\n\s*\n', text):
+        words = paragraph.split()
+        if current and len(current) + len(words) > size:
+            chunks.append(' '.join(current))
+            current = current[-overlap:] if overlap else []
+        current += words
+        while len(current) > size:
+            chunks.append(' '.join(current[:size]))
+            current = current[size - overlap:]
+    if current and (not chunks or len(current) > overlap):
+        chunks.append(' '.join(current))
+    return chunks
+
+
+class KnowledgeIndex:
+    """Chunk vectors in a memory-mapped float32 matrix, plus their text.
+
+    The matrix rows are L2-normalized term vectors. Queries are weighted by
+    inverse document frequency, so a search is one matrix-vector product
+    over the mapped file; the OS page cache keeps it in memory.
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.chunks = manifest['chunks']
+        rows = len(self.chunks)
+        self.vectors = None
+        if rows:
+            self.vectors = np.memmap(
+                os.path.join(directory, manifest['vectors']), dtype=np.float32, mode='r',
+                shape=(rows, manifest['dimensions'])
+            )
+        self.idf = np.log((1.0 + rows) / (1.0 + np.asarray(manifest['df'], dtype=np.float32))) + 1.0
+
+    @classmethod
+    def load(cls, directory):
+        for _ in range(3):
+            manifest = _read_manifest(directory)
+            if manifest is None:
+                return None
+            if manifest['dimensions'] != settings.KNOWLEDGE_VECTOR_DIMENSIONS:
+                logger.warning("Knowledge index dimensions differ from settings; rebuild it")
+                return None
+            try:
+                return cls(directory, manifest)
+            except FileNotFoundError:
+                # Two reindexes landed since the manifest was read; read it again
+                logger.info("Knowledge index was replaced while loading, retrying")
+        return None
+
+    def search(self, query: str, top_k: int):
+        """Best ``top_k`` chunks as (score, chunk) pairs, highest score first"""
+        if self.vectors is None:
+            return []
+        query_vector = vectorize(query) * self.idf
+        norm = np.linalg.norm(query_vector)
+        if not norm:
+            return []
+        scores = self.vectors @ (query_vector / norm)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.chunks[i]) for i in best]
+
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _manifest_mtime(directory):
+    try:
+        return os.stat(os.path.join(directory, MANIFEST_NAME)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_index():
+    """Return this process's index, reloading it when a reindex replaced it.
+
+    The manifest is stat()ed at most every KNOWLEDGE_RELOAD_INTERVAL seconds.
+    """
+    global _index
+    now = time.monotonic()
+    cached = _index
+    if cached is not None and now - cached[2] < settings.KNOWLEDGE_RELOAD_INTERVAL:
+        return cached[0]
+
+    with _index_lock:
+        directory = settings.KNOWLEDGE_INDEX_DIR
+        mtime = _manifest_mtime(directory)
+        if cached is not None and cached[1] == mtime:
+            index = cached[0]
+        else:
+            index = KnowledgeIndex.load(directory) if mtime is not None else None
+            if index is not None:
+                logger.info(f"Loaded knowledge index with {len(index.chunks)} chunks")
+        _index = (index, mtime, now)
+    return index
+
+
+def search(query: str, top_k=None):
+    """Relevant passages for ``query`` scoring at least KNOWLEDGE_MIN_SCORE"""
+    index = get_index()
+    if index is None:
+        return []
+    results = index.search(query, top_k or settings.KNOWLEDGE_TOP_K)
+    return [(score, chunk) for score, chunk in results if score >= settings.KNOWLEDGE_MIN_SCORE]
+
+
+def _document_paths(source_dir):
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if name.lower().endswith(DOCUMENT_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, source_dir), path
+
+
+def build_index(source_dir, index_dir, rebuild=False):
+    """Bring the index in ``index_dir`` up to date with ``source_dir``.
+
+    Only new and changed documents are chunked and vectorized; rows of
+    unchanged documents are copied from the previous matrix. The new matrix
+    is written under a fresh name and the manifest is swapped in atomically,
+    so running workers keep reading a consistent index; the matrix it
+    replaced is removed by the following build. Returns counts of
+    added, updated, removed and unchanged documents.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    dimensions = settings.KNOWLEDGE_VECTOR_DIMENSIONS
+    previous = None if rebuild else KnowledgeIndex.load(index_dir)
+    old_documents = previous.manifest['documents'] if previous else {}
+
+    documents, chunks, blocks = {}, [], []
+    df = np.zeros(dimensions, dtype=np.int64)
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    seen = set()
+
+    for source, path in _document_paths(source_dir):
+        seen.add(source)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        old = old_documents.get(source)
+        start = len(chunks)
+
+        if old and old['sha256'] == digest:
+            vectors = np.asarray(previous.vectors[old['start']:old['end']])
+            chunks.extend(previous.chunks[old['start']:old['end']])
+            counts['unchanged'] += 1
+        else:
+            texts = chunk_text(raw.decode('utf-8', errors='replace'))
+            vectors = np.stack([vectorize(text) for text in texts]) if texts else np.zeros((0, dimensions), np.float32)
+            chunks.extend({'source': source, 'text': text} for text in texts)
+            counts['updated' if old else 'added'] += 1
+
+        df += (vectors > 0).sum(axis=0)
+        blocks.append(vectors)
+        documents[source] = {'sha256': digest, 'start': start, 'end': len(chunks)}
+
+    counts['removed'] = len(set(old_documents) - seen)
+
+    vectors_name = f'vectors-{uuid.uuid4().hex}.f32'
+    if chunks:
+        matrix = np.memmap(os.path.join(index_dir, vectors_name), dtype=np.float32, mode='w+',
+                           shape=(len(chunks), dimensions))
+        offset = 0
+        for block in blocks:
+            matrix[offset:offset + len(block)] = block
+            offset += len(block)
+        matrix.flush()
+        del matrix
+
+    manifest = {
+        'dimensions': dimensions,
+        'vectors': vectors_name,
+        'documents': documents,
+        'chunks': chunks,
+        'df': df.tolist(),
+    }
+    replaced = _read_manifest(index_dir)
+    tmp_path = os.path.join(index_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(index_dir, MANIFEST_NAME))
+
+    # Keep the generation just replaced: a worker that read its manifest may
+    # not have mapped the matrix yet. Older ones are only open, if at all.
+    keep = {vectors_name, replaced['vectors'] if replaced else None}
+    for name in os.listdir(index_dir):
+        if name.startswith('vectors-') and name not in keep:
+            os.remove(os.path.join(index_dir, name))
+
+    return counts
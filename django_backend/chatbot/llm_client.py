@@ -0,0 +1,88 @@
+import httpx
+import openai
+from django.conf import settings
+
+
+def endpoint_specs():
+    """Upstream endpoints, from LLM_ENDPOINTS or the single-provider settings.
+
+    Without LLM_ENDPOINTS the Azure deployment is the primary endpoint and a
+    configured OpenAI key becomes its fallback.
+    """
+    if settings.LLM_ENDPOINTS:
+        return settings.LLM_ENDPOINTS
+
+    specs = []
+    if uses_azure():
+        specs.append({
+            'name': 'azure',
+            'type': 'azure',
+            'api_key': settings.AZURE_OPENAI_API_KEY,
+            'endpoint': settings.AZURE_OPENAI_ENDPOINT,
+            'api_version': settings.AZURE_OPENAI_API_VERSION,
+            'deployment': settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+        })
+    if settings.OPENAI_API_KEY:
+        specs.append({
+            'name': 'openai',
+            'type': 'openai',
+            'api_key': settings.OPENAI_API_KEY,
+            'fallback': bool(specs),
+        })
+    return specs
+
+
+def is_configured() -> bool:
+    """Whether any upstream LLM endpoint is configured"""
+    return bool(endpoint_specs())
+
+
+def uses_azure() -> bool:
+    return bool(settings.AZURE_OPENAI_API_KEY and settings.AZURE_OPENAI_ENDPOINT)
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout():
+    return httpx.Timeout(
+        settings.LLM_HTTP_READ_TIMEOUT,
+        connect=settings.LLM_HTTP_CONNECT_TIMEOUT,
+    )
+
+
+def _build_client(spec, client_class, azure_class, http_client):
+    # Retries are done by the provider pool, which can move to another endpoint
+    if spec.get('type') == 'azure':
+        return azure_class(
+            api_key=spec['api_key'],
+            azure_endpoint=spec['endpoint'],
+            api_version=spec.get('api_version', settings.AZURE_OPENAI_API_VERSION),
+            timeout=_timeout(),
+            max_retries=0,
+            http_client=http_client,
+        )
+    return client_class(
+        api_key=spec['api_key'],
+        base_url=spec.get('base_url'),
+        timeout=_timeout(),
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+def create_client(spec):
+    """Blocking client with its own keep-alive pool, for WSGI and Celery workers"""
+    http_client = httpx.Client(limits=_limits(), timeout=_timeout())
+    return _build_client(spec, openai.OpenAI, openai.AzureOpenAI, http_client)
+
+
+def create_async_client(spec):
+    """Async client with its own keep-alive pool; bound to the current event loop"""
+    http_client = httpx.AsyncClient(limits=_limits(), timeout=_timeout())
+    return _build_client(spec, openai.AsyncOpenAI, openai.AsyncAzureOpenAI, http_client)
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chatbot.models import ChatSession
+from chatbot.rollups import rollup_range
+from datetime import datetime, time, timedelta
+
+
+class Command(BaseCommand):
+    help = 'Backfill hourly and daily chat metrics rollups in date-range chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day (YYYY-MM-DD); defaults to the first session')
+        parser.add_argument('--end', help='Last day, inclusive (YYYY-MM-DD); defaults to today')
+        parser.add_argument('--chunk-days', type=int, default=7,
+                            help='Days recomputed per pair of aggregate queries')
+
+    def handle(self, *args, **options):
+        start_day = self.parse_day(options['start'])
+        if start_day is None:
+            first = ChatSession.objects.order_by('created_at').values_list('created_at', flat=True).first()
+            if first is None:
+                self.stdout.write('Nothing to backfill')
+                return
+            start_day = timezone.localtime(first).date()
+        end_day = self.parse_day(options['end']) or timezone.localdate()
+        if end_day < start_day:
+            raise CommandError('--end is before --start')
+
+        chunk = timedelta(days=max(1, options['chunk_days']))
+        start = timezone.make_aware(datetime.combine(start_day, time.min))
+        end = timezone.make_aware(datetime.combine(end_day + timedelta(days=1), time.min))
+
+        while start < end:
+            chunk_end = min(start + chunk, end)
+            for period in ('hour', 'day'):
+                rollup_range(start, chunk_end, period)
+            self.stdout.write(f'Rolled up {start:%Y-%m-%d} to {chunk_end:%Y-%m-%d}')
+            start = chunk_end
+
+        self.stdout.write(self.style.SUCCESS('Backfill complete'))
+
+    def parse_day(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f'Invalid date: {value}')
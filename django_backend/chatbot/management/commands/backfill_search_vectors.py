@@ -0,0 +1,33 @@
+import time
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from chatbot.models import Message
+from chatbot.search import is_supported
+
+
+class Command(BaseCommand):
+    help = 'Fill Message.search_vector for rows written before full-text search existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        if not is_supported():
+            raise CommandError('Full-text search requires PostgreSQL')
+
+        batch_size = options['batch_size']
+        last_id = Message.objects.aggregate(last=Max('id'))['last'] or 0
+        updated = 0
+        # Walk id ranges so each UPDATE is short and uses the primary key
+        for start in range(0, last_id + 1, batch_size):
+            updated += Message.objects.filter(
+                id__gte=start, id__lt=start + batch_size, search_vector__isnull=True
+            ).update(search_vector=SearchVector('content', config=settings.CHAT_SEARCH_CONFIG))
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} messages'))
@@ -0,0 +1,89 @@
+import random
+import string
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chatbot.intents import DEFAULT_INTENTS, IntentMatcher, normalize, split_keywords
+from chatbot.models import FallbackIntent
+
+SAMPLE_MESSAGES = [
+    "Hi, I need help resetting my password for the payroll system",
+    "How many vacation days do I have left this year?",
+    "My computer keeps freezing when I submit expense reports with attachments",
+    "Where can I update my profile photo in the employee directory?",
+    "Can you tell me what the policy is for working from home on Fridays?",
+    "Good morning! Who do I talk to about benefits enrollment deadlines?",
+    "The VPN drops every few minutes and I cannot reach the internal wiki",
+    "Is there a template for the quarterly performance review self assessment?",
+]
+
+
+class Command(BaseCommand):
+    help = 'Measure fallback intent matching cost as the keyword catalogue grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000',
+                            help='Comma-separated keyword catalogue sizes')
+        parser.add_argument('--keywords-per-intent', type=int, default=20)
+        parser.add_argument('--iterations', type=int, default=2000,
+                            help='Messages matched per catalogue size')
+        parser.add_argument('--no-baseline', action='store_true',
+                            help='Skip the per-keyword substring scan used before compiled matching')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be comma-separated integers')
+        rng = random.Random(options['seed'])
+        iterations = options['iterations']
+
+        self.stdout.write(f"{'keywords':>9} {'build ms':>9} {'matcher us/msg':>15} {'substring us/msg':>17}")
+        for size in sizes:
+            intents = self.catalogue(size, options['keywords_per_intent'], rng)
+            messages = [SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)] for i in range(iterations)]
+
+            started = time.perf_counter()
+            matcher = IntentMatcher(intents)
+            build_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            for message in messages:
+                matcher.match(message)
+            matcher_us = (time.perf_counter() - started) / iterations * 1e6
+
+            baseline = '-'
+            if not options['no_baseline']:
+                keyword_lists = [split_keywords(intent.keywords) for intent in intents]
+                started = time.perf_counter()
+                for message in messages:
+                    text = normalize(message)
+                    next((kws for kws in keyword_lists if any(k in text for k in kws)), None)
+                baseline = f"{(time.perf_counter() - started) / iterations * 1e6:.1f}"
+
+            self.stdout.write(f"{len(matcher.lookup):>9} {build_ms:>9.1f} {matcher_us:>15.1f} {baseline:>17}")
+
+    def catalogue(self, size, per_intent, rng):
+        """The default intents plus synthetic ones, ``size`` keywords in total"""
+        intents = [FallbackIntent(**intent) for intent in DEFAULT_INTENTS]
+        remaining = size - sum(len(split_keywords(intent.keywords)) for intent in intents)
+        priority = 1000
+        while remaining > 0:
+            count = min(per_intent, remaining)
+            keywords = [self.word(rng) for _ in range(count)]
+            intents.append(FallbackIntent(
+                name=f'synthetic-{priority}',
+                keywords=', '.join(keywords),
+                response='Synthetic intent',
+                priority=priority,
+            ))
+            remaining -= count
+            priority += 1
+        return intents
+
+    def word(self, rng):
+        length = rng.randint(4, 12)
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+        if rng.random() < 0.2:
+            word += ' ' + ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
+        return word
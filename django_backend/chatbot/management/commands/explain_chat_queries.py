@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from chatbot.models import ChatSession, Message
+from chatbot.views import with_last_message_id, with_message_count
+from datetime import timedelta
+import uuid
+
+WATCHED_TABLES = ['chatbot_message', 'chatbot_chatsession']
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the hot chat queries and flag sequential scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-sessions', type=int, default=0,
+                            help='Seed this many sessions first (rolled back afterwards)')
+        parser.add_argument('--messages-per-session', type=int, default=50)
+        parser.add_argument('--fail-on-seq-scan', action='store_true',
+                            help='Exit with an error when a watched table is scanned sequentially')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed_sessions']:
+                self.seed(options['seed_sessions'], options['messages_per_session'])
+
+            chat_session = ChatSession.objects.order_by('-id').first()
+            if chat_session is None:
+                raise CommandError('No chat sessions to explain against; use --seed-sessions')
+
+            flagged = []
+            for name, queryset in self.queries(chat_session):
+                plan = queryset.explain()
+                seq_scans = [
+                    table for table in WATCHED_TABLES
+                    if f'Seq Scan on {table}' in plan or f'SCAN {table}' in plan
+                ]
+                self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {name}'))
+                self.stdout.write(plan)
+                if seq_scans:
+                    flagged.append(name)
+                    self.stdout.write(self.style.WARNING(f"Sequential scan on {', '.join(seq_scans)}"))
+
+            # Never keep seeded rows
+            transaction.set_rollback(True)
+
+        if not flagged:
+            self.stdout.write(self.style.SUCCESS('\nNo sequential scans on chat tables'))
+        elif options['fail_on_seq_scan']:
+            raise CommandError(f"Sequential scans in: {', '.join(flagged)}")
+
+    def queries(self, chat_session):
+        now = timezone.now()
+        sessions = ChatSession.objects.filter(user_id=chat_session.user_id)
+        yield 'Session list', with_last_message_id(with_message_count(sessions)).order_by('-updated_at')[:20]
+        yield 'Message history page', chat_session.messages.order_by('-created_at', '-id')[:51]
+        yield 'Daily message count by type', Message.objects.filter(
+            created_at__gte=now - timedelta(days=1), created_at__lt=now, message_type='user'
+        ).values('message_type').annotate(count=Count('id'))
+        yield 'Sessions created per day', ChatSession.objects.filter(
+            created_at__gte=now - timedelta(days=1), created_at__lt=now
+        ).values('id')
+        yield 'Cleanup candidates', ChatSession.objects.filter(
+            is_active=False, updated_at__lt=now - timedelta(days=30)
+        ).values('id')
+
+    def seed(self, session_count, messages_per_session):
+        from django.contrib.auth import get_user_model
+
+        user = get_user_model().objects.create(username=f'explain-{uuid.uuid4().hex[:12]}')
+        sessions = ChatSession.objects.bulk_create([
+            ChatSession(user=user, session_id=uuid.uuid4(), is_active=bool(i % 3))
+            for i in range(session_count)
+        ])
+        for chat_session in sessions:
+            Message.objects.bulk_create([
+                Message(
+                    chat_session=chat_session,
+                    message_type='user' if i % 2 == 0 else 'assistant',
+                    content=f'Seeded message {i}'
+                )
+                for i in range(messages_per_session)
+            ], batch_size=1000)
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE chatbot_chatsession')
+                cursor.execute('ANALYZE chatbot_message')
+        self.stdout.write(f'Seeded {session_count} sessions x {messages_per_session} messages')
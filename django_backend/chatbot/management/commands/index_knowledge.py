@@ -0,0 +1,38 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chatbot import knowledge
+import os
+
+
+class Command(BaseCommand):
+    help = 'Chunk and index local HR/IT documents for grounded answers (only changed files are reprocessed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=None, help='Document directory (default KNOWLEDGE_BASE_DIR)')
+        parser.add_argument('--rebuild', action='store_true', help='Reprocess every document')
+        parser.add_argument('--query', help='Run a search against the index afterwards')
+
+    def handle(self, *args, **options):
+        source = options['source'] or settings.KNOWLEDGE_BASE_DIR
+        if not os.path.isdir(source):
+            raise CommandError(f'Document directory not found: {source}')
+
+        started = time.perf_counter()
+        counts = knowledge.build_index(source, settings.KNOWLEDGE_INDEX_DIR, rebuild=options['rebuild'])
+        elapsed = time.perf_counter() - started
+
+        index = knowledge.KnowledgeIndex.load(settings.KNOWLEDGE_INDEX_DIR)
+        self.stdout.write(
+            f"Indexed {len(index.chunks)} chunks from {len(index.manifest['documents'])} documents in {elapsed:.2f}s "
+            f"({counts['added']} added, {counts['updated']} updated, "
+            f"{counts['removed']} removed, {counts['unchanged']} unchanged)"
+        )
+
+        if options['query']:
+            started = time.perf_counter()
+            results = index.search(options['query'], settings.KNOWLEDGE_TOP_K)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stdout.write(f"\nTop {len(results)} for {options['query']!r} in {elapsed_ms:.1f} ms:")
+            for score, chunk in results:
+                self.stdout.write(f"  {score:.3f}  {chunk['source']}: {chunk['text'][:100]}")
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import uuid
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chatbot import presence, providers, rate_limit, response_cache, single_flight, turns
+from chatbot.benchmarks import driver
+from chatbot.benchmarks.report import build_report, compare
+from chatbot.benchmarks.stub_llm import StubLLMServer
+
+
+class Command(BaseCommand):
+    help = 'Drive concurrent chat sessions over WebSocket and REST and report latency percentiles as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=20, help='Concurrent WebSocket sessions')
+        parser.add_argument('--rest-sessions', type=int, default=0,
+                            help='Concurrent sessions driven through send_message/ instead')
+        parser.add_argument('--turns', type=int, default=3, help='Messages sent per session')
+        parser.add_argument('--no-stream', action='store_true', help='Ask for unstreamed WebSocket replies')
+        parser.add_argument('--same-prompt', action='store_true',
+                            help='Send every session the same questions (exercises caching and coalescing)')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Seconds between a reply and the next message')
+        parser.add_argument('--ramp-up', type=float, default=0.0, help='Seconds over which sessions are started')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for one reply')
+        parser.add_argument('--base-url', help='Drive a running server (e.g. http://localhost:8000) '
+                                               'instead of the application in this process')
+        parser.add_argument('--stub', action='store_true',
+                            help='Route LLM calls to a stub server started in this process')
+        parser.add_argument('--stub-latency', type=float, default=0.2)
+        parser.add_argument('--stub-jitter', type=float, default=0.0)
+        parser.add_argument('--stub-token-rate', type=float, default=50.0)
+        parser.add_argument('--stub-tokens', type=int, default=60)
+        parser.add_argument('--stub-error-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the stub\'s latency jitter and failures')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='Compare against a report from an earlier run')
+        parser.add_argument('--fail-on-regression', type=float, metavar='PERCENT',
+                            help='Exit with an error when a compared metric is this much worse')
+        parser.add_argument('--keep-data', action='store_true', help='Keep the load-test users and chats')
+
+    def handle(self, *args, **options):
+        if options['sessions'] < 0 or options['rest_sessions'] < 0 or options['sessions'] + options['rest_sessions'] == 0:
+            raise CommandError('Nothing to run: give --sessions and/or --rest-sessions')
+        remote = bool(options['base_url'])
+        if remote and options['stub']:
+            raise CommandError('--stub only serves this process; run stub_llm_server next to the server instead')
+        if remote and options['sessions'] and driver.websockets is None:
+            raise CommandError('Driving a remote server over WebSocket needs the websockets package')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        stub = None
+        if options['stub']:
+            stub = StubLLMServer(
+                latency=options['stub_latency'], jitter=options['stub_jitter'],
+                token_rate=options['stub_token_rate'], tokens=options['stub_tokens'],
+                error_rate=options['stub_error_rate'], seed=options['seed'],
+            ).start()
+            settings.LLM_ENDPOINTS = [{'name': 'stub', 'api_key': 'stub', 'base_url': stub.url}]
+            providers.reset_pool()
+
+        if remote:
+            transport = driver.RemoteTransport(options['base_url'])
+        else:
+            from elariis_backend.asgi import application
+            transport = driver.InProcessTransport(application)
+
+        run_id = uuid.uuid4().hex[:8]
+        sessions = driver.create_sessions(options['sessions'] + options['rest_sessions'], run_id)
+        load_test = driver.LoadTest(
+            transport, run_id, turns=options['turns'], stream=not options['no_stream'],
+            think_time=options['think_time'], ramp_up=options['ramp_up'], timeout=options['timeout'],
+            same_prompt=options['same_prompt'],
+        )
+        counter = None if remote else driver.QueryCounter()
+        self.stdout.write(
+            f"Running {options['sessions']} WebSocket and {options['rest_sessions']} REST sessions "
+            f"x {options['turns']} turns ({transport.name}, run {run_id})"
+        )
+        try:
+            if counter:
+                counter.install()
+            recorded, duration = asyncio.run(load_test.run(
+                sessions[:options['sessions']], sessions[options['sessions']:]
+            ))
+        finally:
+            if counter:
+                counter.uninstall()
+            if not options['keep_data']:
+                driver.delete_sessions(sessions)
+            if stub:
+                stub.stop()
+
+        report = build_report(
+            recorded, duration,
+            options={key: options[key] for key in (
+                'sessions', 'rest_sessions', 'turns', 'no_stream', 'same_prompt', 'think_time', 'ramp_up',
+                'base_url', 'stub', 'stub_latency', 'stub_jitter', 'stub_token_rate', 'stub_tokens',
+                'stub_error_rate', 'seed',
+            )},
+            db_queries=counter.count if counter else None,
+            server=self.server_stats(stub) if not remote else {},
+        )
+        self.print_summary(report)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+        if baseline is not None:
+            self.print_comparison(report, baseline, options['fail_on_regression'])
+
+    def server_stats(self, stub):
+        stats = {
+            'response_cache': response_cache.stats(),
+            'single_flight': single_flight.stats(),
+            'rate_limit': rate_limit.stats(),
+            'turns': turns.stats(),
+            'typing': presence.stats(),
+            'providers': providers.get_pool().status(),
+        }
+        if stub:
+            stats['stub'] = stub.stats()
+        return stats
+
+    def print_summary(self, report):
+        self.stdout.write(
+            f"{report['completed']}/{report['turns']} turns in {report['duration_s']}s, "
+            f"{report['throughput_turns_per_s']} turns/s, "
+            f"{report['db_queries_per_turn']} DB queries/turn"
+        )
+        self.stdout.write(f"{'':<22} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for transport, stats in report['transports'].items():
+            for metric in ('latency_ms', 'ttft_ms'):
+                row = stats[metric]
+                if not row['count']:
+                    continue
+                values = ''.join(f"{row[key]:>9}" for key in ('p50', 'p95', 'p99', 'max'))
+                self.stdout.write(f"{transport + ' ' + metric:<22} {row['count']:>6}{values}")
+        for error, count in report['errors'].items():
+            self.stdout.write(self.style.WARNING(f"{count} turns failed: {error}"))
+
+    def print_comparison(self, report, baseline, threshold):
+        self.stdout.write(f"\nAgainst baseline {baseline.get('commit') or '(unknown commit)'}:")
+        regressions = []
+        for name, old, new, change, regressed in compare(report, baseline):
+            change_text = f'{change:+.1f}%' if change is not None else 'n/a'
+            line = f"{name:<24} {old:>10} -> {new:<10} {change_text}"
+            if regressed and threshold is not None and abs(change) >= threshold:
+                regressions.append(name)
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"Regressed beyond {threshold}%: {', '.join(regressions)}")
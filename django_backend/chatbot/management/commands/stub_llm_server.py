@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from chatbot.benchmarks.stub_llm import StubLLMServer
+
+
+class Command(BaseCommand):
+    help = 'Serve an OpenAI-compatible stub LLM with scripted latency and failures, for load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Extra random seconds of latency, at most')
+        parser.add_argument('--token-rate', type=float, default=50.0, help='Tokens per second (0 for instant)')
+        parser.add_argument('--tokens', type=int, default=60, help='Tokens per completion')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail')
+        parser.add_argument('--error-status', type=int, default=503)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        server = StubLLMServer(
+            host=options['host'], port=options['port'], latency=options['latency'],
+            jitter=options['jitter'], token_rate=options['token_rate'], tokens=options['tokens'],
+            error_rate=options['error_rate'], error_status=options['error_status'], seed=options['seed'],
+        )
+        self.stdout.write(
+            f"Stub LLM listening on {server.url}; point the server at it with\n"
+            f"LLM_ENDPOINTS='[{{\"name\": \"stub\", \"api_key\": \"stub\", \"base_url\": \"{server.url}\"}}]'"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Served {server.stats()}")
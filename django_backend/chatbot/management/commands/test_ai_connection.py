@@ -26,6 +26,10 @@ class Command(BaseCommand):
         else:
             self.stdout.write(self.style.ERROR('✗ AI service connection failed'))
             self.stdout.write(f"Error: {result['error']}")
+
+        for endpoint in result.get('endpoints', []):
+            role = 'fallback' if endpoint['fallback'] else 'primary'
+            self.stdout.write(f"  {endpoint['name']} ({role}, {endpoint['model']}): {endpoint['status']}")
             
         self.stdout.write('\nConfiguration check:')
         self.stdout.write(f"Azure OpenAI configured: {'Yes' if ai_service.azure_openai_api_key else 'No'}")
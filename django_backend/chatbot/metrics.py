@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger('chatbot')
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15)
+DB_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+QUEUE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+
+# Reply sources counted by AIService; anything else is folded into 'llm'
+REPLY_SOURCES = ('llm', 'cache', 'coalesced', 'fallback', 'error', 'rate_limited')
+RATE_LIMIT_ERRORS = ('QueueTimeout', 'RateLimitError')
+
+
+class _Noop:
+    """Stands in for every metric when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(kind, name, documentation, labels=(), **kwargs):
+    if prometheus_client is None:
+        return _Noop()
+    return getattr(prometheus_client, kind)(name, documentation, labels, **kwargs)
+
+
+LLM_REQUEST_SECONDS = _metric(
+    'Histogram', 'chatbot_llm_request_duration_seconds',
+    'Upstream LLM call duration per attempt, to the end of the stream when streamed',
+    ['endpoint', 'outcome'], buckets=LATENCY_BUCKETS,
+)
+LLM_TTFT_SECONDS = _metric(
+    'Histogram', 'chatbot_llm_time_to_first_token_seconds',
+    'Time from sending a streamed LLM request to its first chunk',
+    ['endpoint'], buckets=TTFT_BUCKETS,
+)
+LLM_QUEUE_WAIT_SECONDS = _metric(
+    'Histogram', 'chatbot_llm_queue_wait_seconds',
+    'Time LLM requests waited for the concurrency and rate limiters',
+    buckets=QUEUE_BUCKETS,
+)
+WEBSOCKET_TURN_SECONDS = _metric(
+    'Histogram', 'chatbot_websocket_turn_duration_seconds',
+    'WebSocket chat turns from start of generation to the stored reply',
+    ['outcome'], buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_SECONDS = _metric(
+    'Histogram', 'chatbot_request_db_seconds',
+    'Database time spent per HTTP request',
+    ['view'], buckets=DB_BUCKETS,
+)
+CELERY_TASK_SECONDS = _metric(
+    'Histogram', 'chatbot_celery_task_duration_seconds',
+    'Duration of chatbot Celery tasks',
+    ['task', 'outcome'], buckets=TASK_BUCKETS,
+)
+REPLIES = _metric(
+    'Counter', 'chatbot_replies_total',
+    'Assistant replies by where they came from',
+    ['source'],
+)
+EVENTS = _metric(
+    'Counter', 'chatbot_events_total',
+    'Response cache, single-flight, limiter, turn queue and typing events',
+    ['component', 'event'],
+)
+WEBSOCKET_CONNECTIONS = _metric(
+    'Gauge', 'chatbot_websocket_connections',
+    'Open chat WebSocket connections',
+    multiprocess_mode='livesum',
+)
+GENERATIONS_IN_FLIGHT = _metric(
+    'Gauge', 'chatbot_generations_in_flight',
+    'Upstream LLM requests in progress',
+    ['endpoint'], multiprocess_mode='livesum',
+)
+CIRCUIT_OPEN = _metric(
+    'Gauge', 'chatbot_llm_circuit_open',
+    'Whether an endpoint\'s circuit breaker is open (1) or half open (0.5)',
+    ['endpoint'], multiprocess_mode='livemax',
+)
+
+_task_started = {}
+_task_lock = threading.Lock()
+
+
+def count_event(component: str, event: str, amount=1):
+    if amount:
+        EVENTS.labels(component, event).inc(amount)
+
+
+def record_reply(metadata):
+    """Count a finished reply by the source its metadata records"""
+    error = metadata.get('error')
+    if error in RATE_LIMIT_ERRORS:
+        source = 'rate_limited'
+    elif error:
+        source = 'error'
+    elif metadata.get('cache_hit'):
+        source = 'cache'
+    elif metadata.get('coalesced'):
+        source = 'coalesced'
+    elif metadata.get('fallback'):
+        source = 'fallback'
+    else:
+        source = 'llm'
+    REPLIES.labels(source).inc()
+
+
+def observe_llm_call(endpoint: str, started: float, outcome: str):
+    LLM_REQUEST_SECONDS.labels(endpoint, outcome).observe(time.perf_counter() - started)
+
+
+def task_started(task_id):
+    with _task_lock:
+        _task_started[task_id] = time.perf_counter()
+
+
+def task_finished(task_id, task_name, outcome):
+    with _task_lock:
+        started = _task_started.pop(task_id, None)
+    if started is not None and task_name.startswith('chatbot.'):
+        CELERY_TASK_SECONDS.labels(task_name, outcome).observe(time.perf_counter() - started)
+
+
+class DatabaseTimeMiddleware:
+    """Observes the time each request spends in database queries.
+
+    Requests are labelled by URL pattern name, which keeps the label set as
+    small as the URLconf.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        elapsed = [0.0]
+
+        def timed(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                elapsed[0] += time.perf_counter() - started
+
+        with connection.execute_wrapper(timed):
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match and match.view_name else 'unmatched'
+        REQUEST_DB_SECONDS.labels(view).observe(elapsed[0])
+        return response
+
+
+def registry():
+    """Registry to expose: every worker's samples in multiprocess mode, else this process"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        collector_registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return prometheus_client.REGISTRY
+
+
+def metrics_view(request):
+    """Prometheus text exposition, optionally behind a bearer token"""
+    if prometheus_client is None or not settings.METRICS_ENABLED:
+        return HttpResponseNotFound()
+    token = settings.METRICS_AUTH_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(
+        prometheus_client.generate_latest(registry()),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST,
+    )
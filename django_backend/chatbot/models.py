@@ -1,3 +1,5 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.conf import settings
 
@@ -6,15 +8,37 @@ class ChatSession(models.Model):
     session_id = models.UUIDField(unique=True)
     title = models.CharField(max_length=200, blank=True)
     is_active = models.BooleanField(default=True)
+    # Rolling summary of the turns that no longer fit the model context
+    context_summary = models.TextField(blank=True)
+    context_summary_upto = models.BigIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Session list: filter by user, newest activity first
+            models.Index(fields=['user', '-updated_at'], name='chatsession_user_updated_idx'),
+            # Daily reports count sessions by creation time
+            models.Index(fields=['created_at'], name='chatsession_created_idx'),
+            # Cleanup only ever looks at inactive sessions
+            models.Index(
+                fields=['updated_at'],
+                name='chatsession_inactive_upd_idx',
+                condition=models.Q(is_active=False),
+            ),
+        ]
 
     def __str__(self):
         return f"Chat Session: {self.user.username} - {self.session_id}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Stored state, so saves can tell ending a session from editing an ended one
+        instance._stored_is_active = dict(zip(field_names, values)).get('is_active')
+        return instance
+
 class Message(models.Model):
     MESSAGE_TYPES = [
         ('user', 'User'),
@@ -26,24 +50,89 @@ class Message(models.Model):
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES)
     content = models.TextField()
     metadata = models.JSONField(default=dict, blank=True)
+    # Written in the same statement as content; see chatbot.search
+    search_vector = SearchVectorField(null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # History, context building and keyset pages: one session in time order
+            models.Index(fields=['chat_session', 'created_at', 'id'], name='message_session_created_idx'),
+            # Reports and rollups: time ranges split by message type
+            models.Index(fields=['created_at', 'message_type'], name='message_created_type_idx'),
+            # Full-text search over history
+            GinIndex(fields=['search_vector'], name='message_search_gin'),
+        ]
     
     def __str__(self):
         return f"{self.message_type}: {self.content[:50]}..."
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'content' in update_fields:
+            from .search import vector_for
+            self.search_vector = vector_for(self.content)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'search_vector'}
+        super().save(*args, **kwargs)
+
 class AIConfiguration(models.Model):
     name = models.CharField(max_length=100, unique=True)
     model_name = models.CharField(max_length=100)
     temperature = models.FloatField(default=0.7)
     max_tokens = models.IntegerField(default=1000)
     system_prompt = models.TextField(default="You are a helpful AI assistant for the Elariis Portal.")
+    response_cache_enabled = models.BooleanField(
+        default=False,
+        help_text="Reuse replies to identical opening questions instead of calling the model"
+    )
+    response_cache_ttl = models.PositiveIntegerField(
+        default=3600,
+        help_text="Seconds a cached reply stays valid"
+    )
+    knowledge_base_enabled = models.BooleanField(
+        default=True,
+        help_text="Ground replies in passages from the local document index"
+    )
+    max_concurrent_requests = models.PositiveIntegerField(
+        default=0,
+        help_text="Upstream calls in flight across all workers (0 = unlimited)"
+    )
+    requests_per_minute = models.PositiveIntegerField(
+        default=0,
+        help_text="Upstream calls per minute across all users (0 = unlimited)"
+    )
+    user_requests_per_minute = models.PositiveIntegerField(
+        default=0,
+        help_text="Upstream calls per minute for a single user (0 = unlimited)"
+    )
+    queue_timeout = models.FloatField(
+        default=10.0,
+        help_text="Seconds a request may wait for capacity before a busy reply is returned"
+    )
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+class FallbackIntent(models.Model):
+    """Keyword intent answered by the fallback engine when no LLM is configured"""
+    name = models.CharField(max_length=100, unique=True)
+    keywords = models.TextField(
+        help_text="Comma- or newline-separated; matched as whole words, ignoring case"
+    )
+    response = models.TextField(help_text="Reply text; {name} is replaced with the user's first name")
+    priority = models.IntegerField(default=100, help_text="Lower wins when several intents match")
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        ordering = ['priority', 'name']
+
     def __str__(self):
         return self.name
 
@@ -52,11 +141,47 @@ class ChatAnalytics(models.Model):
     total_messages = models.IntegerField(default=0)
     user_messages = models.IntegerField(default=0)
     assistant_messages = models.IntegerField(default=0)
+    # Seconds, from the generation_ms recorded on each reply
     average_response_time = models.FloatField(default=0.0)
+    response_count = models.IntegerField(default=0)
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    # Newest message folded in; incremental updates start after it
+    last_message_id = models.BigIntegerField(null=True, blank=True)
     satisfaction_rating = models.IntegerField(null=True, blank=True)
     feedback = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return f"Analytics for {self.chat_session.session_id}"
\ No newline at end of file
+        return f"Analytics for {self.chat_session.session_id}"
+
+class ChatMetricsRollup(models.Model):
+    """Precomputed chat volume, response time and token use per hour or day, maintained by chatbot.rollups"""
+    PERIODS = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    period = models.CharField(max_length=4, choices=PERIODS)
+    bucket_start = models.DateTimeField()
+    sessions_created = models.IntegerField(default=0)
+    total_messages = models.IntegerField(default=0)
+    user_messages = models.IntegerField(default=0)
+    assistant_messages = models.IntegerField(default=0)
+    response_count = models.IntegerField(default=0)
+    average_response_time = models.FloatField(default=0.0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    cache_hits = models.IntegerField(default=0)
+    fallback_replies = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-bucket_start']
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket_start'], name='rollup_period_bucket_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} rollup for {self.bucket_start:%Y-%m-%d %H:%M}"
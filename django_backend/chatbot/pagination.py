@@ -0,0 +1,124 @@
+import base64
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+def encode_cursor(message) -> str:
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor: str, param: str = 'cursor'):
+    """(created_at, id) from a cursor; a malformed one is a 400 naming ``param``"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        created_at, message_id = raw.rsplit('|', 1)
+        created_at, message_id = parse_datetime(created_at), int(message_id)
+        # Out-of-range ids would fail in the database rather than here
+        if created_at is None or not 0 < message_id < 2 ** 63:
+            raise ValueError(cursor)
+        return created_at, message_id
+    except (ValueError, UnicodeError):
+        raise ValidationError({param: 'Invalid cursor.'})
+
+
+def messages_before(queryset, created_at, message_id):
+    """Messages strictly older than the (created_at, id) position"""
+    return queryset.filter(created_at__lte=created_at).filter(
+        Q(created_at__lt=created_at) | Q(id__lt=message_id)
+    )
+
+
+def messages_after(queryset, created_at, message_id):
+    """Messages strictly newer than the (created_at, id) position"""
+    return queryset.filter(created_at__gte=created_at).filter(
+        Q(created_at__gt=created_at) | Q(id__gt=message_id)
+    )
+
+
+def latest_page(queryset, limit):
+    """The newest ``limit`` messages in chronological order, and whether older ones exist"""
+    rows = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+    has_older = len(rows) > limit
+    return list(reversed(rows[:limit])), has_older
+
+
+class MessageKeysetPagination(BasePagination):
+    """Keyset pagination over (created_at, id) for a session's messages.
+
+    Without a cursor the newest page is returned. ``?before=<cursor>`` walks
+    back through older history and ``?after=<cursor>`` fetches newer
+    messages. Pages are always in chronological order, and the cost of a page
+    does not depend on how deep into the history it is.
+    """
+    limit_query_param = 'limit'
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, settings.MESSAGE_PAGE_SIZE))
+        except ValueError:
+            limit = settings.MESSAGE_PAGE_SIZE
+        return max(1, min(limit, settings.MESSAGE_PAGE_SIZE_MAX))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = self.get_limit(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        self.cursor = after
+
+        if after:
+            rows = list(
+                messages_after(queryset, *decode_cursor(after, 'after'))
+                .order_by('created_at', 'id')[:limit + 1]
+            )
+            self.has_newer = len(rows) > limit
+            self.has_older = True
+            self.page = rows[:limit]
+        else:
+            if before:
+                queryset = messages_before(queryset, *decode_cursor(before, 'before'))
+            self.page, self.has_older = latest_page(queryset, limit)
+            self.has_newer = bool(before)
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'before': encode_cursor(self.page[0]) if self.page and self.has_older else None,
+            'after': encode_cursor(self.page[-1]) if self.page else self.cursor,
+            'has_newer': self.has_newer,
+        })
+
+
+class SearchResultPagination(BasePagination):
+    """Page-number pagination that never counts the full result set.
+
+    Ranked search results cannot be keyset-paginated, and a COUNT over every
+    match of a common term would cost more than the page itself, so one
+    extra row is fetched to tell whether a next page exists.
+    """
+    page_query_param = 'page'
+    limit_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, settings.SEARCH_PAGE_SIZE))
+            self.page_number = max(1, int(request.query_params.get(self.page_query_param, 1)))
+        except ValueError:
+            raise NotFound('Invalid page')
+        limit = max(1, min(limit, settings.SEARCH_PAGE_SIZE_MAX))
+        offset = (self.page_number - 1) * limit
+        rows = list(queryset[offset:offset + limit + 1])
+        self.has_next = len(rows) > limit
+        return rows[:limit]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'page': self.page_number,
+            'next_page': self.page_number + 1 if self.has_next else None,
+        })
\ No newline at end of file
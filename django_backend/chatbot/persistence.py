@@ -0,0 +1,43 @@
+import logging
+from contextlib import nullcontext
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ChatSession, Message
+
+logger = logging.getLogger('chatbot')
+
+
+def _schedule_analytics(chat_session_id):
+    from .tasks import update_chat_analytics
+    try:
+        update_chat_analytics.delay(chat_session_id, incremental=True)
+    except Exception as e:
+        logger.error(f"Could not queue analytics update for session {chat_session_id}: {str(e)}")
+
+
+def save_message(chat_session: ChatSession, message_type: str, content: str,
+                 metadata=None, touch_session=True) -> Message:
+    """Insert a message and bump the session's updated_at.
+
+    With ``touch_session`` the session gets an UPDATE of updated_at alone
+    instead of a full-row save, in the same transaction. Without it the
+    INSERT runs on its own, needing no transaction.
+    """
+    message = Message(
+        chat_session=chat_session, message_type=message_type,
+        content=content, metadata=metadata or {}
+    )
+    with transaction.atomic() if touch_session else nullcontext():
+        message.save(force_insert=True)
+
+        if touch_session:
+            now = timezone.now()
+            ChatSession.objects.filter(pk=chat_session.pk).update(updated_at=now)
+            chat_session.updated_at = now
+
+        if settings.CHAT_ANALYTICS_ON_REPLY and message_type == 'assistant':
+            transaction.on_commit(partial(_schedule_analytics, chat_session.pk))
+
+    return message
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import threading
+import time
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger('chatbot')
+
+_stats_lock = threading.Lock()
+_stats = {'typing_events': 0, 'typing_published': 0, 'piggybacked': 0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+    metrics.count_event('typing', key, amount)
+
+
+def record_piggybacked(count=1):
+    """Typing changes delivered inside message frames instead of their own publish"""
+    _count('piggybacked', count)
+
+
+class TypingThrottle:
+    """Debounces one connection's typing events to at most one publish per window.
+
+    A change of state goes out at once when the last publish is at least
+    CHAT_TYPING_WINDOW seconds old; otherwise only the latest state is kept
+    and sent when the window closes, so a burst of keystroke events costs a
+    single channel-layer publish. Repeating the published state inside the
+    window is dropped.
+    """
+
+    def __init__(self, publish, window=None):
+        self.publish = publish
+        self.window = settings.CHAT_TYPING_WINDOW if window is None else window
+        self.state = None
+        self.published_at = float('-inf')
+        self.pending = None
+        self.flush_task = None
+
+    async def update(self, is_typing: bool):
+        _count('typing_events')
+        if self.flush_task is not None:
+            self.pending = is_typing
+            return
+
+        wait = self.published_at + self.window - time.monotonic()
+        if wait <= 0:
+            await self._publish(is_typing)
+        elif is_typing != self.state:
+            self.pending = is_typing
+            self.flush_task = asyncio.create_task(self._flush_later(wait))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        pending, self.pending = self.pending, None
+        if pending is None or pending == self.state:
+            return
+        try:
+            await self._publish(pending)
+        except Exception as e:
+            logger.warning(f"Could not publish typing indicator: {str(e)}")
+
+    async def _publish(self, is_typing):
+        self.state = is_typing
+        self.published_at = time.monotonic()
+        _count('typing_published')
+        await self.publish(is_typing)
+
+    def cancel(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+
+def stats() -> dict:
+    """Typing fan-out counters for this worker process"""
+    with _stats_lock:
+        result = dict(_stats)
+    result['publishes_saved'] = (
+        result['typing_events'] - result['typing_published'] + result['piggybacked']
+    )
+    return result
@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+import openai
+from django.conf import settings
+from . import llm_client, metrics
+
+logger = logging.getLogger('chatbot')
+
+# Errors worth trying again, possibly on another endpoint
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class NoEndpointAvailable(Exception):
+    """Every upstream endpoint is unconfigured or has its circuit open"""
+
+
+class CircuitBreaker:
+    """Per-endpoint breaker: closed, open for a cooldown, then one trial call.
+
+    ``LLM_BREAKER_FAILURES`` consecutive retryable failures open the circuit.
+    After ``LLM_BREAKER_COOLDOWN`` seconds a single trial call is let through;
+    its outcome closes the circuit or opens it again.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _cooled_down(self):
+        return time.monotonic() - self.opened_at >= settings.LLM_BREAKER_COOLDOWN
+
+    def available(self) -> bool:
+        """Whether a call could be admitted now, without claiming it"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return self._cooled_down()
+            return not self.trial_in_flight
+
+    def allow(self) -> bool:
+        """Admit a call, claiming the trial slot when half-open"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self._cooled_down():
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+                metrics.CIRCUIT_OPEN.labels(self.name).set(0.5)
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    @contextmanager
+    def attempt(self):
+        """Scope of one admitted call.
+
+        A call cancelled or closed before recording its outcome (e.g. a
+        superseded chat turn) gives back the half-open trial it may hold
+        without counting as a failure; otherwise the circuit would wait on
+        that trial forever.
+        """
+        try:
+            yield
+        except BaseException:
+            self.abandon_trial()
+            raise
+
+    def abandon_trial(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit for LLM endpoint {self.name} closed")
+                metrics.CIRCUIT_OPEN.labels(self.name).set(0)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= settings.LLM_BREAKER_FAILURES:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit for LLM endpoint {self.name} opened after {self.failures} failures")
+                    metrics.CIRCUIT_OPEN.labels(self.name).set(1)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+
+class Endpoint:
+    """One upstream deployment with its own clients, breaker and load counter"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.name = spec.get('name') or spec.get('deployment') or spec.get('type', 'openai')
+        self.is_azure = spec.get('type') == 'azure'
+        self.weight = float(spec.get('weight', 1)) or 1.0
+        self.fallback = bool(spec.get('fallback', False))
+        self.breaker = CircuitBreaker(self.name)
+        self.outstanding = 0
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = {}
+
+    def model_for(self, config) -> str:
+        """Azure routes by deployment name, OpenAI by model name"""
+        if self.is_azure:
+            return self.spec['deployment']
+        return self.spec.get('model') or (config.model_name if config else 'gpt-3.5-turbo')
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = llm_client.create_client(self.spec)
+                    logger.info(f"Created pooled LLM client for {self.name}")
+        return self._client
+
+    def async_client(self):
+        """Async client for the running event loop.
+
+        Connections in an httpx pool belong to the loop that opened them, so
+        one client is kept per loop. Daphne runs a single loop per process.
+        """
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            for stale_loop in [l for l in self._async_clients if l.is_closed()]:
+                del self._async_clients[stale_loop]
+            client = llm_client.create_async_client(self.spec)
+            self._async_clients[loop] = client
+            logger.info(f"Created pooled async LLM client for {self.name}")
+        return client
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.outstanding += 1
+        in_flight = metrics.GENERATIONS_IN_FLIGHT.labels(self.name)
+        in_flight.inc()
+        try:
+            yield
+        finally:
+            in_flight.dec()
+            with self._lock:
+                self.outstanding -= 1
+
+
+class ProviderPool:
+    """Routes completions over several endpoints with retry and circuit breaking.
+
+    Primary endpoints are chosen by least outstanding requests per unit of
+    weight (or weighted random with ``LLM_ROUTING = 'weighted'``); fallback
+    endpoints are only used when no primary is available. Retryable errors
+    move the call to another endpoint where possible, with jittered
+    exponential backoff before retrying one that already failed.
+    """
+
+    def __init__(self, specs):
+        self.endpoints = [Endpoint(spec) for spec in specs]
+
+    def _choose(self, candidates):
+        if settings.LLM_ROUTING == 'weighted':
+            return random.choices(candidates, weights=[e.weight for e in candidates])[0]
+        return min(candidates, key=lambda e: (e.outstanding / e.weight, random.random()))
+
+    def _pick(self, tried):
+        while True:
+            available = [e for e in self.endpoints if e.breaker.available()]
+            untried = [e for e in available if e not in tried]
+            candidates = (
+                [e for e in untried if not e.fallback]
+                or [e for e in untried if e.fallback]
+                or [e for e in available if not e.fallback]
+                or available
+            )
+            if not candidates:
+                raise NoEndpointAvailable("All LLM endpoints are unavailable")
+            endpoint = self._choose(candidates)
+            if endpoint.breaker.allow():
+                return endpoint
+
+    def _backoff(self, attempt, error) -> float:
+        delay = random.uniform(0, min(settings.LLM_RETRY_BACKOFF_MAX, settings.LLM_RETRY_BACKOFF_BASE * 2 ** attempt))
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        try:
+            delay = max(delay, min(float(retry_after), settings.LLM_RETRY_BACKOFF_MAX))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    def _next_attempt(self, attempt, tried, error):
+        """Endpoint for this attempt and the seconds to wait before calling it"""
+        endpoint = self._pick(tried)
+        delay = self._backoff(attempt, error) if endpoint in tried else 0.0
+        tried.append(endpoint)
+        return endpoint, delay
+
+    def _failed(self, endpoint, error, attempt):
+        """Record a failure; re-raise unless the call should be retried"""
+        if not isinstance(error, RETRYABLE_ERRORS):
+            # A client error says nothing about the endpoint's health
+            endpoint.breaker.record_success()
+            raise error
+        endpoint.breaker.record_failure()
+        if attempt >= settings.LLM_MAX_RETRIES:
+            raise error
+        logger.warning(f"LLM endpoint {endpoint.name} failed ({type(error).__name__}), retrying")
+
+    def _served(self, metadata, endpoint, config, started, attempt):
+        """Record which endpoint answered and the upstream time, retries included"""
+        if metadata is None:
+            return
+        metadata['endpoint'] = endpoint.name
+        metadata['model'] = endpoint.model_for(config)
+        metadata['upstream_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        if attempt:
+            metadata['retries'] = attempt
+
+    def complete(self, config, messages, metadata=None, **kwargs):
+        tried, error = [], None
+        called = time.perf_counter()
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            endpoint, delay = self._next_attempt(attempt, tried, error)
+            with endpoint.breaker.attempt():
+                if delay:
+                    time.sleep(delay)
+                started = time.perf_counter()
+                with endpoint.track():
+                    try:
+                        response = endpoint.client().chat.completions.create(
+                            model=endpoint.model_for(config), messages=messages, **kwargs
+                        )
+                    except Exception as e:
+                        metrics.observe_llm_call(endpoint.name, started, 'error')
+                        error = e
+                        self._failed(endpoint, e, attempt)
+                        continue
+                metrics.observe_llm_call(endpoint.name, started, 'success')
+                endpoint.breaker.record_success()
+                self._served(metadata, endpoint, config, called, attempt)
+                return response
+
+    async def acomplete(self, config, messages, metadata=None, **kwargs):
+        tried, error = [], None
+        called = time.perf_counter()
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            endpoint, delay = self._next_attempt(attempt, tried, error)
+            with endpoint.breaker.attempt():
+                if delay:
+                    await asyncio.sleep(delay)
+                started = time.perf_counter()
+                with endpoint.track():
+                    try:
+                        response = await endpoint.async_client().chat.completions.create(
+                            model=endpoint.model_for(config), messages=messages, **kwargs
+                        )
+                    except Exception as e:
+                        metrics.observe_llm_call(endpoint.name, started, 'error')
+                        error = e
+                        self._failed(endpoint, e, attempt)
+                        continue
+                metrics.observe_llm_call(endpoint.name, started, 'success')
+                endpoint.breaker.record_success()
+                self._served(metadata, endpoint, config, called, attempt)
+                return response
+
+    async def astream(self, config, messages, metadata=None, **kwargs):
+        """Yield streamed chunks; retries happen only before the stream opens.
+
+        ``metadata`` gets the serving endpoint once the stream has ended.
+        """
+        tried, error = [], None
+        called = time.perf_counter()
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            endpoint, delay = self._next_attempt(attempt, tried, error)
+            with endpoint.breaker.attempt():
+                if delay:
+                    await asyncio.sleep(delay)
+                started = time.perf_counter()
+                with endpoint.track():
+                    try:
+                        chunks = await endpoint.async_client().chat.completions.create(
+                            model=endpoint.model_for(config), messages=messages, stream=True, **kwargs
+                        )
+                    except Exception as e:
+                        metrics.observe_llm_call(endpoint.name, started, 'error')
+                        error = e
+                        self._failed(endpoint, e, attempt)
+                        continue
+
+                    # The endpoint answered; a consumer closing the stream early
+                    # must not leave a half-open breaker waiting on its trial
+                    endpoint.breaker.record_success()
+                    outcome = 'cancelled'
+                    first = True
+                    try:
+                        async for chunk in chunks:
+                            if first:
+                                metrics.LLM_TTFT_SECONDS.labels(endpoint.name).observe(time.perf_counter() - started)
+                                first = False
+                            yield chunk
+                        outcome = 'success'
+                        self._served(metadata, endpoint, config, called, attempt)
+                    except Exception as e:
+                        outcome = 'error'
+                        if isinstance(e, RETRYABLE_ERRORS):
+                            endpoint.breaker.record_failure()
+                        raise
+                    finally:
+                        metrics.observe_llm_call(endpoint.name, started, outcome)
+                    return
+
+    def status(self) -> list:
+        return [
+            {
+                'name': e.name,
+                'fallback': e.fallback,
+                'weight': e.weight,
+                'state': e.breaker.state,
+                'outstanding': e.outstanding,
+            }
+            for e in self.endpoints
+        ]
+
+
+def get_pool() -> ProviderPool:
+    """Return the process-wide provider pool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProviderPool(llm_client.endpoint_specs())
+    return _pool
+
+
+def reset_pool():
+    """Drop the pool so the next call rebuilds it from the current settings"""
+    global _pool
+    with _pool_lock:
+        _pool = None
@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger('chatbot')
+
+SEMAPHORE_KEY = 'chatbot:llm:inflight'
+GLOBAL_BUCKET_KEY = 'chatbot:llm:bucket:global'
+USER_BUCKET_KEY = 'chatbot:llm:bucket:user:{}'
+
+# Take one token from every bucket in KEYS, or from none of them. Returns
+# "0" on success, otherwise the seconds until all buckets have a token.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return '0'
+"""
+
+# Give back the token taken by TOKEN_BUCKET_SCRIPT from every bucket in KEYS
+# (ARGV holds each bucket's capacity), for callers that were never admitted
+REFUND_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local tokens = tonumber(redis.call('HGET', key, 'tokens'))
+    if tokens then
+        redis.call('HSET', key, 'tokens', tostring(math.min(tonumber(ARGV[i]), tokens + 1)))
+    end
+end
+return 1
+"""
+
+# Counting semaphore as a sorted set of holder -> lease expiry. Expired
+# leases (from crashed workers) are dropped before counting.
+SEMAPHORE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], now + lease, ARGV[4])
+    redis.call('EXPIRE', KEYS[1], math.ceil(lease) + 1)
+    return 1
+end
+return 0
+"""
+
+# Push the expiry of the leases in ARGV that are still held; a lease that
+# already expired is not brought back
+RENEW_SCRIPT = """
+local expiry = tonumber(ARGV[1]) + tonumber(ARGV[2])
+for i = 3, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', expiry, ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])) + 1)
+return 1
+"""
+
+_client = None
+_client_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_held_lock = threading.Lock()
+_held = set()
+_renewer = None
+_stats = {'admitted': 0, 'queued': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+
+class QueueTimeout(Exception):
+    """No upstream capacity became free within the configuration's queue timeout"""
+
+
+def _redis():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(settings.LLM_LIMITER_REDIS_URL)
+    return _client
+
+
+def is_limited(config) -> bool:
+    return bool(
+        config.max_concurrent_requests
+        or config.requests_per_minute
+        or config.user_requests_per_minute
+    )
+
+
+def _buckets(config, user_id):
+    """Bucket keys and their (rate per second, capacity) arguments"""
+    keys, args = [], []
+    limits = [(GLOBAL_BUCKET_KEY, config.requests_per_minute)]
+    if user_id is not None:
+        limits.append((USER_BUCKET_KEY.format(user_id), config.user_requests_per_minute))
+    for key, per_minute in limits:
+        if per_minute:
+            rate = per_minute / 60.0
+            keys.append(key)
+            args += [rate, max(1.0, rate * settings.LLM_RATE_LIMIT_BURST_SECONDS)]
+    return keys, args
+
+
+class _Admission:
+    """One caller waiting for a token and a concurrency slot.
+
+    ``poll`` makes a single non-blocking attempt, so the same logic serves
+    blocking workers (time.sleep) and the event loop (asyncio.sleep).
+    """
+
+    def __init__(self, config, user_id):
+        self.config = config
+        self.bucket_keys, self.bucket_args = _buckets(config, user_id)
+        self.needs_slot = bool(config.max_concurrent_requests)
+        self.token = None
+        self.charged = False
+        self.started = time.monotonic()
+        self.deadline = self.started + config.queue_timeout
+        self.waited = False
+
+    def poll(self):
+        """Return None once admitted, otherwise the seconds to wait before retrying"""
+        try:
+            if self.bucket_keys and not self.charged:
+                wait = float(_redis().eval(
+                    TOKEN_BUCKET_SCRIPT, len(self.bucket_keys), *self.bucket_keys,
+                    time.time(), *self.bucket_args
+                ))
+                if wait > 0:
+                    return self._backoff(wait)
+                self.charged = True
+
+            if self.needs_slot:
+                token = uuid.uuid4().hex
+                acquired = _redis().eval(
+                    SEMAPHORE_SCRIPT, 1, SEMAPHORE_KEY, time.time(),
+                    settings.LLM_LIMITER_LEASE, self.config.max_concurrent_requests, token
+                )
+                if not acquired:
+                    return self._backoff(settings.LLM_LIMITER_POLL_INTERVAL)
+                self.token = token
+                self.needs_slot = False
+                _hold(token)
+
+        except redis.RedisError as e:
+            # Fail open: an unavailable limiter must not take the chat down
+            logger.warning(f"LLM limiter unavailable, admitting request: {str(e)}")
+            self.bucket_keys = None
+            self.charged = False
+            self.needs_slot = False
+        return None
+
+    def _backoff(self, wait):
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            self._refund()
+            _record(self._waited_ms(), timed_out=True)
+            raise QueueTimeout(f"No LLM capacity within {self.config.queue_timeout}s")
+        self.waited = True
+        # Jitter so queued callers across workers do not retry in lockstep
+        return min(wait * random.uniform(1.0, 1.25), remaining)
+
+    def _refund(self):
+        """Return the bucket token of a caller that timed out waiting for a slot"""
+        if not self.charged:
+            return
+        self.charged = False
+        capacities = self.bucket_args[1::2]
+        try:
+            _redis().eval(REFUND_SCRIPT, len(self.bucket_keys), *self.bucket_keys, *capacities)
+        except redis.RedisError as e:
+            logger.warning(f"Could not refund LLM rate limit token: {str(e)}")
+
+    def abandon(self):
+        """Give back the token and slot of a caller that stopped waiting"""
+        self._refund()
+        release(self.token)
+        self.token = None
+
+    def _waited_ms(self):
+        return (time.monotonic() - self.started) * 1000
+
+    def admitted(self, metadata):
+        waited_ms = self._waited_ms()
+        _record(waited_ms, queued=self.waited)
+        if metadata is not None:
+            metadata['queue_wait_ms'] = round(waited_ms, 1)
+        if self.waited:
+            logger.info(f"LLM request waited {waited_ms:.0f} ms for capacity")
+
+
+def _record(waited_ms, queued=False, timed_out=False):
+    metrics.count_event('rate_limit', 'timeout' if timed_out else 'admitted')
+    if queued or timed_out:
+        metrics.count_event('rate_limit', 'queued')
+    metrics.LLM_QUEUE_WAIT_SECONDS.observe(waited_ms / 1000)
+    with _stats_lock:
+        if timed_out:
+            _stats['timeouts'] += 1
+        else:
+            _stats['admitted'] += 1
+        if queued or timed_out:
+            _stats['queued'] += 1
+        _stats['wait_ms_total'] += waited_ms
+        _stats['wait_ms_max'] = max(_stats['wait_ms_max'], waited_ms)
+
+
+def _hold(token):
+    """Keep renewing the token's lease until it is released"""
+    global _renewer
+    with _held_lock:
+        _held.add(token)
+        if _renewer is None:
+            _renewer = threading.Thread(target=_renew_leases, name='llm-lease-renewer', daemon=True)
+            _renewer.start()
+
+
+def _renew_leases():
+    """Extend every slot this process holds, so long streams keep their slot.
+
+    Runs in one daemon thread per process while any slot is held; a worker
+    that dies stops renewing and its slots expire after LLM_LIMITER_LEASE.
+    """
+    global _renewer
+    while True:
+        lease = settings.LLM_LIMITER_LEASE
+        time.sleep(lease / 3)
+        with _held_lock:
+            tokens = list(_held)
+            if not tokens:
+                _renewer = None
+                return
+        try:
+            _redis().eval(RENEW_SCRIPT, 1, SEMAPHORE_KEY, time.time(), lease, *tokens)
+        except redis.RedisError as e:
+            logger.warning(f"Could not renew LLM concurrency slots: {str(e)}")
+
+
+def release(token):
+    if token is None:
+        return
+    with _held_lock:
+        _held.discard(token)
+    try:
+        _redis().zrem(SEMAPHORE_KEY, token)
+    except redis.RedisError as e:
+        # The lease expires on its own
+        logger.warning(f"Could not release LLM concurrency slot: {str(e)}")
+
+
+@contextmanager
+def limit(config, user_id=None, metadata=None):
+    """Block until the configuration's limits admit one upstream call.
+
+    Waits at most ``config.queue_timeout`` seconds, then raises QueueTimeout.
+    Records the wait as ``queue_wait_ms`` in ``metadata``.
+    """
+    if not is_limited(config):
+        yield
+        return
+    admission = _Admission(config, user_id)
+    try:
+        while True:
+            delay = admission.poll()
+            if delay is None:
+                break
+            time.sleep(delay)
+    except BaseException:
+        admission.abandon()
+        raise
+    admission.admitted(metadata)
+    try:
+        yield
+    finally:
+        release(admission.token)
+
+
+@asynccontextmanager
+async def alimit(config, user_id=None, metadata=None):
+    """Async limit(); Redis round trips run off the event loop"""
+    if not is_limited(config):
+        yield
+        return
+    admission = _Admission(config, user_id)
+    poll = sync_to_async(admission.poll, thread_sensitive=False)
+    attempt = None
+    try:
+        while True:
+            attempt = asyncio.ensure_future(poll())
+            delay = await asyncio.shield(attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+    except BaseException:
+        # A cancelled turn: the poll in flight may still take a slot in its
+        # thread, so let it finish before giving everything back
+        if attempt is not None:
+            await asyncio.wait([attempt])
+        await sync_to_async(admission.abandon, thread_sensitive=False)()
+        raise
+    admission.admitted(metadata)
+    try:
+        yield
+    finally:
+        await sync_to_async(release, thread_sensitive=False)(admission.token)
+
+
+def stats() -> dict:
+    """Admission counters and queue wait times for this worker process"""
+    with _stats_lock:
+        result = dict(_stats)
+    requests = result['admitted'] + result['timeouts']
+    result['wait_ms_avg'] = result['wait_ms_total'] / requests if requests else 0.0
+    return result
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+
+logger = logging.getLogger('chatbot')
+
+KEY_PREFIX = 'chatbot:response:'
+
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'stores': 0}
+
+
+def normalize(text: str) -> str:
+    """Case- and whitespace-insensitive form of a prompt, ignoring end punctuation"""
+    return ' '.join(text.lower().split()).rstrip('?!. ')
+
+
+def make_key(config, messages):
+    """Cache key for a prompt, or None when the prompt is not cacheable.
+
+    Only context-free prompts (system prompt plus a single user turn) are
+    cacheable, since a follow-up such as "yes" means something different in
+    every conversation.
+    """
+    if not config.response_cache_enabled or len(messages) != 2:
+        return None
+    return KEY_PREFIX + prompt_digest(config, messages)
+
+
+def prompt_digest(config, messages) -> str:
+    """Fingerprint of a context-free prompt under ``config``"""
+    raw = '\x1f'.join([
+        str(config.pk),
+        config.updated_at.isoformat() if config.updated_at else '',
+        normalize(messages[0]['content']),
+        normalize(messages[-1]['content']),
+    ])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _local_get(key):
+    with _lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        _stats['local_hits'] += 1
+    metrics.count_event('response_cache', 'local_hit')
+    return value
+
+
+def _local_set(key, value, ttl):
+    ttl = min(ttl, settings.RESPONSE_CACHE_LOCAL_TTL)
+    with _lock:
+        _local[key] = (value, time.monotonic() + ttl)
+        _local.move_to_end(key)
+        while len(_local) > settings.RESPONSE_CACHE_LOCAL_MAX_ENTRIES:
+            _local.popitem(last=False)
+
+
+def _shared_get(key, ttl):
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Response cache read failed: {str(e)}")
+        value = None
+    with _lock:
+        if value is None:
+            _stats['misses'] += 1
+        else:
+            _stats['redis_hits'] += 1
+    metrics.count_event('response_cache', 'miss' if value is None else 'redis_hit')
+    if value is not None:
+        _local_set(key, value, ttl)
+    return value
+
+
+def get(config, messages):
+    """Return a cached reply for this prompt, or None"""
+    key = make_key(config, messages)
+    if key is None:
+        return None
+    value = _local_get(key)
+    if value is None:
+        value = _shared_get(key, config.response_cache_ttl)
+    return value
+
+
+async def aget(config, messages):
+    """Async get; only a local miss leaves the event loop for Redis"""
+    key = make_key(config, messages)
+    if key is None:
+        return None
+    value = _local_get(key)
+    if value is None:
+        value = await sync_to_async(_shared_get, thread_sensitive=False)(
+            key, config.response_cache_ttl
+        )
+    return value
+
+
+def store(config, messages, response: str):
+    key = make_key(config, messages)
+    if key is None:
+        return
+    _local_set(key, response, config.response_cache_ttl)
+    try:
+        cache.set(key, response, config.response_cache_ttl)
+    except Exception as e:
+        logger.warning(f"Response cache write failed: {str(e)}")
+    with _lock:
+        _stats['stores'] += 1
+    metrics.count_event('response_cache', 'store')
+
+
+async def astore(config, messages, response: str):
+    await sync_to_async(store, thread_sensitive=False)(config, messages, response)
+
+
+def stats() -> dict:
+    """Hit/miss counters for this worker process"""
+    with _lock:
+        result = dict(_stats)
+        result['local_entries'] = len(_local)
+    lookups = result['local_hits'] + result['redis_hits'] + result['misses']
+    result['hit_rate'] = (result['local_hits'] + result['redis_hits']) / lookups if lookups else 0.0
+    return result
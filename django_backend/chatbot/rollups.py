@@ -0,0 +1,122 @@
+from datetime import timedelta
+from django.db.models import Avg, BigIntegerField, Count, F, FloatField, Q, Sum
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, TruncDay, TruncHour
+from django.utils import timezone
+from .models import ChatMetricsRollup, ChatSession, Message
+
+STEP = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+COUNTERS = [
+    'sessions_created', 'total_messages', 'user_messages', 'assistant_messages',
+    'response_count', 'average_response_time', 'prompt_tokens', 'completion_tokens',
+    'cache_hits', 'fallback_replies',
+]
+
+
+def bucket_floor(moment, period):
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def _metadata_number(key, output_field):
+    return Cast(KT(f'metadata__{key}'), output_field)
+
+
+def rollup_range(start, end, period):
+    """Recompute the rollup rows for every ``period`` bucket in [start, end).
+
+    Hours are aggregated from the raw rows: messages with one
+    conditional-aggregation query grouped by hour, sessions with another.
+    Response times and token counts are read from the metadata each reply
+    was stored with. Days are summed from the hourly rows, so the hours of a
+    range must be rolled up before its days. Either way the rows are
+    upserted in one statement, and running it again is harmless.
+    """
+    start = bucket_floor(start, period)
+    rows = {}
+    bucket = start
+    while bucket < end:
+        rows[bucket] = ChatMetricsRollup(period=period, bucket_start=bucket)
+        bucket += STEP[period]
+
+    counts = _hours_from_raw(start, end) if period == 'hour' else _days_from_hours(start, end)
+    for values in counts:
+        row = rows.get(values.pop('bucket'))
+        if row is None:
+            continue
+        for field, value in values.items():
+            if value is not None:
+                setattr(row, field, value)
+
+    ChatMetricsRollup.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=['period', 'bucket_start'],
+        update_fields=COUNTERS + ['updated_at'],
+    )
+    return list(rows.values())
+
+
+def _hours_from_raw(start, end):
+    message_counts = (
+        Message.objects.filter(created_at__gte=start, created_at__lt=end)
+        .annotate(bucket=TruncHour('created_at')).values('bucket').order_by()
+        .annotate(
+            total_messages=Count('id'),
+            user_messages=Count('id', filter=Q(message_type='user')),
+            assistant_messages=Count('id', filter=Q(message_type='assistant')),
+            response_count=Count('id', filter=Q(message_type='assistant', metadata__has_key='generation_ms')),
+            generation_ms=Avg(
+                _metadata_number('generation_ms', FloatField()), filter=Q(message_type='assistant')
+            ),
+            prompt_tokens=Sum(_metadata_number('prompt_tokens', BigIntegerField())),
+            completion_tokens=Sum(_metadata_number('completion_tokens', BigIntegerField())),
+            cache_hits=Count('id', filter=Q(message_type='assistant', metadata__cache_hit=True)),
+            fallback_replies=Count('id', filter=Q(message_type='assistant', metadata__fallback=True)),
+        )
+    )
+    for values in message_counts:
+        generation_ms = values.pop('generation_ms')
+        if generation_ms is not None:
+            values['average_response_time'] = generation_ms / 1000
+        yield values
+
+    yield from (
+        ChatSession.objects.filter(created_at__gte=start, created_at__lt=end)
+        .annotate(bucket=TruncHour('created_at')).values('bucket').order_by()
+        .annotate(sessions_created=Count('id'))
+    )
+
+
+def _days_from_hours(start, end):
+    summed = [field for field in COUNTERS if field != 'average_response_time']
+    hourly = (
+        ChatMetricsRollup.objects.filter(period='hour', bucket_start__gte=start, bucket_start__lt=end)
+        .annotate(bucket=TruncDay('bucket_start')).values('bucket').order_by()
+        .annotate(
+            response_seconds=Sum(
+                F('average_response_time') * F('response_count'), output_field=FloatField()
+            ),
+            **{field: Sum(field) for field in summed},
+        )
+    )
+    for values in hourly:
+        # Each hour's mean weighted by the replies it was taken over
+        response_seconds = values.pop('response_seconds')
+        if values['response_count']:
+            values['average_response_time'] = response_seconds / values['response_count']
+        yield values
+
+
+def refresh_recent_rollups(now=None):
+    """Recompute the current and previous hour, then the current and previous day from the hours.
+
+    Only two hours of raw messages are scanned per run; the daily report
+    re-aggregates the whole of yesterday once late writes have landed.
+    """
+    now = now or timezone.now()
+    for period in ('hour', 'day'):
+        current = bucket_floor(now, period)
+        rollup_range(current - STEP[period], current + STEP[period], period)
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, Value
+
+
+def is_supported() -> bool:
+    """Full-text search needs PostgreSQL; other backends fall back to a substring scan"""
+    return connection.vendor == 'postgresql'
+
+
+def vector_for(content: str):
+    """Expression that computes a message's search vector inside its INSERT/UPDATE"""
+    if not is_supported():
+        return None
+    return SearchVector(Value(content), config=settings.CHAT_SEARCH_CONFIG)
+
+
+def search_query(text: str) -> SearchQuery:
+    # websearch syntax: quoted phrases, OR and -exclusions, never a syntax error
+    return SearchQuery(text, search_type='websearch', config=settings.CHAT_SEARCH_CONFIG)
+
+
+def filter_messages(queryset, text: str):
+    """Messages matching ``text`` through the GIN index on search_vector"""
+    if not is_supported():
+        return queryset.filter(content__icontains=text)
+    return queryset.filter(search_vector=search_query(text))
+
+
+def rank_messages(queryset, text: str):
+    """Matching messages, best first, with ``rank`` and a highlighted ``headline``"""
+    if not is_supported():
+        return filter_messages(queryset, text).annotate(
+            rank=Value(0.0), headline=F('content')
+        ).order_by('-created_at', '-id')
+
+    query = search_query(text)
+    return queryset.filter(search_vector=query).annotate(
+        rank=SearchRank(F('search_vector'), query),
+        headline=SearchHeadline(
+            'content', query, config=settings.CHAT_SEARCH_CONFIG,
+            start_sel='<mark>', stop_sel='</mark>', max_words=35, min_words=15
+        ),
+    ).order_by('-rank', '-created_at', '-id')
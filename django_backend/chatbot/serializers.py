@@ -1,5 +1,7 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import ChatSession, Message, AIConfiguration, ChatAnalytics
+from .models import ChatSession, Message, AIConfiguration, ChatAnalytics, ChatMetricsRollup
+from .pagination import encode_cursor, latest_page
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -7,16 +9,46 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'message_type', 'content', 'metadata', 'created_at']
         read_only_fields = ['id', 'created_at']
 
+class MessageSearchResultSerializer(serializers.ModelSerializer):
+    session_id = serializers.UUIDField(source='chat_session.session_id', read_only=True)
+    session_title = serializers.CharField(source='chat_session.title', read_only=True)
+    headline = serializers.CharField(read_only=True)
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'chat_session', 'session_id', 'session_title', 'message_type',
+                  'headline', 'rank', 'created_at']
+        read_only_fields = fields
+
 class ChatSessionSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
+    # Only the most recent page of history; older messages are fetched
+    # from the messages endpoint with ?before=<messages_before>
+    messages = serializers.SerializerMethodField()
+    messages_before = serializers.SerializerMethodField()
     message_count = serializers.SerializerMethodField()
     
     class Meta:
         model = ChatSession
-        fields = ['id', 'session_id', 'title', 'is_active', 'created_at', 'updated_at', 'messages', 'message_count']
+        fields = ['id', 'session_id', 'title', 'is_active', 'created_at', 'updated_at', 'messages', 'messages_before', 'message_count']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+    def _recent_page(self, obj):
+        if not hasattr(obj, '_recent_messages_page'):
+            obj._recent_messages_page = latest_page(obj.messages.all(), settings.MESSAGE_PAGE_SIZE)
+        return obj._recent_messages_page
+
+    def get_messages(self, obj):
+        page, _ = self._recent_page(obj)
+        return MessageSerializer(page, many=True).data
+
+    def get_messages_before(self, obj):
+        page, has_older = self._recent_page(obj)
+        return encode_cursor(page[0]) if has_older else None
+
     def get_message_count(self, obj):
+        if hasattr(obj, 'message_count'):
+            return obj.message_count
         return obj.messages.count()
 
 class ChatSessionListSerializer(serializers.ModelSerializer):
@@ -29,10 +61,16 @@ class ChatSessionListSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
     def get_message_count(self, obj):
+        # Annotated by ChatSessionViewSet.get_queryset
+        if hasattr(obj, 'message_count'):
+            return obj.message_count
         return obj.messages.count()
 
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
+        if 'last_messages' in self.context:
+            last_message = self.context['last_messages'].get(obj.last_message_id)
+        else:
+            last_message = obj.messages.last()
         if last_message:
             return MessageSerializer(last_message).data
         return None
@@ -47,4 +85,12 @@ class ChatAnalyticsSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatAnalytics
         fields = '__all__'
-        read_only_fields = ['id', 'created_at', 'updated_at']
\ No newline at end of file
+        read_only_fields = ['id', 'created_at', 'updated_at']
+
+class ChatMetricsRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatMetricsRollup
+        fields = ['period', 'bucket_start', 'sessions_created', 'total_messages',
+                  'user_messages', 'assistant_messages', 'response_count', 'average_response_time',
+                  'prompt_tokens', 'completion_tokens', 'cache_hits', 'fallback_replies', 'updated_at']
+        read_only_fields = fields
\ No newline at end of file
@@ -1,6 +1,11 @@
 import openai
 import logging
+import time
+from contextlib import aclosing
+from channels.db import database_sync_to_async
 from django.conf import settings
+from . import config_cache, intents, llm_client, metrics, providers, rate_limit, response_cache, single_flight
+from .context import ContextBuilder, count_message_tokens, count_tokens
 from .models import AIConfiguration, ChatSession, Message
 
 logger = logging.getLogger('chatbot')
@@ -12,53 +17,30 @@ class AIService:
         self.azure_openai_endpoint = settings.AZURE_OPENAI_ENDPOINT
         self.azure_openai_api_version = settings.AZURE_OPENAI_API_VERSION
         self.azure_openai_deployment_name = settings.AZURE_OPENAI_DEPLOYMENT_NAME
-        
-        # Configure OpenAI client based on available credentials
-        if self.azure_openai_api_key and self.azure_openai_endpoint:
-            # Configure for Azure OpenAI
-            openai.api_type = "azure"
-            openai.api_key = self.azure_openai_api_key
-            openai.api_base = self.azure_openai_endpoint
-            openai.api_version = self.azure_openai_api_version
-            self.use_azure = True
-            logger.info("Configured for Azure OpenAI")
-        elif self.openai_api_key:
-            # Configure for standard OpenAI
-            openai.api_key = self.openai_api_key
-            openai.api_type = "open_ai"
-            self.use_azure = False
-            logger.info("Configured for standard OpenAI")
-        else:
-            self.use_azure = False
-            logger.info("No OpenAI API keys configured, using fallback responses")
 
-    def generate_response(self, chat_session: ChatSession, user_message: str) -> str:
-        """Generate AI response based on chat history and user message"""
+        # Endpoints and their clients live in the process-wide provider pool
+        # and are shared by every AIService instance.
+        self.use_azure = llm_client.uses_azure()
+
+    def generate_response(self, chat_session: ChatSession, user_message: str, metadata=None) -> str:
+        """Generate AI response based on chat history and user message.
+
+        If ``metadata`` is given it is filled with details about the reply
+        that are worth storing on the assistant Message: timings, token
+        counts, the model that answered and where the reply came from.
+        """
+        metadata = {} if metadata is None else metadata
+        started = time.perf_counter()
         try:
-            # Get AI configuration
-            config = AIConfiguration.objects.filter(is_active=True).first()
-            if not config:
-                config = self._get_default_config()
-
-            # Get recent chat history
-            recent_messages = chat_session.messages.order_by('-created_at')[:10]
-            
-            # Build conversation context
-            messages = [{"role": "system", "content": config.system_prompt}]
-            
-            for msg in reversed(recent_messages):
-                if msg.message_type == 'user':
-                    messages.append({"role": "user", "content": msg.content})
-                elif msg.message_type == 'assistant':
-                    messages.append({"role": "assistant", "content": msg.content})
-
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
+            config, messages = self.prepare_context(chat_session, user_message, metadata)
 
             # Generate response
-            if self.azure_openai_api_key or self.openai_api_key:
-                response = self._generate_openai_response(messages, config)
+            if llm_client.is_configured():
+                response = self._generate_openai_response(
+                    messages, config, metadata, user_id=chat_session.user_id
+                )
             else:
+                metadata['fallback'] = True
                 response = self._generate_fallback_response(user_message, chat_session.user)
 
             logger.info(f"Generated response for user {chat_session.user.username}")
@@ -66,78 +48,239 @@ class AIService:
 
         except Exception as e:
             logger.error(f"Error generating AI response: {str(e)}")
+            metadata['error'] = type(e).__name__
+            return self._generate_error_response()
+        finally:
+            metadata['generation_ms'] = _elapsed_ms(started)
+            metrics.record_reply(metadata)
+
+    def prepare_context(self, chat_session: ChatSession, user_message: str, metadata=None):
+        """Resolve the active configuration and build the conversation context"""
+        started = time.perf_counter()
+        # Get AI configuration (cached per worker, see config_cache)
+        config = config_cache.get_active_config(self._get_default_config)
+
+        # Pack as much recent history as fits the model's token budget
+        messages = ContextBuilder(config).build(chat_session, user_message)
+
+        if metadata is not None:
+            metadata['context_ms'] = _elapsed_ms(started)
+        return config, messages
+
+    async def agenerate_response(self, chat_session: ChatSession, user_message: str, metadata=None) -> str:
+        """Async counterpart of generate_response for the WebSocket consumer.
+
+        Only context building runs in the database thread; the upstream call
+        is awaited on the event loop through the shared connection pool.
+        """
+        metadata = {} if metadata is None else metadata
+        started = time.perf_counter()
+        try:
+            config, messages = await database_sync_to_async(self.prepare_context)(
+                chat_session, user_message, metadata
+            )
+
+            if llm_client.is_configured():
+                response = await self._agenerate_openai_response(
+                    messages, config, metadata, user_id=chat_session.user_id
+                )
+            else:
+                metadata['fallback'] = True
+                response = await database_sync_to_async(self._generate_fallback_response)(
+                    user_message, chat_session.user
+                )
+
+            logger.info(f"Generated response for user {chat_session.user.username}")
+            return response
+
+        except Exception as e:
+            logger.error(f"Error generating AI response: {str(e)}")
+            metadata['error'] = type(e).__name__
             return self._generate_error_response()
+        finally:
+            metadata['generation_ms'] = _elapsed_ms(started)
+            metrics.record_reply(metadata)
+
+    async def astream_response(self, messages, config, user_message: str, user, metadata=None):
+        """Yield the AI response in chunks as the model produces them.
+
+        Does no database work. Cached, fallback and error replies are yielded
+        as a single chunk.
+        """
+        metadata = {} if metadata is None else metadata
+        try:
+            stream = self._astream_reply(messages, config, user_message, user, metadata)
+            async with aclosing(stream) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            metrics.record_reply(metadata)
+
+    async def _astream_reply(self, messages, config, user_message: str, user, metadata):
+        if not llm_client.is_configured():
+            metadata['fallback'] = True
+            yield await database_sync_to_async(self._generate_fallback_response)(user_message, user)
+            return
+
+        cached = await response_cache.aget(config, messages)
+        if cached is not None:
+            metadata['cache_hit'] = True
+            yield cached
+            return
+
+        # An identical prompt already in flight is answered in one chunk, like a cache hit
+        shared, flight = await single_flight.ajoin(config, messages)
+        if shared is not None:
+            metadata['coalesced'] = True
+            yield shared
+            return
+
+        parts = []
+        content = None
+        try:
+            # The concurrency slot is held until the stream is finished
+            async with rate_limit.alimit(config, getattr(user, 'id', None), metadata):
+                stream = providers.get_pool().astream(
+                    config,
+                    messages,
+                    metadata=metadata,
+                    temperature=config.temperature,
+                    max_tokens=config.max_tokens
+                )
+                async with aclosing(stream) as chunks:
+                    async for chunk in chunks:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+            content = ''.join(parts)
+            self._record_usage(metadata, config, messages, content)
+
+        except Exception as e:
+            if parts:
+                # Keep the partial answer rather than appending a canned reply to it
+                logger.error(f"OpenAI stream interrupted: {str(e)}")
+                metadata['error'] = type(e).__name__
+                self._record_usage(metadata, config, messages, ''.join(parts))
+                return
+            yield self._handle_openai_error(e, metadata)
+            return
+        finally:
+            # Also reached when the consumer abandons the stream
+            await single_flight.afinish(flight, content)
 
-    def _generate_openai_response(self, messages, config):
+        await response_cache.astore(config, messages, content)
+
+    def _generate_openai_response(self, messages, config, metadata, user_id=None):
         """Generate response using OpenAI API (Azure or Standard)"""
+        cached = response_cache.get(config, messages)
+        if cached is not None:
+            metadata['cache_hit'] = True
+            return cached
+
+        # Concurrent identical prompts share one upstream call
+        shared, flight = single_flight.join(config, messages)
+        if shared is not None:
+            metadata['coalesced'] = True
+            return shared
+
+        content = None
         try:
-            if self.use_azure:
-                # Azure OpenAI API call
-                response = openai.ChatCompletion.create(
-                    engine=self.azure_openai_deployment_name,  # Use engine for Azure
-                    messages=messages,
+            with rate_limit.limit(config, user_id, metadata):
+                response = providers.get_pool().complete(
+                    config,
+                    messages,
+                    metadata=metadata,
                     temperature=config.temperature,
                     max_tokens=config.max_tokens
                 )
-            else:
-                # Standard OpenAI API call
-                response = openai.ChatCompletion.create(
-                    model=config.model_name,
-                    messages=messages,
+            content = response.choices[0].message.content
+            self._record_usage(metadata, config, messages, content, response.usage)
+        except Exception as e:
+            return self._handle_openai_error(e, metadata)
+        finally:
+            single_flight.finish(flight, content)
+
+        response_cache.store(config, messages, content)
+        return content
+
+    async def _agenerate_openai_response(self, messages, config, metadata, user_id=None):
+        """Generate response on the pooled async client"""
+        cached = await response_cache.aget(config, messages)
+        if cached is not None:
+            metadata['cache_hit'] = True
+            return cached
+
+        shared, flight = await single_flight.ajoin(config, messages)
+        if shared is not None:
+            metadata['coalesced'] = True
+            return shared
+
+        content = None
+        try:
+            async with rate_limit.alimit(config, user_id, metadata):
+                response = await providers.get_pool().acomplete(
+                    config,
+                    messages,
+                    metadata=metadata,
                     temperature=config.temperature,
                     max_tokens=config.max_tokens
                 )
-            
-            return response.choices[0].message.content
-            
-        except openai.error.RateLimitError:
+            content = response.choices[0].message.content
+            self._record_usage(metadata, config, messages, content, response.usage)
+        except Exception as e:
+            return self._handle_openai_error(e, metadata)
+        finally:
+            await single_flight.afinish(flight, content)
+
+        await response_cache.astore(config, messages, content)
+        return content
+
+    def _record_usage(self, metadata, config, messages, content, usage=None):
+        """Store token counts from the API's usage block.
+
+        Streamed replies carry no usage block, so their tokens are counted
+        locally and flagged with ``tokens_estimated``.
+        """
+        if usage is not None:
+            metadata['prompt_tokens'] = usage.prompt_tokens
+            metadata['completion_tokens'] = usage.completion_tokens
+            return
+        metadata['prompt_tokens'] = count_message_tokens(messages, config.model_name)
+        metadata['completion_tokens'] = count_tokens(content or '', config.model_name)
+        metadata['tokens_estimated'] = True
+
+    def _handle_openai_error(self, error: Exception, metadata) -> str:
+        """Log an OpenAI API error and return the reply to show the user"""
+        metadata['error'] = type(error).__name__
+        if isinstance(error, rate_limit.QueueTimeout):
+            logger.warning(f"LLM request shed after queueing: {str(error)}")
+            return "I'm experiencing high demand right now. Please try again in a moment."
+        elif isinstance(error, openai.RateLimitError):
             logger.error("OpenAI API rate limit exceeded")
             return "I'm experiencing high demand right now. Please try again in a moment."
-        except openai.error.InvalidRequestError as e:
-            logger.error(f"OpenAI API invalid request: {str(e)}")
+        elif isinstance(error, openai.BadRequestError):
+            logger.error(f"OpenAI API invalid request: {str(error)}")
             return "I'm having trouble processing your request. Please try rephrasing your question."
-        except openai.error.AuthenticationError:
+        elif isinstance(error, openai.AuthenticationError):
             logger.error("OpenAI API authentication failed")
             return self._generate_fallback_response("", None)
-        except openai.error.APIConnectionError:
+        elif isinstance(error, (openai.APIConnectionError, providers.NoEndpointAvailable)):
             logger.error("OpenAI API connection error")
             return "I'm having trouble connecting to my AI service. Please try again later."
-        except Exception as e:
-            logger.error(f"OpenAI API error: {str(e)}")
+        else:
+            logger.error(f"OpenAI API error: {str(error)}")
             return self._generate_fallback_response("", None)
 
     def _generate_fallback_response(self, user_message: str, user) -> str:
-        """Generate fallback response when OpenAI is not available"""
-        user_message_lower = user_message.lower()
-        
-        # Azure AI Foundry specific responses
-        if any(keyword in user_message_lower for keyword in ['azure', 'ai foundry', 'gpt-4', 'openai']):
-            return "I'm powered by Azure AI Foundry's GPT-4 model to provide you with intelligent assistance. How can I help you with your workplace needs today?"
-        
-        # HR-related responses
-        elif any(keyword in user_message_lower for keyword in ['hr', 'human resources', 'payroll', 'benefits', 'leave', 'vacation']):
-            return "I can help you with HR-related questions! For specific HR matters like payroll, benefits, or leave requests, I recommend visiting the HR Management portal or contacting your HR representative directly. What specific HR topic would you like assistance with?"
-        
-        # IT-related responses
-        elif any(keyword in user_message_lower for keyword in ['it', 'technical', 'computer', 'software', 'password', 'system']):
-            return "For technical support and IT-related issues, I can guide you through common solutions or help you submit a support ticket. What technical issue are you experiencing?"
-        
-        # Employee portal responses
-        elif any(keyword in user_message_lower for keyword in ['employee', 'portal', 'profile', 'directory']):
-            return "You can access your employee information, update your profile, and view the company directory through the Employee Portal. What specific information are you looking for?"
-        
-        # Greeting responses
-        elif any(keyword in user_message_lower for keyword in ['hello', 'hi', 'hey', 'good morning', 'good afternoon']):
-            name = user.first_name if user and user.first_name else "there"
-            return f"Hello {name}! I'm your AI assistant powered by Azure AI Foundry. I'm here to help with HR questions, IT support, employee services, and general workplace information. What can I assist you with today?"
-        
-        # General help
-        elif any(keyword in user_message_lower for keyword in ['help', 'support', 'assistance']):
-            return "I'm here to help! I can assist you with:\n\n• HR-related questions and processes\n• IT support and technical issues\n• Employee portal navigation\n• General workplace information\n• Policy and procedure questions\n\nWhat would you like to know about?"
-        
-        # Default response
-        else:
-            return "I understand you're looking for assistance. Could you please provide more details about what you need help with? I can help with HR matters, IT support, employee services, and general workplace questions. I'm powered by Azure AI Foundry to provide you with the best possible assistance."
+        """Generate fallback response when OpenAI is not available.
+
+        Intents are stored as FallbackIntent rows and compiled into a single
+        whole-word matcher per worker (see chatbot.intents).
+        """
+        return intents.respond(user_message, user)
 
     def _generate_error_response(self) -> str:
         """Generate error response when AI service fails"""
@@ -178,48 +321,49 @@ Always maintain a professional tone while being friendly and approachable. You'r
         return config
 
     def test_connection(self) -> dict:
-        """Test the AI service connection"""
-        try:
-            test_messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": "Hello, this is a connection test."}
-            ]
-            
-            if self.use_azure:
-                response = openai.ChatCompletion.create(
-                    engine=self.azure_openai_deployment_name,
-                    messages=test_messages,
-                    temperature=0.7,
-                    max_tokens=50
-                )
-                return {
-                    'status': 'success',
-                    'service': 'Azure OpenAI',
-                    'model': self.azure_openai_deployment_name,
-                    'endpoint': self.azure_openai_endpoint
-                }
-            elif self.openai_api_key:
-                response = openai.ChatCompletion.create(
-                    model='gpt-3.5-turbo',
+        """Test connection to every configured upstream endpoint.
+
+        The top-level fields describe the first endpoint that answered (or
+        the first endpoint if none did); ``endpoints`` lists each of them.
+        """
+        if not llm_client.is_configured():
+            return {
+                'status': 'fallback',
+                'service': 'Fallback responses',
+                'message': 'No API keys configured'
+            }
+
+        test_messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Hello, this is a connection test."}
+        ]
+        results = []
+        for endpoint in providers.get_pool().endpoints:
+            result = {
+                'name': endpoint.name,
+                'service': 'Azure OpenAI' if endpoint.is_azure else 'OpenAI',
+                'model': endpoint.model_for(None),
+                'fallback': endpoint.fallback,
+            }
+            if endpoint.is_azure:
+                result['endpoint'] = endpoint.spec['endpoint']
+            try:
+                # Straight to the endpoint, bypassing retries and routing
+                endpoint.client().chat.completions.create(
+                    model=result['model'],
                     messages=test_messages,
                     temperature=0.7,
                     max_tokens=50
                 )
-                return {
-                    'status': 'success',
-                    'service': 'OpenAI',
-                    'model': 'gpt-3.5-turbo'
-                }
-            else:
-                return {
-                    'status': 'fallback',
-                    'service': 'Fallback responses',
-                    'message': 'No API keys configured'
-                }
-                
-        except Exception as e:
-            return {
-                'status': 'error',
-                'service': 'Azure OpenAI' if self.use_azure else 'OpenAI',
-                'error': str(e)
-            }
\ No newline at end of file
+                result['status'] = 'success'
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = str(e)
+            results.append(result)
+
+        summary = next((r for r in results if r['status'] == 'success'), results[0])
+        return {**summary, 'endpoints': results}
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
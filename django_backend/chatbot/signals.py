@@ -0,0 +1,35 @@
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from . import config_cache, consumers, intents
+from .models import AIConfiguration, ChatSession, FallbackIntent
+
+
+@receiver(post_save, sender=AIConfiguration)
+@receiver(post_delete, sender=AIConfiguration)
+def invalidate_ai_configuration(sender, **kwargs):
+    """Covers saves from AIConfigurationViewSet, the admin and the shell"""
+    transaction.on_commit(config_cache.invalidate)
+
+
+@receiver(post_save, sender=FallbackIntent)
+@receiver(post_delete, sender=FallbackIntent)
+def invalidate_fallback_intents(sender, **kwargs):
+    transaction.on_commit(intents.invalidate)
+
+
+@receiver(post_save, sender=ChatSession)
+def end_chat_session_sockets(sender, instance, created, update_fields=None, **kwargs):
+    """Open sockets hold their session from connect; ending it must reach them.
+
+    Only the save that ends an active session notifies them, not later
+    edits (e.g. in the admin) to a session that was already ended.
+    """
+    if update_fields is not None and 'is_active' not in update_fields:
+        return
+    was_active = getattr(instance, '_stored_is_active', None)
+    instance._stored_is_active = instance.is_active
+    if created or instance.is_active or was_active is False:
+        return
+    transaction.on_commit(partial(consumers.end_session_sockets, instance.session_id))
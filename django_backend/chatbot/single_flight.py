@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+
+logger = logging.getLogger('chatbot')
+
+KEY_PREFIX = 'chatbot:flight:'
+
+_lock = threading.Lock()
+_flights = {}
+_stats = {'leaders': 0, 'local_followers': 0, 'remote_followers': 0, 'fallthroughs': 0}
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+    metrics.count_event('single_flight', key)
+
+
+def flight_key(config, messages):
+    """Key shared by identical prompts, or None when the prompt may not be merged.
+
+    As with the response cache, only context-free prompts (system prompt
+    plus a single user turn) are eligible, so replies that depend on a
+    conversation's history are never handed to another user. Unlike the
+    cache key, the prompt text is not normalized: only byte-identical
+    requests to the same model with the same parameters share a call.
+    """
+    if not settings.SINGLE_FLIGHT_ENABLED or len(messages) != 2:
+        return None
+    raw = '\x1f'.join([
+        str(config.pk),
+        config.model_name,
+        repr(config.temperature),
+        str(config.max_tokens),
+        *(f"{message['role']}\x1e{message['content']}" for message in messages),
+    ])
+    return KEY_PREFIX + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class Flight:
+    """One upstream call for a prompt that concurrent callers are waiting on.
+
+    Callers in this process wait on the Flight itself. The leader also holds
+    a lock key in the shared cache; leaders in other workers see it and poll
+    for the result key instead of calling upstream themselves.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.token = uuid.uuid4().hex
+        self.remote = False
+        self.result = None
+        self.done = threading.Event()
+        self.waiters = []
+
+    @property
+    def lock_key(self):
+        return self.key + ':lock'
+
+    @property
+    def result_key(self):
+        return self.key + ':result'
+
+    def wait(self):
+        self.done.wait(settings.SINGLE_FLIGHT_TIMEOUT)
+        return self.result
+
+    async def await_result(self):
+        loop = asyncio.get_running_loop()
+        with _lock:
+            if self.done.is_set():
+                return self.result
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, settings.SINGLE_FLIGHT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        return self.result
+
+    def release(self, result):
+        """Hand ``result`` to the local followers and retire the flight"""
+        with _lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+            self.result = result
+            self.done.set()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def claim_or_poll(self):
+        """Take the cross-worker lock, or wait for the worker holding it.
+
+        Returns that worker's reply, or None when this flight leads (or the
+        other leader gave up without a reply).
+        """
+        try:
+            if cache.add(self.lock_key, self.token, settings.SINGLE_FLIGHT_TIMEOUT):
+                self.remote = True
+                return None
+            deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+            while time.monotonic() < deadline:
+                done, result = self.poll()
+                if done:
+                    return result
+                time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        except Exception as e:
+            logger.warning(f"Single-flight lock failed, calling upstream directly: {str(e)}")
+        return None
+
+    async def aclaim_or_poll(self):
+        """Async claim_or_poll; the event loop is free between polls"""
+        try:
+            claimed = await sync_to_async(cache.add, thread_sensitive=False)(
+                self.lock_key, self.token, settings.SINGLE_FLIGHT_TIMEOUT
+            )
+            if claimed:
+                self.remote = True
+                return None
+            deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+            while time.monotonic() < deadline:
+                done, result = await sync_to_async(self.poll, thread_sensitive=False)()
+                if done:
+                    return result
+                await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        except Exception as e:
+            logger.warning(f"Single-flight lock failed, calling upstream directly: {str(e)}")
+        return None
+
+    def poll(self):
+        """(finished, result) of the flight led by another worker"""
+        values = cache.get_many([self.result_key, self.lock_key])
+        if self.result_key in values:
+            return True, values[self.result_key]
+        if self.lock_key not in values:
+            # The leader released its lock; its result may have landed in between
+            return True, cache.get(self.result_key)
+        return False, None
+
+    def publish(self, result):
+        """Store the leader's reply for other workers, then drop the lock"""
+        if not self.remote:
+            return
+        try:
+            if result is not None:
+                cache.set(self.result_key, result, settings.SINGLE_FLIGHT_RESULT_TTL)
+            if cache.get(self.lock_key) == self.token:
+                cache.delete(self.lock_key)
+        except Exception as e:
+            logger.warning(f"Could not publish single-flight result: {str(e)}")
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _enter(key):
+    """(flight, is_leader) for ``key`` in this process"""
+    with _lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight(key)
+        return flight, True
+
+
+def join(config, messages):
+    """Join the flight for this prompt.
+
+    Returns ``(shared, flight)``: ``shared`` is another caller's reply to
+    use as is; otherwise ``flight``, if not None, is led by this caller and
+    must be passed to ``finish`` once the upstream call is over.
+    """
+    key = flight_key(config, messages)
+    if key is None:
+        return None, None
+
+    flight, leader = _enter(key)
+    if not leader:
+        return _followed(flight.wait(), 'local_followers')
+
+    shared = flight.claim_or_poll()
+    if shared is not None:
+        flight.release(shared)
+        return _followed(shared, 'remote_followers')
+    _count('leaders')
+    return None, flight
+
+
+async def ajoin(config, messages):
+    """Async join; waiting never blocks the event loop"""
+    key = flight_key(config, messages)
+    if key is None:
+        return None, None
+
+    flight, leader = _enter(key)
+    if not leader:
+        return _followed(await flight.await_result(), 'local_followers')
+
+    try:
+        shared = await flight.aclaim_or_poll()
+    except BaseException:
+        flight.release(None)
+        raise
+    if shared is not None:
+        flight.release(shared)
+        return _followed(shared, 'remote_followers')
+    _count('leaders')
+    return None, flight
+
+
+def _followed(shared, counter):
+    # No reply to share (the leader failed or timed out): call upstream alone
+    _count(counter if shared is not None else 'fallthroughs')
+    return shared, None
+
+
+def finish(flight, result):
+    """Release a led flight with its reply, or None when the call failed"""
+    if flight is None:
+        return
+    flight.release(result)
+    flight.publish(result)
+
+
+async def afinish(flight, result):
+    if flight is None:
+        return
+    flight.release(result)
+    if flight.remote:
+        await sync_to_async(flight.publish, thread_sensitive=False)(result)
+
+
+def stats() -> dict:
+    """Coalescing counters for this worker process"""
+    with _lock:
+        result = dict(_stats)
+        result['in_flight'] = len(_flights)
+    return result
@@ -1,49 +1,40 @@
 from celery import shared_task
+from celery.signals import task_postrun, task_prerun
+from . import metrics
+from .cleanup import cleanup_sessions
+from .context import update_summary
 from .models import ChatSession, ChatAnalytics, Message
+from .persistence import save_message
+from .rollups import refresh_recent_rollups, rollup_range
+from .services import AIService
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 import logging
 
 logger = logging.getLogger('chatbot')
 
 @shared_task
-def update_chat_analytics(chat_session_id):
-    """Update analytics for a chat session"""
+def update_chat_analytics(chat_session_id, incremental=False):
+    """Update analytics for a chat session.
+
+    The full mode makes one streamed pass over the session's messages. The
+    incremental mode folds in only messages newer than the previous pass, so
+    running it after every reply costs the same however long the session is.
+    """
     try:
-        chat_session = ChatSession.objects.get(id=chat_session_id)
-        analytics, created = ChatAnalytics.objects.get_or_create(
-            chat_session=chat_session
-        )
-        
-        messages = chat_session.messages.all()
-        analytics.total_messages = messages.count()
-        analytics.user_messages = messages.filter(message_type='user').count()
-        analytics.assistant_messages = messages.filter(message_type='assistant').count()
-        
-        # Calculate average response time (simplified)
-        user_messages = messages.filter(message_type='user').order_by('created_at')
-        assistant_messages = messages.filter(message_type='assistant').order_by('created_at')
-        
-        if user_messages.exists() and assistant_messages.exists():
-            total_response_time = 0
-            response_count = 0
-            
-            for i, user_msg in enumerate(user_messages):
-                try:
-                    assistant_msg = assistant_messages.filter(
-                        created_at__gt=user_msg.created_at
-                    ).first()
-                    if assistant_msg:
-                        response_time = (assistant_msg.created_at - user_msg.created_at).total_seconds()
-                        total_response_time += response_time
-                        response_count += 1
-                except:
-                    continue
-            
-            if response_count > 0:
-                analytics.average_response_time = total_response_time / response_count
-        
-        analytics.save()
+        if not ChatSession.objects.filter(id=chat_session_id).exists():
+            raise ChatSession.DoesNotExist
+
+        with transaction.atomic():
+            analytics = _locked_analytics(chat_session_id)
+            if incremental and analytics.last_message_id is not None:
+                _fold_new_messages(analytics)
+            else:
+                _recompute_analytics(analytics)
+            analytics.save()
+
         logger.info(f"Updated analytics for chat session {chat_session_id}")
         
     except ChatSession.DoesNotExist:
@@ -51,57 +42,184 @@ def update_chat_analytics(chat_session_id):
     except Exception as e:
         logger.error(f"Error updating analytics: {str(e)}")
 
-@shared_task
-def cleanup_old_sessions():
-    """Clean up old inactive chat sessions"""
+def _locked_analytics(chat_session_id):
+    """The session's analytics row, locked for this transaction and created if missing.
+
+    Two first runs can both miss the row; the insert skips on conflict, so
+    the second one waits on the winner's lock instead of failing.
+    """
+    rows = ChatAnalytics.objects.select_for_update()
     try:
-        cutoff_date = timezone.now() - timedelta(days=30)
-        old_sessions = ChatSession.objects.filter(
-            is_active=False,
-            updated_at__lt=cutoff_date
+        return rows.get(chat_session_id=chat_session_id)
+    except ChatAnalytics.DoesNotExist:
+        ChatAnalytics.objects.bulk_create(
+            [ChatAnalytics(chat_session_id=chat_session_id)], ignore_conflicts=True
         )
-        
-        deleted_count = old_sessions.count()
-        old_sessions.delete()
-        
+        return rows.get(chat_session_id=chat_session_id)
+
+FOLD_FIELDS = ('id', 'message_type', 'created_at', 'metadata')
+
+def _recompute_analytics(analytics):
+    analytics.total_messages = 0
+    analytics.user_messages = 0
+    analytics.assistant_messages = 0
+    analytics.response_count = 0
+    analytics.average_response_time = 0.0
+    analytics.prompt_tokens = 0
+    analytics.completion_tokens = 0
+
+    rows = (
+        Message.objects.filter(chat_session_id=analytics.chat_session_id)
+        .order_by('id').values_list(*FOLD_FIELDS)
+        .iterator(chunk_size=2000)
+    )
+    _fold_messages(analytics, rows, pending=[])
+
+def _fold_new_messages(analytics):
+    session_messages = Message.objects.filter(chat_session_id=analytics.chat_session_id)
+    rows = list(
+        session_messages.filter(id__gt=analytics.last_message_id)
+        .order_by('id').values_list(*FOLD_FIELDS)
+    )
+
+    # User messages from the previous pass that were still waiting for a reply
+    pending = []
+    if any(row[1] == 'assistant' for row in rows):
+        previous = session_messages.filter(id__lte=analytics.last_message_id).order_by('-id')
+        for message_id, message_type, created_at in previous.values_list('id', 'message_type', 'created_at')[:20]:
+            if message_type != 'user':
+                break
+            pending.insert(0, (message_id, created_at))
+
+    _fold_messages(analytics, rows, pending)
+
+def _fold_messages(analytics, rows, pending):
+    """Count messages, response times and tokens.
+
+    ``rows`` are (id, message_type, created_at, metadata) in insertion order
+    and ``pending`` holds (id, created_at) of earlier unanswered user
+    messages. A reply's response time is the ``generation_ms`` recorded when
+    it was generated; replies stored without one (before it was recorded)
+    fall back to the time since the user messages they followed.
+    """
+    total_response_time = analytics.average_response_time * analytics.response_count
+
+    for message_id, message_type, created_at, metadata in rows:
+        analytics.total_messages += 1
+        analytics.last_message_id = message_id
+        if message_type == 'user':
+            analytics.user_messages += 1
+            pending.append((message_id, created_at))
+        elif message_type == 'assistant':
+            analytics.assistant_messages += 1
+            metadata = metadata or {}
+            analytics.prompt_tokens += metadata.get('prompt_tokens') or 0
+            analytics.completion_tokens += metadata.get('completion_tokens') or 0
+
+            generation_ms = metadata.get('generation_ms')
+            if generation_ms is not None:
+                total_response_time += generation_ms / 1000
+                analytics.response_count += 1
+                reply_to = metadata.get('reply_to')
+                if reply_to is not None:
+                    pending = [(asked_id, asked_at) for asked_id, asked_at in pending if asked_id != reply_to]
+                else:
+                    pending = pending[1:]
+                continue
+
+            for _, asked_at in pending:
+                total_response_time += (created_at - asked_at).total_seconds()
+                analytics.response_count += 1
+            pending = []
+
+    if analytics.response_count:
+        analytics.average_response_time = total_response_time / analytics.response_count
+
+@shared_task
+def generate_assistant_reply(chat_session_id, user_message_id):
+    """Generate and store the assistant reply for a queued REST message"""
+    try:
+        chat_session = ChatSession.objects.select_related('user').get(id=chat_session_id)
+        content = chat_session.messages.values_list('content', flat=True).get(id=user_message_id)
+
+        metadata = {'reply_to': user_message_id}
+        ai_response = AIService().generate_response(chat_session, content, metadata)
+
+        assistant_message = save_message(chat_session, 'assistant', ai_response, metadata)
+
+        logger.info(f"Generated queued reply for chat session {chat_session_id}")
+        return {'assistant_message_id': assistant_message.id}
+
+    except (ChatSession.DoesNotExist, Message.DoesNotExist):
+        logger.error(f"Chat session {chat_session_id} or message {user_message_id} not found")
+
+@shared_task
+def update_context_summary(chat_session_id, upto_message_id):
+    """Fold older turns of a chat session into its rolling context summary"""
+    try:
+        if update_summary(chat_session_id, upto_message_id):
+            logger.info(f"Updated context summary for chat session {chat_session_id}")
+    except ChatSession.DoesNotExist:
+        logger.error(f"Chat session {chat_session_id} not found")
+    except Exception as e:
+        logger.error(f"Error updating context summary: {str(e)}")
+
+@shared_task
+def cleanup_old_sessions(archive=None):
+    """Clean up old inactive chat sessions in small batches, archiving them first if enabled"""
+    try:
+        cutoff_date = timezone.now() - timedelta(days=settings.SESSION_RETENTION_DAYS)
+        if archive is None:
+            archive = settings.CHAT_ARCHIVE_ENABLED
+
+        deleted_count, archive_file = cleanup_sessions(cutoff_date, archive=archive)
+
         logger.info(f"Cleaned up {deleted_count} old chat sessions")
+        if archive_file:
+            logger.info(f"Archived cleaned up sessions to {archive_file}")
         
     except Exception as e:
         logger.error(f"Error cleaning up old sessions: {str(e)}")
 
+@shared_task
+def update_metrics_rollups():
+    """Refresh the hourly and daily chat metrics rollups for the current period"""
+    try:
+        refresh_recent_rollups()
+        logger.info("Refreshed chat metrics rollups")
+    except Exception as e:
+        logger.error(f"Error refreshing metrics rollups: {str(e)}")
+
 @shared_task
 def generate_daily_report():
     """Generate daily analytics report"""
     try:
         today = timezone.now().date()
         yesterday = today - timedelta(days=1)
-        
-        # Get yesterday's stats
-        sessions_created = ChatSession.objects.filter(
-            created_at__date=yesterday
-        ).count()
-        
-        messages_sent = Message.objects.filter(
-            created_at__date=yesterday
-        ).count()
-        
-        user_messages = Message.objects.filter(
-            created_at__date=yesterday,
-            message_type='user'
-        ).count()
-        
-        assistant_messages = Message.objects.filter(
-            created_at__date=yesterday,
-            message_type='assistant'
-        ).count()
-        
+
+        # Recompute yesterday's hours, then its day, so late writes are included
+        start = timezone.make_aware(datetime.combine(yesterday, time.min))
+        rollup_range(start, start + timedelta(days=1), 'hour')
+        rollup = rollup_range(start, start + timedelta(days=1), 'day')[0]
+
         logger.info(f"Daily Report for {yesterday}:")
-        logger.info(f"- Sessions created: {sessions_created}")
-        logger.info(f"- Total messages: {messages_sent}")
-        logger.info(f"- User messages: {user_messages}")
-        logger.info(f"- Assistant messages: {assistant_messages}")
-        
-        # You can extend this to send email reports, save to database, etc.
+        logger.info(f"- Sessions created: {rollup.sessions_created}")
+        logger.info(f"- Total messages: {rollup.total_messages}")
+        logger.info(f"- User messages: {rollup.user_messages}")
+        logger.info(f"- Assistant messages: {rollup.assistant_messages}")
+        logger.info(f"- Average response time: {rollup.average_response_time:.2f}s over {rollup.response_count} replies")
+        logger.info(f"- Tokens: {rollup.prompt_tokens} prompt, {rollup.completion_tokens} completion")
+        logger.info(f"- Cache hits: {rollup.cache_hits}, fallback replies: {rollup.fallback_replies}")
         
     except Exception as e:
-        logger.error(f"Error generating daily report: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error generating daily report: {str(e)}")
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    metrics.task_started(task_id)
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    metrics.task_finished(task_id, task.name, 'success' if state == 'SUCCESS' else 'failure')
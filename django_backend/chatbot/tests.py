@@ -0,0 +1,588 @@
+import asyncio
+import base64
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from . import context, knowledge, providers, rate_limit, response_cache, single_flight
+from .benchmarks.driver import QueryCounter
+from .context import SUMMARY_PREFIX, ContextBuilder
+from .models import ChatAnalytics, ChatMetricsRollup, ChatSession, Message
+from .persistence import save_message
+from .rollups import refresh_recent_rollups, rollup_range
+from .routing import websocket_urlpatterns
+from .services import AIService
+from .tasks import generate_assistant_reply, update_chat_analytics
+
+# Redis-free stand-ins for the cache, channel layer and Celery; no LLM
+# endpoint is configured, so replies come from the fallback intents.
+TEST_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'CELERY_TASK_ALWAYS_EAGER': True,
+    'CELERY_TASK_STORE_EAGER_RESULT': True,
+    'CELERY_RESULT_BACKEND': 'cache+memory://',
+    'LLM_ENDPOINTS': [],
+    'OPENAI_API_KEY': '',
+    'AZURE_OPENAI_API_KEY': '',
+    'CHAT_ANALYTICS_ON_REPLY': False,
+}
+
+
+class ChatTestMixin:
+    """Logged-in API client with one chat session; Celery tasks run eagerly"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='employee', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chat_session = ChatSession.objects.create(user=self.user, session_id=uuid.uuid4())
+
+    def session_url(self, action):
+        return f'/api/v1/chat/sessions/{self.chat_session.pk}/{action}/'
+
+
+@override_settings(**TEST_SETTINGS)
+class ChatTestCase(ChatTestMixin, TestCase):
+    pass
+
+
+@override_settings(**TEST_SETTINGS)
+class ChatTransactionTestCase(ChatTestMixin, TransactionTestCase):
+    """For consumers: database_sync_to_async closes connections left in a transaction"""
+
+    def connect(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat_session.session_id}/'
+        )
+        communicator.scope['user'] = self.user
+        return communicator
+
+
+# Celery copies task_store_eager_result onto each task when the app is
+# finalized, which may happen before TEST_SETTINGS apply
+@mock.patch.object(generate_assistant_reply, 'store_eager_result', True)
+class SendMessageAsyncTests(ChatTestCase):
+    def test_reply_is_queued_and_polled(self):
+        response = self.client.post(self.session_url('send_message_async'), {'content': 'Hello'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Location'], response.data['status_url'])
+
+        poll = self.client.get(response.data['status_url'])
+        self.assertEqual(poll.status_code, 200)
+        self.assertEqual(poll.data['status'], 'completed')
+        reply = Message.objects.get(id=poll.data['assistant_message']['id'])
+        self.assertEqual(reply.message_type, 'assistant')
+        self.assertEqual(reply.metadata['reply_to'], response.data['user_message']['id'])
+
+    def test_unknown_job_is_not_found(self):
+        response = self.client.get(self.session_url(f'jobs/{uuid.uuid4()}'))
+        self.assertEqual(response.status_code, 404)
+
+
+class ContextSummaryTests(ChatTestCase):
+    @override_settings(LLM_CONTEXT_WINDOW=1500, CONTEXT_MAX_HISTORY_MESSAGES=50)
+    def test_trimmed_history_is_summarized(self):
+        turns = [
+            Message(chat_session=self.chat_session, message_type=message_type,
+                    content=f'{message_type} turn {i}: ' + 'details ' * 60)
+            for i in range(12) for message_type in ('user', 'assistant')
+        ]
+        Message.objects.bulk_create(turns)
+        config = AIService()._get_default_config()
+
+        messages = ContextBuilder(config).build(self.chat_session, 'What did we decide?')
+
+        kept = [m['content'] for m in messages if m['role'] in ('user', 'assistant')][:-1]
+        oldest_kept = Message.objects.get(chat_session=self.chat_session, content=kept[0])
+        self.assertNotEqual(oldest_kept.id, turns[0].id)
+
+        # Everything older than the oldest kept turn was folded into the summary
+        self.chat_session.refresh_from_db()
+        self.assertEqual(self.chat_session.context_summary_upto, oldest_kept.id - 1)
+        self.assertIn('Employee: user turn', self.chat_session.context_summary)
+
+
+    @override_settings(CONTEXT_MAX_HISTORY_MESSAGES=5)
+    def test_turns_past_the_message_cap_are_summarized(self):
+        Message.objects.bulk_create(
+            Message(chat_session=self.chat_session, message_type=message_type, content=f'{message_type} turn {i}')
+            for i in range(4) for message_type in ('user', 'assistant')
+        )
+        save_message(self.chat_session, 'user', 'And now?')
+        config = AIService()._get_default_config()
+
+        messages = ContextBuilder(config).build(self.chat_session, 'And now?')
+
+        history = [m['content'] for m in messages if m['role'] in ('user', 'assistant')][:-1]
+        self.assertEqual(history[0], 'assistant turn 1')
+        self.assertEqual(len(history), 5)
+        oldest_kept = Message.objects.get(chat_session=self.chat_session, content='assistant turn 1')
+        self.chat_session.refresh_from_db()
+        self.assertEqual(self.chat_session.context_summary_upto, oldest_kept.id - 1)
+        self.assertIn('Employee: user turn 1', self.chat_session.context_summary)
+
+
+class RestTurnQueryCountTests(ChatTestCase):
+    """Database round trips for one chat turn, so regressions show up here"""
+
+    def test_rest_turn(self):
+        # Warm the per-worker configuration and intent caches
+        self.client.post(self.session_url('send_message'), {'content': 'Hello'})
+
+        # Session, user message INSERT, history, user (for the fallback reply),
+        # then the assistant INSERT and session UPDATE inside a savepoint
+        with self.assertNumQueries(8):
+            response = self.client.post(self.session_url('send_message'), {'content': 'How do I reset my password?'})
+        self.assertEqual(response.status_code, 200)
+
+
+class WebSocketTurnQueryCountTests(ChatTransactionTestCase):
+    async def test_websocket_turn(self):
+        # The consumer's queries run on its own thread and connection
+        counter = QueryCounter()
+        counter.install()
+        self.addCleanup(counter.uninstall)
+        communicator = self.connect()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await self.ws_turn(communicator, 'Hello')
+
+        # Summary reload, user message INSERT, history, assistant INSERT and
+        # session UPDATE; the session and its user were loaded once on connect
+        before = counter.count
+        reply = await self.ws_turn(communicator, 'How do I reset my password?')
+        self.assertEqual(counter.count - before, 5)
+        self.assertEqual(reply['message']['type'], 'assistant')
+        await communicator.disconnect()
+
+    async def ws_turn(self, communicator, content):
+        await communicator.send_json_to({'type': 'message', 'content': content})
+        user_frame = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(user_frame['message']['content'], content)
+        return await communicator.receive_json_from(timeout=5)
+
+
+async def fake_reply(self, chat_session, content, metadata):
+    if content.startswith('slow'):
+        await asyncio.sleep(5)
+    return f'Re: {content}'
+
+
+@override_settings(CHAT_TURN_POLICY='supersede', CHAT_STREAMING_DEFAULT=False)
+@mock.patch.object(AIService, 'agenerate_response', fake_reply)
+class SupersededTurnTests(ChatTransactionTestCase):
+    async def frames(self, communicator, count):
+        return [await communicator.receive_json_from(timeout=5) for _ in range(count)]
+
+    async def test_superseded_message_is_told_no_reply_is_coming(self):
+        communicator = self.connect()
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'message', 'content': 'slow question'})
+        first = (await self.frames(communicator, 1))[0]['message']
+        await communicator.send_json_to({'type': 'message', 'content': 'Never mind'})
+
+        superseded, user, reply = await self.frames(communicator, 3)
+        self.assertEqual(superseded, {'type': 'superseded', 'reply_to': first['id']})
+        self.assertEqual(user['message']['content'], 'Never mind')
+        self.assertEqual(reply['message']['content'], 'Re: Never mind')
+        await communicator.disconnect()
+
+    async def test_reply_saved_while_superseded_is_delivered(self):
+        saving = asyncio.Event()
+
+        def slow_save(chat_session, message_type, content, *args, **kwargs):
+            if content == 'Re: first':
+                saving.set()
+                time.sleep(0.3)
+            return save_message(chat_session, message_type, content, *args, **kwargs)
+
+        communicator = self.connect()
+        await communicator.connect()
+        with mock.patch('chatbot.consumers.save_message', side_effect=slow_save):
+            await communicator.send_json_to({'type': 'message', 'content': 'first'})
+            await asyncio.wait_for(saving.wait(), 5)
+            await communicator.send_json_to({'type': 'message', 'content': 'second'})
+            frames = await self.frames(communicator, 4)
+
+        contents = [frame['message']['content'] for frame in frames]
+        self.assertEqual(contents, ['first', 'Re: first', 'second', 'Re: second'])
+        await communicator.disconnect()
+
+
+class WebSocketSummaryTests(ChatTransactionTestCase):
+    async def test_summary_written_after_connect_reaches_the_prompt(self):
+        prompts = []
+        build = ContextBuilder.build
+
+        def record(builder, chat_session, user_message):
+            prompts.append(build(builder, chat_session, user_message))
+            return prompts[-1]
+
+        communicator = self.connect()
+        await communicator.connect()
+        old = await database_sync_to_async(save_message)(self.chat_session, 'user', 'My badge is broken')
+        await database_sync_to_async(ChatSession.objects.filter(pk=self.chat_session.pk).update)(
+            context_summary='Employee reported a broken badge.', context_summary_upto=old.id
+        )
+
+        with mock.patch.object(ContextBuilder, 'build', record):
+            await communicator.send_json_to({'type': 'message', 'content': 'Any news?'})
+            for _ in range(2):
+                await communicator.receive_json_from(timeout=5)
+
+        contents = [message['content'] for message in prompts[0]]
+        self.assertIn(SUMMARY_PREFIX + 'Employee reported a broken badge.', contents)
+        self.assertNotIn('My badge is broken', contents)
+        await communicator.disconnect()
+
+
+class EndSessionNotificationTests(ChatTestCase):
+    def saves_notifying(self, save):
+        with mock.patch('chatbot.consumers.end_session_sockets') as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                save()
+        return notify.call_count
+
+    def test_only_ending_an_active_session_notifies_sockets(self):
+        chat_session = ChatSession.objects.get(pk=self.chat_session.pk)
+        chat_session.is_active = False
+        self.assertEqual(self.saves_notifying(chat_session.save), 1)
+        # Later edits to the ended session, fresh from the database or not
+        chat_session.title = 'Badge problem'
+        self.assertEqual(self.saves_notifying(chat_session.save), 0)
+        reloaded = ChatSession.objects.get(pk=self.chat_session.pk)
+        reloaded.title = 'Badge replaced'
+        self.assertEqual(self.saves_notifying(reloaded.save), 0)
+
+    def test_end_session_endpoint_notifies_sockets(self):
+        notified = self.saves_notifying(lambda: self.client.post(self.session_url('end_session')))
+        self.assertEqual(notified, 1)
+
+
+class SessionListQueryCountTests(ChatTestCase):
+    def add_sessions(self, count):
+        sessions = ChatSession.objects.bulk_create(
+            ChatSession(user=self.user, session_id=uuid.uuid4()) for _ in range(count)
+        )
+        Message.objects.bulk_create(
+            Message(chat_session=session, message_type=message_type, content=f'{message_type} message')
+            for session in sessions for message_type in ('user', 'assistant')
+        )
+
+    def test_list_queries_do_not_grow_with_the_page(self):
+        self.chat_session.delete()
+        # COUNT for the paginator, the annotated page, then the last messages
+        for total in (1, 5, 20):
+            self.add_sessions(total - ChatSession.objects.count())
+            with self.subTest(sessions=total), self.assertNumQueries(3):
+                response = self.client.get('/api/v1/chat/sessions/')
+            self.assertEqual(len(response.data['results']), total)
+            self.assertEqual(response.data['results'][0]['message_count'], 2)
+            self.assertIsNotNone(response.data['results'][-1]['last_message'])
+
+
+class MessagePaginationTests(ChatTestCase):
+    def test_malformed_cursor_is_a_bad_request(self):
+        overflow = base64.urlsafe_b64encode(b'2024-01-01T00:00:00+00:00|99999999999999999999').decode()
+        for param, cursor in (('before', 'not-a-cursor'), ('after', 'bm90aGluZw=='), ('before', overflow)):
+            with self.subTest(param=param, cursor=cursor):
+                response = self.client.get(self.session_url('messages'), {param: cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(param, response.data)
+
+    def test_cursor_walks_back_through_history(self):
+        Message.objects.bulk_create(
+            Message(chat_session=self.chat_session, message_type='user', content=f'message {i}')
+            for i in range(5)
+        )
+        newest = self.client.get(self.session_url('messages'), {'limit': 3})
+        older = self.client.get(self.session_url('messages'), {'limit': 3, 'before': newest.data['before']})
+        self.assertEqual(older.status_code, 200)
+        self.assertEqual([m['content'] for m in older.data['results']], ['message 0', 'message 1'])
+
+
+class AnalyticsOnReplyTests(ChatTestCase):
+    @override_settings(CHAT_ANALYTICS_ON_REPLY=True)
+    def test_saving_a_reply_folds_it_into_the_analytics(self):
+        for turn in range(2):
+            question = save_message(self.chat_session, 'user', f'Question {turn}', touch_session=False)
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                save_message(self.chat_session, 'assistant', f'Answer {turn}', {
+                    'reply_to': question.id, 'generation_ms': 1500.0 + 1000 * turn,
+                    'prompt_tokens': 100, 'completion_tokens': 20,
+                })
+            self.assertEqual(len(callbacks), 1)
+
+        analytics = ChatAnalytics.objects.get(chat_session=self.chat_session)
+        self.assertEqual(analytics.total_messages, 4)
+        self.assertEqual(analytics.assistant_messages, 2)
+        self.assertEqual(analytics.response_count, 2)
+        self.assertAlmostEqual(analytics.average_response_time, 2.0)
+        self.assertEqual(analytics.completion_tokens, 40)
+
+    def test_run_that_loses_the_insert_race_uses_the_winners_row(self):
+        save_message(self.chat_session, 'user', 'Hello')
+        # Another run inserts the row after this one looked for it
+        ChatAnalytics.objects.create(chat_session=self.chat_session)
+        misses = [ChatAnalytics.DoesNotExist]
+        real_get = QuerySet.get
+
+        def get(queryset, *args, **kwargs):
+            if queryset.model is ChatAnalytics and misses:
+                raise misses.pop()
+            return real_get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', get), mock.patch('chatbot.tasks.logger') as task_logger:
+            update_chat_analytics(self.chat_session.pk, incremental=True)
+        task_logger.error.assert_not_called()
+        analytics = ChatAnalytics.objects.get(chat_session=self.chat_session)
+        self.assertEqual(analytics.total_messages, 1)
+
+    def test_user_messages_do_not_queue_an_update(self):
+        with self.settings(CHAT_ANALYTICS_ON_REPLY=True), self.captureOnCommitCallbacks() as callbacks:
+            save_message(self.chat_session, 'user', 'Hello')
+        self.assertEqual(callbacks, [])
+
+
+class MetricsRollupTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.day = timezone.make_aware(datetime(2024, 1, 15))
+
+    def add_reply(self, hour, generation_ms, **metadata):
+        created_at = self.day + timedelta(hours=hour, minutes=5)
+        for message_type, extra in (('user', {}), ('assistant', {'generation_ms': generation_ms, **metadata})):
+            message = Message.objects.create(
+                chat_session=self.chat_session, message_type=message_type, content='...', metadata=extra
+            )
+            Message.objects.filter(id=message.id).update(created_at=created_at)
+
+    def test_days_are_summed_from_hours(self):
+        # One reply at 9:00, three at 14:00: the day's mean weighs every reply alike
+        self.add_reply(9, 4000, prompt_tokens=100, completion_tokens=10)
+        for _ in range(3):
+            self.add_reply(14, 2000, prompt_tokens=50, completion_tokens=5, cache_hit=True)
+
+        end = self.day + timedelta(days=1)
+        hours = {row.bucket_start.hour: row for row in rollup_range(self.day, end, 'hour')}
+        with self.assertNumQueries(2):
+            day = rollup_range(self.day, end, 'day')[0]
+
+        self.assertAlmostEqual(hours[9].average_response_time, 4.0)
+        self.assertAlmostEqual(hours[14].average_response_time, 2.0)
+        self.assertEqual(day.total_messages, 8)
+        self.assertEqual(day.response_count, 4)
+        self.assertAlmostEqual(day.average_response_time, 2.5)
+        self.assertEqual(day.prompt_tokens, 250)
+        self.assertEqual(day.completion_tokens, 25)
+        self.assertEqual(day.cache_hits, 3)
+
+    def test_refresh_only_scans_recent_hours(self):
+        self.add_reply(9, 1000)
+        rollup_range(self.day, self.day + timedelta(days=1), 'hour')
+        self.add_reply(9, 1000)  # Late write to an hour the refresh no longer covers
+
+        refresh_recent_rollups(now=self.day + timedelta(hours=20, minutes=30))
+        day = ChatMetricsRollup.objects.get(period='day', bucket_start=self.day)
+        self.assertEqual(day.assistant_messages, 1)
+
+    def test_bad_filters_are_rejected(self):
+        self.user.is_staff = True
+        self.user.save()
+        url = '/api/v1/chat/rollups/'
+        self.assertEqual(self.client.get(url, {'start': '2024-01-01', 'end': '2024-01-02T00:00:00Z'}).status_code, 200)
+        for params in ({'start': 'yesterday'}, {'end': '2024-13-01'}, {'period': 'week'}):
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(next(iter(params)), response.data)
+
+
+class RateLimitTests(SimpleTestCase):
+    """The limiter's Redis scripts are stubbed: buckets always grant, slots never free up"""
+
+    def setUp(self):
+        self.redis = mock.Mock()
+        self.redis.eval.side_effect = lambda script, *args: {
+            rate_limit.TOKEN_BUCKET_SCRIPT: '0',
+            rate_limit.SEMAPHORE_SCRIPT: self.slot_free,
+        }.get(script, 1)
+        for patcher in (
+            mock.patch.object(rate_limit, '_redis', return_value=self.redis),
+            # Renewer threads left sleeping by other tests must not stand in
+            mock.patch.object(rate_limit, '_renewer', None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.config = SimpleNamespace(
+            max_concurrent_requests=1, requests_per_minute=60, user_requests_per_minute=0, queue_timeout=0.1
+        )
+
+    def scripts(self):
+        return [call.args[0] for call in self.redis.eval.call_args_list]
+
+    def test_token_is_refunded_when_no_slot_frees_up(self):
+        self.slot_free = 0
+        with self.assertRaises(rate_limit.QueueTimeout):
+            with rate_limit.limit(self.config, user_id=1):
+                pass
+        self.assertEqual(self.scripts().count(rate_limit.TOKEN_BUCKET_SCRIPT), 1)
+        self.assertEqual(self.scripts()[-1], rate_limit.REFUND_SCRIPT)
+
+    async def test_cancelled_wait_gives_back_slot_and_token(self):
+        # Cancelled while its poll is taking a slot in a worker thread
+        members = set()
+
+        def take_slot(*args):
+            time.sleep(0.2)
+            members.add(args[-1])
+            return 1
+
+        self.redis.eval.side_effect = lambda script, *args: {
+            rate_limit.TOKEN_BUCKET_SCRIPT: lambda: '0',
+            rate_limit.SEMAPHORE_SCRIPT: lambda: take_slot(*args),
+        }.get(script, lambda: 1)()
+        self.redis.zrem.side_effect = lambda key, token: members.discard(token)
+
+        async def turn():
+            async with rate_limit.alimit(self.config, user_id=1):
+                self.fail('admitted after cancellation')
+
+        task = asyncio.create_task(turn())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(members, set())
+        self.assertEqual(rate_limit._held, set())
+        self.assertIn(rate_limit.REFUND_SCRIPT, self.scripts())
+
+    @override_settings(LLM_LIMITER_LEASE=0.06)
+    def test_held_slot_is_renewed_until_released(self):
+        self.slot_free = 1
+        with rate_limit.limit(self.config, user_id=1):
+            time.sleep(0.1)
+            self.assertIn(rate_limit.RENEW_SCRIPT, self.scripts())
+            token = next(iter(rate_limit._held))
+        self.redis.zrem.assert_called_once_with(rate_limit.SEMAPHORE_KEY, token)
+        self.assertNotIn(token, rate_limit._held)
+        self.assertNotIn(rate_limit.REFUND_SCRIPT, self.scripts())
+
+
+class KnowledgeIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.index = tempfile.TemporaryDirectory()
+        self.addCleanup(self.source.cleanup)
+        self.addCleanup(self.index.cleanup)
+
+    def reindex(self, text):
+        with open(os.path.join(self.source.name, 'vpn.md'), 'w') as f:
+            f.write(text)
+        knowledge.build_index(self.source.name, self.index.name)
+        return knowledge._read_manifest(self.index.name)
+
+    def test_replaced_generation_outlives_one_reindex(self):
+        # A worker that read this manifest before the next swap can still map it
+        stale = self.reindex('Connect to the VPN with the company client.')
+        self.reindex('Connect to the VPN with the new client.')
+        index = knowledge.KnowledgeIndex(self.index.name, stale)
+        self.assertEqual(index.search('VPN client', 1)[0][1]['source'], 'vpn.md')
+
+        self.reindex('The VPN is retired.')
+        self.assertEqual(len([n for n in os.listdir(self.index.name) if n.startswith('vectors-')]), 2)
+        with self.assertRaises(FileNotFoundError):
+            knowledge.KnowledgeIndex(self.index.name, stale)
+
+    def test_load_rereads_a_manifest_replaced_midway(self):
+        stale = self.reindex('Badges are issued at reception.')
+        for text in ('Badges are issued by security.', 'Badges are issued online.'):
+            current = self.reindex(text)
+        manifests = iter([stale, current])
+        with mock.patch.object(knowledge, '_read_manifest', side_effect=lambda directory: next(manifests)):
+            index = knowledge.KnowledgeIndex.load(self.index.name)
+        self.assertEqual(index.manifest['vectors'], current['vectors'])
+
+
+@mock.patch.dict(context._encodings, clear=True)
+@mock.patch.dict(context._encoding_failures, clear=True)
+class TokenizerTests(SimpleTestCase):
+    def test_failed_tokenizer_load_is_retried(self):
+        tokenizer = mock.Mock(**{'encode.return_value': [1, 2]})
+        fake = mock.Mock(**{'encoding_for_model.side_effect': [OSError('offline'), tokenizer]})
+        with mock.patch.object(context, 'tiktoken', fake):
+            self.assertEqual(context.count_tokens('x' * 40), 11)
+            with mock.patch.object(context, 'TOKENIZER_RETRY_SECONDS', 0):
+                self.assertEqual(context.count_tokens('x' * 40), 2)
+            self.assertEqual(context.count_tokens('x' * 40), 2)
+        self.assertEqual(fake.encoding_for_model.call_count, 2)
+
+
+class SingleFlightKeyTests(SimpleTestCase):
+    def test_only_identical_requests_share_a_flight(self):
+        config = SimpleNamespace(pk=1, model_name='gpt-4', temperature=0.7, max_tokens=1000,
+                                 updated_at=None, response_cache_enabled=True)
+
+        def prompt(question):
+            return [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': question}]
+
+        key = single_flight.flight_key(config, prompt('How do I reset my password?'))
+        self.assertEqual(key, single_flight.flight_key(config, prompt('How do I reset my password?')))
+        # The response cache treats these as one prompt; the upstream call does not
+        variant = prompt('how do I reset my password')
+        self.assertEqual(response_cache.make_key(config, variant),
+                         response_cache.make_key(config, prompt('How do I reset my password?')))
+        self.assertNotEqual(key, single_flight.flight_key(config, variant))
+        self.assertNotEqual(key, single_flight.flight_key(
+            SimpleNamespace(**{**vars(config), 'temperature': 0.2}), prompt('How do I reset my password?')
+        ))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = providers.ProviderPool([{'name': 'primary'}])
+        self.endpoint = self.pool.endpoints[0]
+        # Cooled down: the next call is the half-open trial
+        self.endpoint.breaker.state = providers.CircuitBreaker.OPEN
+        self.endpoint.breaker.opened_at = time.monotonic() - 3600
+
+        async def hang(**kwargs):
+            await asyncio.sleep(5)
+
+        client = mock.Mock()
+        client.chat.completions.create = hang
+        self.endpoint.async_client = mock.Mock(return_value=client)
+
+    async def cancel_trial(self, call):
+        task = asyncio.create_task(call)
+        await asyncio.sleep(0.05)
+        self.assertFalse(self.endpoint.breaker.available())
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test_cancelled_trial_is_given_back(self):
+        await self.cancel_trial(self.pool.acomplete(None, []))
+        self.assertEqual(self.endpoint.breaker.state, providers.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.endpoint.breaker.available())
+        self.assertEqual(self.endpoint.breaker.failures, 0)
+
+    async def test_stream_cancelled_before_it_opens_gives_back_trial(self):
+        async def consume():
+            async for _ in self.pool.astream(None, []):
+                pass
+
+        await self.cancel_trial(consume())
+        self.assertTrue(self.endpoint.breaker.available())
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger('chatbot')
+
+QUEUE, SUPERSEDE = 'queue', 'supersede'
+
+_stats_lock = threading.Lock()
+_stats = {
+    'turns': 0, 'queued': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+    'superseded': 0, 'cancelled': 0, 'dropped': 0,
+}
+
+
+def _count(key, amount=1):
+    if amount:
+        with _stats_lock:
+            _stats[key] += amount
+        metrics.count_event('turns', key, amount)
+
+
+class TurnQueue:
+    """Runs one connection's chat turns one at a time.
+
+    With CHAT_TURN_POLICY ``queue`` a message sent while a reply is being
+    generated waits for it, up to CHAT_TURN_QUEUE_LIMIT waiting turns. With
+    ``supersede`` it cancels the generation in flight and any waiting turns,
+    so only the latest message is answered. ``cancel()`` aborts everything
+    when the socket goes away; cancelling the task closes the upstream
+    request, so no tokens are paid for a reply nobody will read.
+    """
+
+    def __init__(self, handler, on_error, policy=None, limit=None):
+        self.handler = handler
+        self.on_error = on_error
+        self.policy = policy or settings.CHAT_TURN_POLICY
+        self.limit = settings.CHAT_TURN_QUEUE_LIMIT if limit is None else limit
+        self.pending = deque()
+        self.current = None
+        self.worker = None
+        self.closed = False
+
+    @property
+    def busy(self) -> bool:
+        return self.current is not None and not self.current.done()
+
+    def submit(self, data) -> bool:
+        """Schedule a turn; False when the queue is full and it was rejected"""
+        if self.policy == SUPERSEDE:
+            _count('dropped', len(self.pending))
+            self.pending.clear()
+            if self.busy:
+                self.current.cancel()
+                _count('superseded')
+        elif len(self.pending) >= self.limit:
+            _count('rejected')
+            return False
+
+        if self.busy or self.pending:
+            _count('queued')
+        _count('turns')
+        self.pending.append(data)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        while self.pending and not self.closed:
+            started = time.perf_counter()
+            outcome = 'completed'
+            self.current = asyncio.create_task(self.handler(self.pending.popleft()))
+            try:
+                await self.current
+                _count('completed')
+            except asyncio.CancelledError:
+                outcome = 'cancelled' if self.closed else 'superseded'
+                if self.closed:
+                    raise
+            except Exception as e:
+                outcome = 'failed'
+                _count('failed')
+                logger.error(f"Error handling chat turn: {str(e)}")
+                await self.on_error(e)
+            finally:
+                self.current = None
+                metrics.WEBSOCKET_TURN_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+    def cancel(self):
+        """Abort the turn in flight and drop waiting ones"""
+        self.closed = True
+        _count('dropped', len(self.pending))
+        self.pending.clear()
+        if self.busy:
+            self.current.cancel()
+            _count('cancelled')
+        if self.worker is not None:
+            self.worker.cancel()
+
+
+def stats() -> dict:
+    """Turn scheduling counters for this worker process.
+
+    ``superseded`` and ``cancelled`` count generations aborted mid-flight,
+    ``dropped`` the waiting turns discarded before they started.
+    """
+    with _stats_lock:
+        return dict(_stats)
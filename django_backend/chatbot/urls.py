@@ -6,6 +6,7 @@ router = DefaultRouter()
 router.register(r'sessions', views.ChatSessionViewSet, basename='chat-session')
 router.register(r'messages', views.MessageViewSet, basename='message')
 router.register(r'config', views.AIConfigurationViewSet, basename='ai-config')
+router.register(r'rollups', views.ChatMetricsRollupViewSet, basename='metrics-rollup')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,16 +1,34 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.reverse import reverse
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.result import AsyncResult
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404
-from .models import ChatSession, Message, AIConfiguration, ChatAnalytics
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import ChatSession, Message, AIConfiguration, ChatAnalytics, ChatMetricsRollup
 from .serializers import (
     ChatSessionSerializer, ChatSessionListSerializer,
-    MessageSerializer, AIConfigurationSerializer, ChatAnalyticsSerializer
+    MessageSerializer, AIConfigurationSerializer, ChatAnalyticsSerializer,
+    ChatMetricsRollupSerializer, MessageSearchResultSerializer
 )
+from .pagination import MessageKeysetPagination, SearchResultPagination
+from .search import rank_messages
+from .persistence import save_message
 from .services import AIService
+from .tasks import generate_assistant_reply
+from datetime import datetime, time
+import logging
 import uuid
 
+logger = logging.getLogger('chatbot')
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def test_ai_connection(request):
@@ -19,18 +37,61 @@ def test_ai_connection(request):
     result = ai_service.test_connection()
     return Response(result)
 
+def with_message_count(queryset):
+    """Annotate message_count with a correlated COUNT subquery"""
+    session_messages = Message.objects.filter(chat_session=OuterRef('pk')).order_by()
+    return queryset.annotate(
+        message_count=Coalesce(
+            Subquery(
+                session_messages.values('chat_session')
+                .annotate(count=Count('id')).values('count')
+            ),
+            0
+        )
+    )
+
+def with_last_message_id(queryset):
+    """Annotate last_message_id with a correlated ORDER BY ... LIMIT 1 subquery"""
+    return queryset.annotate(
+        last_message_id=Subquery(
+            Message.objects.filter(chat_session=OuterRef('pk'))
+            .order_by('-created_at', '-id').values('id')[:1]
+        )
+    )
+
 class ChatSessionViewSet(viewsets.ModelViewSet):
     serializer_class = ChatSessionSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return ChatSession.objects.filter(user=self.request.user)
+        queryset = ChatSession.objects.filter(user=self.request.user)
+        if self.action in ('list', 'retrieve'):
+            queryset = with_message_count(queryset)
+        if self.action == 'list':
+            queryset = with_last_message_id(queryset)
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'list':
             return ChatSessionListSerializer
         return ChatSessionSerializer
 
+    def list(self, request, *args, **kwargs):
+        # Counts and last-message ids come from the annotated page query;
+        # the last messages themselves are then loaded in one query.
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        sessions = page if page is not None else list(queryset)
+
+        last_message_ids = [s.last_message_id for s in sessions if s.last_message_id]
+        context = self.get_serializer_context()
+        context['last_messages'] = Message.objects.in_bulk(last_message_ids)
+
+        serializer = ChatSessionListSerializer(sessions, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
         serializer.save(
             user=self.request.user,
@@ -45,44 +106,105 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
         if not content:
             return Response({'error': 'Message content is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Create user message
-        user_message = Message.objects.create(
-            chat_session=chat_session,
-            message_type='user',
-            content=content
-        )
+        # Create user message; the reply below bumps the session timestamp
+        user_message = save_message(chat_session, 'user', content, touch_session=False)
 
         # Get AI response
         ai_service = AIService()
-        ai_response = ai_service.generate_response(chat_session, content)
+        metadata = {'reply_to': user_message.id}
+        ai_response = ai_service.generate_response(chat_session, content, metadata)
+
+        # Create assistant message and update the chat session timestamp
+        assistant_message = save_message(chat_session, 'assistant', ai_response, metadata)
+
+        return Response({
+            'user_message': MessageSerializer(user_message).data,
+            'assistant_message': MessageSerializer(assistant_message).data
+        })
+
+    @action(detail=True, methods=['post'])
+    def send_message_async(self, request, pk=None):
+        """Store the user message and queue generation; returns 202 with a job id"""
+        chat_session = self.get_object()
+        content = request.data.get('content', '')
 
-        # Create assistant message
-        assistant_message = Message.objects.create(
-            chat_session=chat_session,
-            message_type='assistant',
-            content=ai_response
+        if not content:
+            return Response({'error': 'Message content is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        job_id = str(uuid.uuid4())
+        user_message = save_message(
+            chat_session, 'user', content, {'job_id': job_id}, touch_session=False
+        )
+
+        try:
+            generate_assistant_reply.apply_async(
+                args=[chat_session.id, user_message.id], task_id=job_id
+            )
+        except Exception as e:
+            logger.error(f"Could not queue reply generation: {str(e)}")
+            return Response(
+                {'error': 'Message queue unavailable, please retry'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+
+        status_url = reverse('chat-session-job', kwargs={'pk': chat_session.pk, 'job_id': job_id})
+        return Response(
+            {
+                'job_id': job_id,
+                'status': 'pending',
+                'status_url': status_url,
+                'user_message': MessageSerializer(user_message).data
+            },
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': status_url}
         )
 
-        # Update chat session
-        chat_session.save()
+    @action(detail=True, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9a-f-]+)', url_name='job')
+    def job(self, request, pk=None, job_id=None):
+        """Poll a send_message_async job; ?wait=N long-polls for up to N seconds"""
+        chat_session = self.get_object()
+        if not chat_session.messages.filter(message_type='user', metadata__job_id=job_id).exists():
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), settings.SEND_MESSAGE_LONG_POLL_MAX_WAIT)
+        except ValueError:
+            return Response({'error': 'wait must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = AsyncResult(job_id)
+        if wait > 0 and not result.ready():
+            try:
+                result.get(timeout=wait, propagate=False)
+            except CeleryTimeoutError:
+                pass
+
+        if not result.ready():
+            return Response({'job_id': job_id, 'status': 'pending'}, status=status.HTTP_202_ACCEPTED)
+        if not result.successful() or not result.result:
+            return Response({'job_id': job_id, 'status': 'failed'})
 
+        assistant_message = get_object_or_404(
+            chat_session.messages, id=result.result['assistant_message_id']
+        )
         return Response({
-            'user_message': MessageSerializer(user_message).data,
+            'job_id': job_id,
+            'status': 'completed',
             'assistant_message': MessageSerializer(assistant_message).data
         })
 
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
         chat_session = self.get_object()
-        messages = chat_session.messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        paginator = MessageKeysetPagination()
+        page = paginator.paginate_queryset(chat_session.messages.all(), request, view=self)
+        serializer = MessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['post'])
     def end_session(self, request, pk=None):
         chat_session = self.get_object()
         chat_session.is_active = False
-        chat_session.save()
+        chat_session.save(update_fields=['is_active', 'updated_at'])
         return Response({'message': 'Chat session ended'})
 
 class MessageViewSet(viewsets.ReadOnlyModelViewSet):
@@ -92,6 +214,19 @@ class MessageViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         return Message.objects.filter(chat_session__user=self.request.user)
 
+    @action(detail=False)
+    def search(self, request):
+        """Ranked full-text search over the user's own messages: ?q=&page=&limit="""
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This query parameter is required.'})
+
+        queryset = rank_messages(self.get_queryset().select_related('chat_session'), query)
+        paginator = SearchResultPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = MessageSearchResultSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
 class AIConfigurationViewSet(viewsets.ModelViewSet):
     queryset = AIConfiguration.objects.all()
     serializer_class = AIConfigurationSerializer
@@ -103,4 +238,40 @@ class AIConfigurationViewSet(viewsets.ModelViewSet):
         if config:
             serializer = self.get_serializer(config)
             return Response(serializer.data)
-        return Response({'error': 'No active configuration found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        return Response({'error': 'No active configuration found'}, status=status.HTTP_404_NOT_FOUND)
+
+class ChatMetricsRollupViewSet(viewsets.ReadOnlyModelViewSet):
+    """Precomputed hourly/daily chat volume; filter with ?period=&start=&end="""
+    serializer_class = ChatMetricsRollupSerializer
+    permission_classes = [IsAdminUser]
+
+    def get_queryset(self):
+        period = self.request.query_params.get('period', 'day')
+        if period not in dict(ChatMetricsRollup.PERIODS):
+            raise ValidationError({'period': 'Expected hour or day.'})
+        queryset = ChatMetricsRollup.objects.filter(period=period)
+        start = self.parse_bound('start')
+        end = self.parse_bound('end')
+        if start:
+            queryset = queryset.filter(bucket_start__gte=start)
+        if end:
+            queryset = queryset.filter(bucket_start__lt=end)
+        return queryset
+
+    def parse_bound(self, param):
+        """An ISO date (local midnight) or timestamp from the query string, or None"""
+        value = self.request.query_params.get(param)
+        if not value:
+            return None
+        try:
+            moment = parse_datetime(value)
+            if moment is None:
+                day = parse_date(value)
+                moment = datetime.combine(day, time.min) if day else None
+        except ValueError:
+            moment = None
+        if moment is None:
+            raise ValidationError({param: 'Expected an ISO date or timestamp.'})
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment
\ No newline at end of file
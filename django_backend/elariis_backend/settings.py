@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 from decouple import config
@@ -22,7 +23,9 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
+    'rest_framework.authtoken',
     'corsheaders',
     'channels',
     'accounts',
@@ -31,6 +34,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'chatbot.metrics.DatabaseTimeMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -74,6 +78,8 @@ DATABASES = {
     }
 }
 
+AUTH_USER_MODEL = 'accounts.User'
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -124,6 +130,15 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Message history pages (keyset pagination on created_at, id)
+MESSAGE_PAGE_SIZE = config('MESSAGE_PAGE_SIZE', default=50, cast=int)
+MESSAGE_PAGE_SIZE_MAX = config('MESSAGE_PAGE_SIZE_MAX', default=200, cast=int)
+
+# Full-text search over chat history (PostgreSQL text search configuration)
+CHAT_SEARCH_CONFIG = config('CHAT_SEARCH_CONFIG', default='english')
+SEARCH_PAGE_SIZE = config('SEARCH_PAGE_SIZE', default=20, cast=int)
+SEARCH_PAGE_SIZE_MAX = config('SEARCH_PAGE_SIZE_MAX', default=100, cast=int)
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -144,6 +159,14 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('REDIS_URL', default='redis://localhost:6379'),
+    }
+}
+
 # Celery Configuration
 CELERY_BROKER_URL = config('REDIS_URL', default='redis://localhost:6379')
 CELERY_RESULT_BACKEND = config('REDIS_URL', default='redis://localhost:6379')
@@ -151,6 +174,26 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    'update-metrics-rollups': {
+        'task': 'chatbot.tasks.update_metrics_rollups',
+        'schedule': config('METRICS_ROLLUP_INTERVAL', default=300, cast=int),
+    },
+}
+
+# Queue an incremental analytics update after every assistant reply
+CHAT_ANALYTICS_ON_REPLY = config('CHAT_ANALYTICS_ON_REPLY', default=True, cast=bool)
+
+# Session cleanup
+SESSION_RETENTION_DAYS = config('SESSION_RETENTION_DAYS', default=30, cast=int)
+CLEANUP_BATCH_SIZE = config('CLEANUP_BATCH_SIZE', default=500, cast=int)
+CLEANUP_MESSAGE_BATCH_SIZE = config('CLEANUP_MESSAGE_BATCH_SIZE', default=5000, cast=int)
+CLEANUP_BATCH_PAUSE = config('CLEANUP_BATCH_PAUSE', default=0.1, cast=float)
+CHAT_ARCHIVE_ENABLED = config('CHAT_ARCHIVE_ENABLED', default=False, cast=bool)
+CHAT_ARCHIVE_DIR = config('CHAT_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'archive'))
+
+# Upper bound for ?wait= on send_message_async job polling, in seconds
+SEND_MESSAGE_LONG_POLL_MAX_WAIT = config('SEND_MESSAGE_LONG_POLL_MAX_WAIT', default=20, cast=int)
 
 # OpenAI Configuration
 OPENAI_API_KEY = config('OPENAI_API_KEY', default='')
@@ -161,6 +204,98 @@ AZURE_OPENAI_ENDPOINT = config('AZURE_OPENAI_ENDPOINT', default='')
 AZURE_OPENAI_API_VERSION = config('AZURE_OPENAI_API_VERSION', default='2024-02-15-preview')
 AZURE_OPENAI_DEPLOYMENT_NAME = config('AZURE_OPENAI_DEPLOYMENT_NAME', default='gpt-4')
 
+# LLM HTTP client
+# One keep-alive connection pool is shared by every request in a process
+LLM_HTTP_MAX_CONNECTIONS = config('LLM_HTTP_MAX_CONNECTIONS', default=100, cast=int)
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = config('LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', default=20, cast=int)
+LLM_HTTP_KEEPALIVE_EXPIRY = config('LLM_HTTP_KEEPALIVE_EXPIRY', default=30.0, cast=float)
+LLM_HTTP_CONNECT_TIMEOUT = config('LLM_HTTP_CONNECT_TIMEOUT', default=5.0, cast=float)
+LLM_HTTP_READ_TIMEOUT = config('LLM_HTTP_READ_TIMEOUT', default=60.0, cast=float)
+
+# LLM provider pool
+# JSON list of endpoints, e.g. [{"name": "east", "type": "azure", "endpoint": "...",
+# "api_key": "...", "deployment": "gpt-4", "weight": 2}, {"name": "openai",
+# "type": "openai", "api_key": "...", "fallback": true}]. Empty uses the
+# Azure/OpenAI settings above, with OpenAI as the fallback.
+LLM_ENDPOINTS = config('LLM_ENDPOINTS', default='[]', cast=json.loads)
+# 'least_outstanding' or 'weighted'
+LLM_ROUTING = config('LLM_ROUTING', default='least_outstanding')
+# Retries for rate-limit, connection and 5xx errors, across endpoints
+LLM_MAX_RETRIES = config('LLM_MAX_RETRIES', default=2, cast=int)
+LLM_RETRY_BACKOFF_BASE = config('LLM_RETRY_BACKOFF_BASE', default=0.5, cast=float)
+LLM_RETRY_BACKOFF_MAX = config('LLM_RETRY_BACKOFF_MAX', default=8.0, cast=float)
+# Consecutive failures that open an endpoint's circuit, and seconds it stays open
+LLM_BREAKER_FAILURES = config('LLM_BREAKER_FAILURES', default=5, cast=int)
+LLM_BREAKER_COOLDOWN = config('LLM_BREAKER_COOLDOWN', default=30.0, cast=float)
+
+# Seconds a worker may serve its cached AIConfiguration before checking
+# the shared version key for changes made by other workers
+AI_CONFIG_CACHE_CHECK_INTERVAL = config('AI_CONFIG_CACHE_CHECK_INTERVAL', default=5.0, cast=float)
+# Same bound for the compiled fallback intent matcher
+INTENT_CACHE_CHECK_INTERVAL = config('INTENT_CACHE_CHECK_INTERVAL', default=5.0, cast=float)
+
+# Cluster-wide LLM limiter (limits are set per AIConfiguration)
+LLM_LIMITER_REDIS_URL = config('REDIS_URL', default='redis://localhost:6379')
+# Seconds a concurrency slot is held if its worker dies without releasing it;
+# live workers renew their slots every third of this
+LLM_LIMITER_LEASE = config('LLM_LIMITER_LEASE', default=120.0, cast=float)
+# Seconds between attempts while waiting for a free concurrency slot
+LLM_LIMITER_POLL_INTERVAL = config('LLM_LIMITER_POLL_INTERVAL', default=0.05, cast=float)
+# Token buckets hold this many seconds' worth of requests as burst
+LLM_RATE_LIMIT_BURST_SECONDS = config('LLM_RATE_LIMIT_BURST_SECONDS', default=10.0, cast=float)
+
+# Conversation context
+# Model context window in tokens; 0 derives it from the model name
+LLM_CONTEXT_WINDOW = config('LLM_CONTEXT_WINDOW', default=0, cast=int)
+# Most recent messages considered for the prompt before token packing
+CONTEXT_MAX_HISTORY_MESSAGES = config('CONTEXT_MAX_HISTORY_MESSAGES', default=50, cast=int)
+# Size of the rolling summary that replaces turns which no longer fit
+CONTEXT_SUMMARY_MAX_TOKENS = config('CONTEXT_SUMMARY_MAX_TOKENS', default=300, cast=int)
+
+# Knowledge base (see `manage.py index_knowledge`)
+KNOWLEDGE_BASE_DIR = config('KNOWLEDGE_BASE_DIR', default=os.path.join(BASE_DIR, 'knowledge'))
+KNOWLEDGE_INDEX_DIR = config('KNOWLEDGE_INDEX_DIR', default=os.path.join(BASE_DIR, 'knowledge_index'))
+KNOWLEDGE_VECTOR_DIMENSIONS = config('KNOWLEDGE_VECTOR_DIMENSIONS', default=2048, cast=int)
+KNOWLEDGE_CHUNK_WORDS = config('KNOWLEDGE_CHUNK_WORDS', default=180, cast=int)
+KNOWLEDGE_CHUNK_OVERLAP = config('KNOWLEDGE_CHUNK_OVERLAP', default=30, cast=int)
+KNOWLEDGE_TOP_K = config('KNOWLEDGE_TOP_K', default=4, cast=int)
+KNOWLEDGE_MIN_SCORE = config('KNOWLEDGE_MIN_SCORE', default=0.05, cast=float)
+# Token budget for passages added to the system prompt
+KNOWLEDGE_MAX_CONTEXT_TOKENS = config('KNOWLEDGE_MAX_CONTEXT_TOKENS', default=800, cast=int)
+# Seconds between checks for a rebuilt index
+KNOWLEDGE_RELOAD_INTERVAL = config('KNOWLEDGE_RELOAD_INTERVAL', default=10.0, cast=float)
+
+# Response cache (enabled per AIConfiguration)
+# In-process LRU tier in front of Redis; entries live at most this long locally
+RESPONSE_CACHE_LOCAL_MAX_ENTRIES = config('RESPONSE_CACHE_LOCAL_MAX_ENTRIES', default=1024, cast=int)
+RESPONSE_CACHE_LOCAL_TTL = config('RESPONSE_CACHE_LOCAL_TTL', default=300, cast=int)
+
+# Single-flight: concurrent identical context-free prompts share one upstream call
+SINGLE_FLIGHT_ENABLED = config('SINGLE_FLIGHT_ENABLED', default=True, cast=bool)
+# Longest a caller waits on another's call before making its own
+SINGLE_FLIGHT_TIMEOUT = config('SINGLE_FLIGHT_TIMEOUT', default=30, cast=int)
+SINGLE_FLIGHT_POLL_INTERVAL = config('SINGLE_FLIGHT_POLL_INTERVAL', default=0.1, cast=float)
+# How long a finished reply stays readable by workers that were polling for it
+SINGLE_FLIGHT_RESULT_TTL = config('SINGLE_FLIGHT_RESULT_TTL', default=10, cast=int)
+
+# Prometheus metrics at /metrics. Set PROMETHEUS_MULTIPROC_DIR in the environment
+# of every Daphne, Gunicorn and Celery process to aggregate across workers.
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+# When set, scrapes must send "Authorization: Bearer <token>"
+METRICS_AUTH_TOKEN = config('METRICS_AUTH_TOKEN', default='')
+
+# Chat streaming
+# Clients may override per message with {"stream": true|false}
+CHAT_STREAMING_DEFAULT = config('CHAT_STREAMING_DEFAULT', default=False, cast=bool)
+# Seconds to coalesce streamed tokens into one delta frame
+CHAT_STREAM_FLUSH_INTERVAL = config('CHAT_STREAM_FLUSH_INTERVAL', default=0.05, cast=float)
+# Seconds within which one connection's typing events are coalesced into one publish
+CHAT_TYPING_WINDOW = config('CHAT_TYPING_WINDOW', default=1.0, cast=float)
+# What a message sent during a generation does: 'queue' behind it or 'supersede' it
+CHAT_TURN_POLICY = config('CHAT_TURN_POLICY', default='queue')
+# Turns a connection may have waiting under the 'queue' policy
+CHAT_TURN_QUEUE_LIMIT = config('CHAT_TURN_QUEUE_LIMIT', default=3, cast=int)
+
 # Logging
 LOGGING = {
     'version': 1,
@@ -2,8 +2,10 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from chatbot.metrics import metrics_view
 
 urlpatterns = [
+    path('metrics', metrics_view, name='metrics'),
     path('admin/', admin.site.urls),
     path('api/v1/auth/', include('accounts.urls')),
     path('api/v1/chat/', include('chatbot.urls')),
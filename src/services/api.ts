@@ -3,6 +3,8 @@ import {
   User, 
   ChatSession, 
   Message, 
+  MessagePage, 
+  MessageSearchPage, 
   AuthResponse, 
   SendMessageRequest, 
   SendMessageResponse 
@@ -135,9 +137,21 @@ class APIService {
     return response.data;
   }
 
-  async getSessionMessages(sessionId: number): Promise<Message[]> {
-    const response: AxiosResponse<Message[]> = await this.api.get(
-      `/api/v1/chat/sessions/${sessionId}/messages/`
+  async getSessionMessages(
+    sessionId: number,
+    cursor?: { before?: string; after?: string }
+  ): Promise<MessagePage> {
+    const response: AxiosResponse<MessagePage> = await this.api.get(
+      `/api/v1/chat/sessions/${sessionId}/messages/`,
+      { params: cursor }
+    );
+    return response.data;
+  }
+
+  async searchMessages(query: string, page: number = 1): Promise<MessageSearchPage> {
+    const response: AxiosResponse<MessageSearchPage> = await this.api.get(
+      '/api/v1/chat/messages/search/',
+      { params: { q: query, page } }
     );
     return response.data;
   }
@@ -82,6 +82,10 @@ export class ChatWebSocket {
         if (data.message) {
           this.onMessage?.(data.message);
         }
+        // The assistant's typing state is sent along with message frames
+        if (data.is_typing !== undefined) {
+          this.onTyping?.(data.is_typing);
+        }
         break;
       case 'typing':
         this.onTyping?.(data.is_typing || false, data.user_id);
@@ -30,10 +30,35 @@ export interface ChatSession {
   created_at: string;
   updated_at: string;
   messages?: Message[];
+  messages_before?: string | null;
   message_count?: number;
   last_message?: Message;
 }
 
+export interface MessagePage {
+  results: Message[];
+  before: string | null;
+  after: string | null;
+  has_newer: boolean;
+}
+
+export interface MessageSearchResult {
+  id: number;
+  chat_session: number;
+  session_id: string;
+  session_title: string;
+  message_type: 'user' | 'assistant' | 'system';
+  headline: string;
+  rank: number;
+  created_at: string;
+}
+
+export interface MessageSearchPage {
+  results: MessageSearchResult[];
+  page: number;
+  next_page: number | null;
+}
+
 export interface AuthResponse {
   token: string;
   user: User;